@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import logging
+import os
+import re
+
+# MUGQIC Modules
+
+log = logging.getLogger(__name__)
+
+# Header line of genome gap cache files, followed by the minimum gap length
+genome_gaps_cache_header = "#mugqic_genome_gaps\tmin_gap_length="
+
+# Size of FASTA sequence chunks scanned at once for N runs
+genome_gaps_chunk_size = 4 * 1024 * 1024
+
+# Return the genome gap cache file of a FASTA file, next to its .fai index
+def genome_gaps_cache_path(genome_fasta):
+    return genome_fasta + ".gaps.bed"
+
+# Return the ordered dict of gap lists by sequence name, each gap being a 0-based half-open (start, end) run of at least min_gap_length N bases
+def scan_genome_gaps(genome_fasta, min_gap_length):
+    gaps = collections.OrderedDict()
+
+    log.info("Scan genome gaps of at least " + str(min_gap_length) + " bp in " + genome_fasta + " ...")
+
+    def add_gap(sequence_gaps, start, end):
+        if end - start >= min_gap_length:
+            sequence_gaps.append((start, end))
+
+    # Scan chunks of joined sequence lines; an N run reaching the end of a chunk is pending until the next chunk
+    def scan_chunk(sequence_gaps, chunk, offset, pending_start):
+        matches = False
+        for match in re.finditer("[Nn]+", chunk):
+            matches = True
+            start = offset + match.start()
+            if pending_start is not None:
+                if match.start() == 0:
+                    start = pending_start
+                else:
+                    add_gap(sequence_gaps, pending_start, offset)
+                pending_start = None
+            if match.end() == len(chunk):
+                pending_start = start
+            else:
+                add_gap(sequence_gaps, start, offset + match.end())
+        # Pending N run ended at the previous chunk end
+        if pending_start is not None and not matches:
+            add_gap(sequence_gaps, pending_start, offset)
+            pending_start = None
+        return pending_start
+
+    with open(genome_fasta) as fasta:
+        sequence_gaps = None
+        lines = []
+        chunk_length = 0
+        offset = 0
+        pending_start = None
+        for line in fasta:
+            if line.startswith(">"):
+                if sequence_gaps is not None:
+                    pending_start = scan_chunk(sequence_gaps, "".join(lines), offset, pending_start)
+                    offset += chunk_length
+                    if pending_start is not None:
+                        add_gap(sequence_gaps, pending_start, offset)
+                sequence_gaps = gaps.setdefault(line[1:].split()[0], [])
+                lines = []
+                chunk_length = 0
+                offset = 0
+                pending_start = None
+            else:
+                line = line.rstrip()
+                lines.append(line)
+                chunk_length += len(line)
+                if chunk_length >= genome_gaps_chunk_size:
+                    pending_start = scan_chunk(sequence_gaps, "".join(lines), offset, pending_start)
+                    offset += chunk_length
+                    lines = []
+                    chunk_length = 0
+        if sequence_gaps is not None:
+            pending_start = scan_chunk(sequence_gaps, "".join(lines), offset, pending_start)
+            offset += chunk_length
+            if pending_start is not None:
+                add_gap(sequence_gaps, pending_start, offset)
+
+    log.info(str(sum([len(sequence_gaps) for sequence_gaps in gaps.values()])) + " gaps found\n")
+
+    return gaps
+
+# Return the cached genome gaps if the cache is more recent than the FASTA file and was built with the same minimum gap length, None otherwise
+def read_genome_gaps_cache(cache, genome_fasta, min_gap_length):
+    try:
+        if os.path.getmtime(cache) < os.path.getmtime(genome_fasta):
+            return None
+        gaps = collections.OrderedDict()
+        with open(cache) as cache_file:
+            if cache_file.readline().rstrip("\n") != genome_gaps_cache_header + str(min_gap_length):
+                return None
+            for line in cache_file:
+                fields = line.rstrip("\n").split("\t")
+                # Sequences without gap are listed with an empty gap
+                sequence_gaps = gaps.setdefault(fields[0], [])
+                if fields[1] != fields[2]:
+                    sequence_gaps.append((int(fields[1]), int(fields[2])))
+        return gaps
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+# Write genome gaps in BED format into a temporary file renamed once complete, so that concurrent readers never see a partial cache.
+# A failure is not an error: the genome directory may not be writable, gaps will then be scanned again next time.
+def write_genome_gaps_cache(cache, gaps, min_gap_length):
+    tmp_cache = cache + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmp_cache, 'w') as cache_file:
+            cache_file.write(genome_gaps_cache_header + str(min_gap_length) + "\n")
+            for name, sequence_gaps in gaps.items():
+                for start, end in sequence_gaps or [(0, 0)]:
+                    cache_file.write(name + "\t" + str(start) + "\t" + str(end) + "\n")
+        os.rename(tmp_cache, cache)
+        log.info("Genome gaps cached in " + cache)
+    except (IOError, OSError) as e:
+        log.warning("Genome gaps could not be cached in " + cache + ": " + str(e))
+        if os.path.exists(tmp_cache):
+            os.remove(tmp_cache)
+
+# Return the genome gaps of a FASTA file, read from its cache or scanned once and cached
+def genome_gaps(genome_fasta, min_gap_length):
+    cache = genome_gaps_cache_path(genome_fasta)
+    gaps = read_genome_gaps_cache(cache, genome_fasta, min_gap_length)
+    if gaps is None:
+        gaps = scan_genome_gaps(genome_fasta, min_gap_length)
+        write_genome_gaps_cache(cache, gaps, min_gap_length)
+    else:
+        log.info("Genome gaps read from cache " + cache + "\n")
+    return gaps
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import array
+import collections
+import cPickle
+import hashlib
+import logging
+import os
+import re
+import sys
+
+# MUGQIC Modules
+from core.config import *
+from genome_gaps import *
+
+log = logging.getLogger(__name__)
+
+# Version of reference table cache files, to be incremented whenever table contents change
+genome_reference_cache_version = 1
+
+# Fallback directory of reference table caches, used when the genome directory is not writable
+default_genome_reference_cache_dir = os.path.join(os.path.expanduser("~"), ".mugqic", "genome_reference")
+
+# Return the reference table cache file of a source file and a table set, next to the source file
+def reference_cache_path(source, table_set):
+    return source + ".mugqic_" + table_set + ".cache"
+
+# Return the fallback reference table cache file of a source file and a table set, in the user cache directory
+def fallback_reference_cache_path(source, table_set):
+    return os.path.join(default_genome_reference_cache_dir, hashlib.md5(os.path.abspath(source)).hexdigest() + "." + table_set + ".cache")
+
+# Reference table cache key: cache version, array layout since arrays are stored as raw bytes, source file size and modification time
+def reference_cache_key(source):
+    return (genome_reference_cache_version, sys.byteorder, array.array('L').itemsize, os.path.getsize(source), os.path.getmtime(source))
+
+# Return the tables of a cache file if it matches the current cache version and source file, None otherwise.
+# Tables are either stdlib arrays, stored as (type code, raw bytes), or string lists, stored as newline-separated strings.
+def read_reference_cache(cache, source):
+    try:
+        with open(cache, 'rb') as cache_file:
+            if cPickle.load(cache_file) != reference_cache_key(source):
+                return None
+            tables = {}
+            for name, (typecode, data) in cPickle.load(cache_file).items():
+                if typecode:
+                    tables[name] = array.array(typecode)
+                    tables[name].fromstring(data)
+                else:
+                    tables[name] = data.split("\n") if data else []
+            return tables
+    except (IOError, OSError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+        return None
+
+# Write tables into a temporary cache file renamed once complete, so that concurrent pipelines never read a partial cache.
+# Return True on success.
+def write_reference_cache(cache, source, tables):
+    tmp_cache = cache + "." + str(os.getpid()) + ".tmp"
+    try:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(cache))):
+            os.makedirs(os.path.dirname(os.path.abspath(cache)))
+        with open(tmp_cache, 'wb') as cache_file:
+            cPickle.dump(reference_cache_key(source), cache_file, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(dict([(name, (table.typecode, table.tostring()) if isinstance(table, array.array) else (None, "\n".join(table))) for name, table in tables.items()]), cache_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_cache, cache)
+        log.debug("Reference tables cached in " + cache)
+        return True
+    except (IOError, OSError) as e:
+        log.debug("Reference tables could not be cached in " + cache + ": " + str(e))
+        if os.path.exists(tmp_cache):
+            os.remove(tmp_cache)
+        return False
+
+# Return the tables of a source file, read from the cache next to it or in the user cache directory, or else parsed and cached
+def cached_reference_tables(source, table_set, parse_tables):
+    for cache in [reference_cache_path(source, table_set), fallback_reference_cache_path(source, table_set)]:
+        tables = read_reference_cache(cache, source)
+        if tables is not None:
+            log.debug("Reference tables of " + source + " read from cache " + cache)
+            return tables
+
+    tables = parse_tables(source)
+    if not write_reference_cache(reference_cache_path(source, table_set), source, tables) and not write_reference_cache(fallback_reference_cache_path(source, table_set), source, tables):
+        log.warning("Reference tables of " + source + " could not be cached")
+    return tables
+
+# Return the sequence name and length tables of a sequence dictionary file
+def parse_dictionary_tables(genome_dictionary):
+    names = []
+    lengths = array.array('L')
+    log.info("Parse sequence dictionary " + genome_dictionary + " ...")
+    with open(genome_dictionary) as dictionary:
+        for line in dictionary:
+            parsed_line = re.search("^@SQ\tSN:([^\t]+)\tLN:(\d+)", line)
+            if parsed_line:
+                names.append(parsed_line.group(1))
+                lengths.append(int(parsed_line.group(2)))
+    log.info(str(len(names)) + " sequences parsed\n")
+    return {'names': names, 'lengths': lengths}
+
+# Return the sequence name and length tables of a FASTA index file: sequence names and lengths are its first 2 columns
+def parse_fasta_index_tables(fasta_index):
+    names = []
+    lengths = array.array('L')
+    with open(fasta_index) as index:
+        for line in index:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                names.append(fields[0])
+                lengths.append(int(fields[1]))
+    return {'names': names, 'lengths': lengths}
+
+# Return the gene id and length tables of a GTF file, the length of a gene being the number of bases covered by its exons
+def parse_gtf_gene_tables(gtf):
+    exons = collections.OrderedDict()
+    log.info("Parse gene lengths of " + gtf + " ...")
+    with open(gtf) as gtf_file:
+        for line in gtf_file:
+            fields = line.split("\t")
+            if len(fields) >= 9 and fields[2] == "exon":
+                gene_id = re.search("gene_id \"([^\"]+)\"", fields[8])
+                if gene_id:
+                    exons.setdefault(gene_id.group(1), []).append((fields[0], int(fields[3]) - 1, int(fields[4])))
+
+    gene_ids = []
+    lengths = array.array('L')
+    for gene_id, gene_exons in exons.items():
+        # Overlapping exons of different transcripts are counted once
+        length = 0
+        merged_end = None
+        for sequence, start, end in sorted(gene_exons):
+            if merged_end is not None and sequence == merged_sequence and start < merged_end:
+                length += max(end - merged_end, 0)
+                merged_end = max(merged_end, end)
+            else:
+                length += end - start
+                merged_sequence = sequence
+                merged_end = end
+        gene_ids.append(gene_id)
+        lengths.append(length)
+    log.info(str(len(gene_ids)) + " genes parsed\n")
+    return {'gene_ids': gene_ids, 'lengths': lengths}
+
+# Reference genome metadata: sequence dictionary, FASTA index, gaps and GTF gene lengths, each loaded once when first needed.
+# Tables are stored as compact stdlib arrays, in versioned cache files next to their source files, or in the user cache directory
+# if the genome directory is not writable. Caches are rebuilt whenever their source file or the cache version changes.
+class GenomeReference:
+
+    def __init__(self, genome_fasta=None, genome_dictionary=None):
+        self._genome_fasta = genome_fasta
+        self._genome_dictionary = genome_dictionary
+        self._gaps = {}
+        self._gene_lengths = {}
+
+    # Genome files default to the config [DEFAULT] ones, only checked when needed
+    @property
+    def genome_fasta(self):
+        if not self._genome_fasta:
+            self._genome_fasta = config.param('DEFAULT', 'genome_fasta', type='filepath')
+        return self._genome_fasta
+
+    @property
+    def genome_dictionary(self):
+        if not self._genome_dictionary:
+            self._genome_dictionary = config.param('DEFAULT', 'genome_dictionary', type='filepath')
+        return self._genome_dictionary
+
+    @property
+    def dictionary_tables(self):
+        if not hasattr(self, "_dictionary_tables"):
+            self._dictionary_tables = cached_reference_tables(self.genome_dictionary, "dictionary", parse_dictionary_tables)
+        return self._dictionary_tables
+
+    @property
+    def fasta_index_tables(self):
+        if not hasattr(self, "_fasta_index_tables"):
+            self._fasta_index_tables = cached_reference_tables(self.genome_fasta + ".fai", "fasta_index", parse_fasta_index_tables)
+        return self._fasta_index_tables
+
+    # Sequence dictionary as a list of {'name', 'length'} dicts, in dictionary order
+    @property
+    def sequence_dictionary(self):
+        if not hasattr(self, "_sequence_dictionary"):
+            self._sequence_dictionary = [{'name': name, 'length': int(length)} for name, length in zip(self.dictionary_tables['names'], self.dictionary_tables['lengths'])]
+        return self._sequence_dictionary
+
+    # Total length of FASTA index sequences
+    @property
+    def genome_size(self):
+        return sum(self.fasta_index_tables['lengths'])
+
+    # Genome gaps of at least min_gap_length N bases, by sequence name
+    def gaps(self, min_gap_length):
+        if min_gap_length not in self._gaps:
+            self._gaps[min_gap_length] = genome_gaps(self.genome_fasta, min_gap_length)
+        return self._gaps[min_gap_length]
+
+    # Gene exonic lengths by gene id of a GTF file
+    def gene_lengths(self, gtf):
+        if gtf not in self._gene_lengths:
+            tables = cached_reference_tables(gtf, "gene_lengths", parse_gtf_gene_tables)
+            self._gene_lengths[gtf] = collections.OrderedDict(zip(tables['gene_ids'], tables['lengths']))
+        return self._gene_lengths[gtf]
+
+# Shared genome references by (genome FASTA, genome dictionary) files, None meaning the config [DEFAULT] one
+_genome_references = {}
+
+# Return the genome reference shared by all pipelines and wrappers for the given genome files
+def genome_reference(genome_fasta=None, genome_dictionary=None):
+    if (genome_fasta, genome_dictionary) not in _genome_references:
+        _genome_references[(genome_fasta, genome_dictionary)] = GenomeReference(genome_fasta, genome_dictionary)
+    return _genome_references[(genome_fasta, genome_dictionary)]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import logging
+import os
+import re
+import struct
+
+# MUGQIC Modules
+
+log = logging.getLogger(__name__)
+
+# Scatter weights are lists of 0-based half-open (start, end, weight) segments by sequence name, used by sequence_dictionary.scatter_intervals
+
+# BAI linear index window size
+bam_index_window_size = 16384
+
+# BAI pseudo-bin holding the numbers of mapped and unmapped reads of a reference
+bam_index_pseudo_bin = 37450
+
+# Return the index file of a BAM file, either <file>.bam.bai or <file>.bai, or None if not found
+def bam_index_file(bam):
+    for bam_index in [bam + ".bai", re.sub("\.bam$", ".bai", bam)]:
+        if os.path.isfile(bam_index):
+            return bam_index
+    return None
+
+# Return the target base weights of the union of BED files: each target base weighs 1
+def bed_weights(bed_files):
+    targets = collections.defaultdict(list)
+    for bed_file in bed_files:
+        log.info("Parse scatter weights from BED file " + bed_file + " ...")
+        with open(bed_file) as bed:
+            for line in bed:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) >= 3 and not re.search("^(#|track|browser)", line):
+                    targets[fields[0]].append((int(fields[1]), int(fields[2])))
+
+    # Merge overlapping targets so that bases targeted by several BED files are not counted twice
+    weights = {}
+    for name, sequence_targets in targets.items():
+        merged_targets = []
+        for start, end in sorted(sequence_targets):
+            if merged_targets and start <= merged_targets[-1][1]:
+                merged_targets[-1][1] = max(merged_targets[-1][1], end)
+            else:
+                merged_targets.append([start, end])
+        weights[name] = [(start, end, end - start) for start, end in merged_targets]
+
+    log.info(str(sum([len(segments) for segments in weights.values()])) + " targets parsed\n")
+    return weights
+
+# Return the (numbers of mapped reads or None if not recorded, linear index window compressed data sizes) lists by reference of a BAI file.
+# The compressed data size of a window is the difference between the file offsets of the first reads overlapping it and the next window.
+def parse_bam_index(bam_index):
+    with open(bam_index, 'rb') as bai:
+        data = bai.read()
+    if data[0:4] != "BAI\1":
+        raise Exception("Error: " + bam_index + " is not a valid BAM index file!")
+
+    references = []
+    position = 4
+    [nb_references] = struct.unpack_from("<i", data, position)
+    position += 4
+    for reference in range(nb_references):
+        nb_mapped_reads = None
+        reference_end_offset = 0
+        [nb_bins] = struct.unpack_from("<i", data, position)
+        position += 4
+        for bin in range(nb_bins):
+            bin_id, nb_chunks = struct.unpack_from("<Ii", data, position)
+            position += 8
+            chunks = struct.unpack_from("<" + str(2 * nb_chunks) + "Q", data, position)
+            position += 16 * nb_chunks
+            if bin_id == bam_index_pseudo_bin and nb_chunks == 2:
+                reference_end_offset = chunks[1] >> 16
+                nb_mapped_reads = chunks[2]
+        [nb_windows] = struct.unpack_from("<i", data, position)
+        position += 4
+        window_offsets = [offset >> 16 for offset in struct.unpack_from("<" + str(nb_windows) + "Q", data, position)]
+        position += 8 * nb_windows
+
+        # Empty windows may have a null offset: they hold no data
+        window_sizes = [0] * nb_windows
+        next_offset = reference_end_offset
+        for index in reversed(range(nb_windows)):
+            if window_offsets[index]:
+                window_sizes[index] = max(next_offset - window_offsets[index], 0)
+                next_offset = window_offsets[index]
+        references.append((nb_mapped_reads, window_sizes))
+
+    return references
+
+# Return the read density weights of BAM files from their index, summed over all BAM files: the number of mapped reads of each reference
+# is spread over its linear index windows in proportion to their compressed data size, or evenly if windows hold no data.
+# References of all BAM files must be the sequences of the dictionary, in the same order.
+def bam_index_weights(bam_indexes, sequence_dictionary):
+    weights = collections.defaultdict(lambda: collections.defaultdict(float))
+    for bam_index in bam_indexes:
+        log.info("Parse scatter weights from BAM index " + bam_index + " ...")
+        references = parse_bam_index(bam_index)
+        if len(references) != len(sequence_dictionary):
+            raise Exception("Error: BAM index " + bam_index + " has " + str(len(references)) + " references while genome dictionary has " + str(len(sequence_dictionary)) + " sequences!")
+        for sequence, (nb_mapped_reads, window_sizes) in zip(sequence_dictionary, references):
+            total_size = sum(window_sizes)
+            # Indexes without read counts weigh reads by their compressed data size
+            reference_weight = nb_mapped_reads if nb_mapped_reads is not None else total_size
+            if reference_weight and window_sizes:
+                for window, window_size in enumerate(window_sizes):
+                    weights[sequence['name']][window] += reference_weight * (float(window_size) / total_size if total_size else 1.0 / len(window_sizes))
+
+    log.info(str(len(bam_indexes)) + " BAM index" + ("es" if len(bam_indexes) > 1 else "") + " parsed\n")
+    return dict([(sequence['name'], [(window * bam_index_window_size, min((window + 1) * bam_index_window_size, sequence['length']), weights[sequence['name']][window])
+        for window in sorted(weights[sequence['name']]) if window * bam_index_window_size < sequence['length']]) for sequence in sequence_dictionary if sequence['name'] in weights])
@@ -20,59 +20,180 @@
 ################################################################################
 
 # Python Standard Modules
+import bisect
+import heapq
 import logging
+import math
 import re
 
 # MUGQIC Modules
+from genome_reference import *
 
 log = logging.getLogger(__name__)
 
+# Sequence dictionaries are parsed once and cached by the shared genome reference
 def parse_sequence_dictionary_file(sequence_dictionary_file):
-    sequence_dictionary = []
-
-    log.info("Parse sequence dictionary " + sequence_dictionary_file + " ...")
-
-    with open(sequence_dictionary_file) as sdf:
-        for line in sdf:
-            parsed_line = re.search("^@SQ\tSN:([^\t]+)\tLN:(\d+)", line)
-            if parsed_line:
-                sequence_dictionary.append({'name': parsed_line.group(1), 'length': int(parsed_line.group(2))})
-
-    log.info(str(len(sequence_dictionary)) + " sequences parsed\n")
-
-    return sequence_dictionary
-
-def split_by_size(sequence_dictionary, nbSplits):
-    split_list = []
-
-    total = 0
+    return list(genome_reference(genome_dictionary=sequence_dictionary_file).sequence_dictionary)
+
+# Return the sequence dictionary scattered in nb_shards shards of balanced total weight, as lists of GATK intervals.
+# Weights are optional lists of 0-based half-open (start, end, weight) segments by sequence name, e.g. target bases or read counts,
+# bases outside segments weighing nothing; by default, each base weighs 1 i.e. shards are balanced by length.
+# With split_sequences, the genome is cut in contiguous shards of equal weight, long sequences being split in "name:start-end" sub-intervals,
+# so that shard outputs concatenated in shard order remain sorted by genomic position, as required by GATK CatVariants.
+# Otherwise, whole sequences are assigned to the least loaded shard by decreasing weight (longest processing time first bin packing),
+# e.g. for read walkers which would output reads overlapping a sub-interval boundary twice. Shard intervals are kept in dictionary order
+# and the shard with the most intervals is the last one, so that it can be processed as the complement of all other shards.
+# Shard imbalance, i.e. the heaviest shard weight relative to the mean shard weight, is logged.
+def scatter_intervals(sequence_dictionary, nb_shards, split_sequences=True, weights=None):
+    total = sum([sequence['length'] for sequence in sequence_dictionary])
+    nb_shards = max(1, min(nb_shards, total if split_sequences else len(sequence_dictionary)))
+    shards = [[] for shard in range(nb_shards)]
+    shard_lengths = [0] * nb_shards
+
+    if weights is not None and sum([weight for sequence in sequence_dictionary for start, end, weight in weights.get(sequence['name'], [])]) <= 0:
+        log.warning("Scatter weights do not match any sequence of the dictionary: shards are balanced by length instead")
+        weights = None
+    unit = "weight" if weights is not None else "length"
+
+    # Weighted segments laid end to end in dictionary order, in genome coordinates
+    segment_starts = []
+    segment_ends = []
+    segment_weights = []
+    offset = 0
     for sequence in sequence_dictionary:
-        total += sequence['length']
-
-    blockSize = int(total/nbSplits)
+        for start, end, weight in weights.get(sequence['name'], []) if weights is not None else [(0, sequence['length'], sequence['length'])]:
+            if weight > 0 and end > start:
+                segment_starts.append(offset + start)
+                segment_ends.append(offset + end)
+                segment_weights.append(weight)
+        offset += sequence['length']
+    cumulative_weights = [0]
+    for weight in segment_weights:
+        cumulative_weights.append(cumulative_weights[-1] + weight)
+    total_weight = cumulative_weights[-1]
+
+    # Cumulative weight of the genome before a position, the weight of a segment being evenly spread over its bases
+    def cumulative_weight(position):
+        index = bisect.bisect_right(segment_starts, position) - 1
+        if index < 0:
+            return 0
+        return cumulative_weights[index] + segment_weights[index] * min(1, float(position - segment_starts[index]) / (segment_ends[index] - segment_starts[index]))
+
+    # Genome position where the cumulative weight reaches a weight
+    def weight_position(weight):
+        index = min(max(bisect.bisect_left(cumulative_weights, weight) - 1, 0), len(segment_weights) - 1)
+        return segment_starts[index] + int(round((weight - cumulative_weights[index]) / segment_weights[index] * (segment_ends[index] - segment_starts[index])))
+
+    if split_sequences:
+        # Shard boundaries in genome coordinates, each shard holding at least one base
+        boundaries = [weight_position(float(total_weight) * index / nb_shards) for index in range(1, nb_shards)] + [total]
+        for index in range(nb_shards - 1):
+            boundaries[index] = max(boundaries[index], boundaries[index - 1] + 1 if index > 0 else 1)
+        for index in reversed(range(nb_shards - 1)):
+            boundaries[index] = min(boundaries[index], boundaries[index + 1] - 1)
+
+        shard = 0
+        offset = 0
+        for sequence in sequence_dictionary:
+            start = offset
+            end = offset + sequence['length']
+            while start < end:
+                while boundaries[shard] <= start:
+                    shard += 1
+                interval_end = min(end, boundaries[shard])
+                if start == offset and interval_end == end:
+                    shards[shard].append(sequence['name'])
+                else:
+                    # GATK intervals are 1-based and inclusive
+                    shards[shard].append(sequence['name'] + ":" + str(start - offset + 1) + "-" + str(interval_end - offset))
+                shard_lengths[shard] += interval_end - start
+                start = interval_end
+            offset = end
+        shard_weights = [cumulative_weight(boundary) - cumulative_weight(previous_boundary) for previous_boundary, boundary in zip([0] + boundaries[:-1], boundaries)]
+    else:
+        sequence_weights = [sum([weight for start, end, weight in weights.get(sequence['name'], [])]) if weights is not None else sequence['length'] for sequence in sequence_dictionary]
+        heap = [(0, shard) for shard in range(nb_shards)]
+        shard_sequence_indexes = [[] for shard in range(nb_shards)]
+        shard_weights = [0] * nb_shards
+        for index in sorted(range(len(sequence_dictionary)), key=lambda index: (sequence_weights[index], sequence_dictionary[index]['length']), reverse=True):
+            weight, shard = heapq.heappop(heap)
+            shard_sequence_indexes[shard].append(index)
+            shard_weights[shard] = weight + sequence_weights[index]
+            shard_lengths[shard] += sequence_dictionary[index]['length']
+            heapq.heappush(heap, (shard_weights[shard], shard))
+        order = sorted(range(nb_shards), key=lambda shard: (len(shard_sequence_indexes[shard]), sorted(shard_sequence_indexes[shard])))
+        shards = [[sequence_dictionary[index]['name'] for index in sorted(shard_sequence_indexes[shard])] for shard in order]
+        shard_lengths = [shard_lengths[shard] for shard in order]
+        shard_weights = [shard_weights[shard] for shard in order]
+
+    mean_weight = float(total_weight) / nb_shards
+    log.info("Genome scattered in " + str(nb_shards) + " shard" + ("s" if nb_shards > 1 else "") + (" with" if split_sequences else " without") + " sequence splitting: " + \
+        "shard " + unit + " min " + str(int(round(min(shard_weights)))) + ", max " + str(int(round(max(shard_weights)))) + ", mean " + str(int(round(mean_weight))) + \
+        (" bp" if unit == "length" else "") + ", imbalance (max/mean) " + ("%.2f" % (max(shard_weights) / mean_weight) if mean_weight else "N/A") + "\n")
+    for shard, (intervals, shard_length, shard_weight) in enumerate(zip(shards, shard_lengths, shard_weights)):
+        log.debug("Shard " + str(shard) + ": " + str(shard_length) + " bp" + (", weight " + str(int(round(shard_weight))) if unit == "weight" else "") + ", " + str(len(intervals)) + " interval" + ("s" if len(intervals) > 1 else "") + ": " + " ".join(intervals))
+
+    return shards
+
+# Return the BED lines "name<TAB>start<TAB>end" of GATK intervals, either whole sequence names or 1-based inclusive "name:start-end" sub-intervals
+def intervals_to_bed(sequence_dictionary, intervals):
+    sequence_lengths = dict([(sequence['name'], sequence['length']) for sequence in sequence_dictionary])
+    bed_lines = []
+    for interval in intervals:
+        if interval in sequence_lengths:
+            bed_lines.append(interval + "\t0\t" + str(sequence_lengths[interval]))
+        else:
+            parsed_interval = re.search("^(.+):(\d+)-(\d+)$", interval)
+            bed_lines.append(parsed_interval.group(1) + "\t" + str(int(parsed_interval.group(2)) - 1) + "\t" + parsed_interval.group(3))
+    return bed_lines
+
+# Return about nb_windows "name:start-end" windows covering all sequences, each window carrying a similar number of callable bases
+# i.e. bases outside gaps given as 0-based half-open (start, end) lists by sequence name. Window boundaries are placed in the middle
+# of gaps whenever the current window holds at least half of the target callable length, so that no window falls entirely in a gap;
+# callable runs longer than the target length are cut. Each sequence has at least one window, except sequences entirely in gaps which are skipped.
+def gap_aware_windows(sequence_dictionary, gaps, nb_windows):
+    callable_lengths = [sequence['length'] - sum([end - start for start, end in gaps.get(sequence['name'], [])]) for sequence in sequence_dictionary]
+    target = max(1, int(math.ceil(float(sum(callable_lengths)) / nb_windows)))
+    windows = []
+    window_callable_lengths = []
 
-    total = 0
-    toExcludeChr = []
-    currentChrs = []
     for sequence in sequence_dictionary:
-        # Stop if we already reached our limit.
-        # This can gappen since the size of chromosomes vary
-        if len(split_list) == nbSplits:
-            break
-
-        if total+sequence['length'] > blockSize:
-            split_list.append(currentChrs)
-            toExcludeChr.extend(currentChrs)
-            currentChrs = []
-            total = 0
-        currentChrs.append(sequence['name'])
-        total += sequence['length']
-
-    # If the split gave a round number remove the last block and set it in other
-    if len(split_list) == len(sequence_dictionary):
-        toRemove = split_list.pop()
-        for sequence in toRemove:
-          toExcludeChr.pop()
-        
-
-    return split_list,toExcludeChr
+        window_start = 0
+        window_callable = 0
+        previous_end = 0
+        # Callable runs between gaps
+        runs = []
+        for gap_start, gap_end in gaps.get(sequence['name'], []):
+            if gap_start > previous_end:
+                runs.append((previous_end, gap_start))
+            previous_end = max(previous_end, gap_end)
+        if sequence['length'] > previous_end:
+            runs.append((previous_end, sequence['length']))
+        if not runs:
+            log.debug("Sequence " + sequence['name'] + " skipped since it is entirely in gaps")
+            continue
+
+        previous_end = 0
+        for start, end in runs:
+            if window_callable + end - start > target and window_callable >= target / 2.0:
+                boundary = (previous_end + start) // 2
+                windows.append((sequence['name'], window_start, boundary))
+                window_callable_lengths.append(window_callable)
+                window_start = boundary
+                window_callable = 0
+            while window_callable + end - start > target:
+                boundary = start + target - window_callable
+                windows.append((sequence['name'], window_start, boundary))
+                window_callable_lengths.append(target)
+                window_start = boundary
+                start = boundary
+                window_callable = 0
+            window_callable += end - start
+            previous_end = end
+        windows.append((sequence['name'], window_start, sequence['length']))
+        window_callable_lengths.append(window_callable)
+
+    log.info("Gap-aware windows: " + str(len(windows)) + " windows of callable length min " + str(min(window_callable_lengths)) + \
+        ", max " + str(max(window_callable_lengths)) + ", mean " + str(sum(window_callable_lengths) // len(windows)) + " bp\n")
+
+    return [name + ":" + str(start + 1) + "-" + str(end) for name, start, end in windows]
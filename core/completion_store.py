@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import logging
+import os
+
+# MUGQIC Modules
+from config import *
+from stat_cache import *
+
+log = logging.getLogger(__name__)
+
+# Completion log file name, in the job output directory i.e. the parent directory of step job .done file directories
+completion_log_name = "mugqic.completion.log"
+
+# Completion log record states: a job removes its completion when it starts and records it again when it succeeds
+completion_log_states = ["start", "done"]
+
+# Return the completion log of the job output directory containing a job .done file
+def completion_log_path(abspath_done):
+    return os.path.join(os.path.dirname(os.path.dirname(abspath_done)), completion_log_name)
+
+# Return the set of absolute .done paths of completed jobs recorded in a completion log, the last record of each job prevailing
+def read_completion_log(completion_log):
+    output_dir = os.path.dirname(os.path.dirname(completion_log))
+    completed_jobs = set()
+    try:
+        with open(completion_log) as completion_log_file:
+            for line in completion_log_file:
+                fields = line.rstrip("\n").split("\t")
+                # Skip records partially written by a job killed while writing
+                if len(fields) == 2 and fields[0] in completion_log_states:
+                    abspath_done = os.path.normpath(os.path.join(output_dir, fields[1]))
+                    if fields[0] == "done":
+                        completed_jobs.add(abspath_done)
+                    else:
+                        completed_jobs.discard(abspath_done)
+    except IOError:
+        pass
+    return completed_jobs
+
+# Shell command appending a record to a completion log, under an exclusive lock if 'flock' is available.
+# A single small write in append mode is atomic on POSIX file systems anyway.
+def completion_log_cmd(state, done, completion_log):
+    return "(command -v flock > /dev/null && flock -x 9 || true ; printf '" + state + "\\t%s\\n' " + done + " >&9) 9>> " + completion_log
+
+# Job completion store: either one .done file per job (default) or, with '[DEFAULT] completion_store=log',
+# one append-only completion log per pipeline output directory, written by job scripts and read by the pipeline in a single pass.
+# Job input and output file manifests of checksum up-to-date check are still stored next to job .done file paths.
+class CompletionStore:
+
+    def __init__(self):
+        self._completion_logs = {}
+
+    @property
+    def type(self):
+        if not hasattr(self, "_type"):
+            self._type = config.param('DEFAULT', 'completion_store', required=False) or "files"
+            if self._type not in ["files", "log"]:
+                raise Exception("Error: completion_store \"" + self._type + "\" is invalid (should be files or log)!")
+        return self._type
+
+    # Return True if job has completed successfully since its last start
+    def is_done(self, abspath_done):
+        if self.type == "log":
+            completion_log = completion_log_path(abspath_done)
+            if completion_log not in self._completion_logs:
+                self._completion_logs[completion_log] = read_completion_log(completion_log)
+            return abspath_done in self._completion_logs[completion_log]
+        else:
+            return stat_cache.exists(abspath_done)
+
+    # Shell command removing job completion, given its .done file path possibly as a shell variable
+    def remove_done_cmd(self, done, output_dir):
+        if self.type == "log":
+            return "rm -f " + done + ".manifest && " + completion_log_cmd("start", done, os.path.join(output_dir, "job_output", completion_log_name))
+        else:
+            return "rm -f " + done + " " + done + ".manifest"
+
+    # Shell command recording job completion, given its .done file path possibly as a shell variable
+    def create_done_cmd(self, done, output_dir):
+        if self.type == "log":
+            return completion_log_cmd("done", done, os.path.join(output_dir, "job_output", completion_log_name))
+        else:
+            return "touch " + done
+
+# Global completion store object used throughout the whole pipeline
+completion_store = CompletionStore()
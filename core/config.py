@@ -22,17 +22,24 @@
 # Python Standard Modules
 import ConfigParser
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
 import sys
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
+# Default file caching modules successfully checked, with their module file fingerprints
+default_check_modules_cache = os.path.join(os.path.expanduser("~"), ".mugqic", "check_modules_cache.json")
+
 class Config(ConfigParser.SafeConfigParser):
 
     def __init__(self):
+        self.clear_param_cache()
         ConfigParser.SafeConfigParser.__init__(self)
 
     @property
@@ -44,9 +51,32 @@ class Config(ConfigParser.SafeConfigParser):
         self.optionxform = str
         for config_file in config_files:
             self.readfp(config_file)
+        # Parameter values may have changed
+        self.clear_param_cache()
         self.check_modules()
 
-    # Check by a system call if all modules defined in config files are available
+    # Parameter values are memoized by (section, option, type) and file system validations by (type, path)
+    def clear_param_cache(self):
+        self._param_cache = {}
+        self._path_checks = {}
+        self._param_lookups = 0
+        self._param_cache_hits = 0
+
+    @property
+    def param_lookups(self):
+        return self._param_lookups
+
+    @property
+    def param_cache_hits(self):
+        return self._param_cache_hits
+
+    def set(self, section, option, value=None):
+        ConfigParser.SafeConfigParser.set(self, section, option, value)
+        self.clear_param_cache()
+
+    # Check by a system call if all modules defined in config files are available.
+    # Modules are checked concurrently and successful checks are cached on disk:
+    # a module is checked again only if its fingerprint (MODULEPATH and module file modification times) changed.
     def check_modules(self):
         modules = []
 
@@ -58,21 +88,80 @@ class Config(ConfigParser.SafeConfigParser):
                     modules.append(value)
 
         log.info("Check modules...")
+        check_modules_cache = os.path.expandvars(self.param('DEFAULT', 'check_modules_cache', required=False) or default_check_modules_cache)
+        cached_fingerprints = self.load_check_modules_cache(check_modules_cache)
+        module_fingerprints = dict([(module, module_fingerprint(module)) for module in modules])
+
+        unchecked_modules = [module for module in modules if cached_fingerprints.get(module) != module_fingerprints[module]]
+        if unchecked_modules:
+            nb_threads = self.param('DEFAULT', 'check_modules_threads', required=False, type='posint') or 8
+            pool = ThreadPool(min(nb_threads, len(unchecked_modules)))
+            try:
+                module_show_outputs = dict(zip(unchecked_modules, pool.map(module_show, unchecked_modules)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            module_show_outputs = {}
+
         for module in modules:
-            # Bash shell must be invoked in order to find "module" cmd
-            module_show_output = subprocess.check_output(["bash", "-c", "module show " + module], stderr=subprocess.STDOUT)
-            if re.search("Error", module_show_output, re.IGNORECASE):
-                raise Exception("Error in config file(s) with " + module + ":\n" + module_show_output)
+            if module in module_show_outputs:
+                if re.search("Error", module_show_outputs[module], re.IGNORECASE):
+                    raise Exception("Error in config file(s) with " + module + ":\n" + module_show_outputs[module])
+                else:
+                    log.info("Module " + module + " OK")
+                    cached_fingerprints[module] = module_fingerprints[module]
             else:
-                log.info("Module " + module + " OK")
+                log.info("Module " + module + " OK (cached)")
+
+        if unchecked_modules:
+            self.save_check_modules_cache(check_modules_cache, cached_fingerprints)
         log.info("Module check finished\n")
 
+    def load_check_modules_cache(self, check_modules_cache):
+        if os.path.isfile(check_modules_cache):
+            try:
+                with open(check_modules_cache) as cache_file:
+                    return json.load(cache_file)
+            except ValueError:
+                log.warning("Invalid module check cache " + check_modules_cache + "... ignoring")
+        return {}
+
+    def save_check_modules_cache(self, check_modules_cache, module_fingerprints):
+        # Write cache in a temporary file first, then rename it, so that concurrent pipelines never read a partial cache
+        tmp_check_modules_cache = check_modules_cache + "." + str(os.getpid()) + ".tmp"
+        try:
+            if not os.path.isdir(os.path.dirname(check_modules_cache)):
+                os.makedirs(os.path.dirname(check_modules_cache))
+            with open(tmp_check_modules_cache, 'w') as cache_file:
+                json.dump(module_fingerprints, cache_file, indent=2, sort_keys=True)
+            os.rename(tmp_check_modules_cache, check_modules_cache)
+        except (IOError, OSError) as e:
+            log.warning("Module check cache " + check_modules_cache + " could not be written: " + str(e))
+
     # Retrieve param in config files with optional definition check and type validation
     # By default, parameter is required to be defined in one of the config file
     def param(self, section, option, required=True, type='string'):
-        # Store original section for future error message, in case 'DEFAULT' section is used eventually
-        original_section = section
+        self._param_lookups += 1
+        param_key = (section, option, type)
+        if param_key in self._param_cache:
+            self._param_cache_hits += 1
+            value = self._param_cache[param_key]
+        else:
+            # Undefined parameter value is cached as None
+            value = self.typed_param(section, option, type)
+            self._param_cache[param_key] = value
+
+        if value is not None:
+            # Return a copy of list values so that the cached value cannot be modified by the caller
+            return list(value) if type == 'list' else value
+        elif required:
+            raise Exception("Error: parameter \"[" + section + "] " + option + "\" is not defined in config file(s)!")
+        else:
+            return ""
 
+    # Return param value validated and converted to type, or None if param is not defined
+    def typed_param(self, section, option, type):
         if not self.has_section(section):
             section = 'DEFAULT'
 
@@ -92,19 +181,19 @@ class Config(ConfigParser.SafeConfigParser):
                     return self.getboolean(section, option)
                 elif type == 'filepath':
                     value = os.path.expandvars(self.get(section, option))
-                    if os.path.isfile(value):
+                    if self.check_path(type, value):
                         return value
                     else:
                         raise Exception("File path \"" + value + "\" does not exist or is not a valid regular file!")
                 elif type == 'dirpath':
                     value = os.path.expandvars(self.get(section, option))
-                    if os.path.isdir(value):
+                    if self.check_path(type, value):
                         return value
                     else:
                         raise Exception("Directory path \"" + value + "\" does not exist or is not a valid directory!")
                 elif type == 'prefixpath':
                     value = os.path.expandvars(self.get(section, option))
-                    if glob.glob(value + "*"):
+                    if self.check_path(type, value):
                         return value
                     else:
                         raise Exception("Prefix path \"" + value + "\" does not match any file!")
@@ -117,10 +206,48 @@ class Config(ConfigParser.SafeConfigParser):
                     raise Exception("Unknown parameter type '" + type + "'")
             except Exception as e:
                 raise Exception("Error: parameter \"[" + section + "] " + option + "\" value \"" + self.get(section, option) + "\" is invalid!\n" + e.message)
-        elif required:
-            raise Exception("Error: parameter \"[" + original_section + "] " + option + "\" is not defined in config file(s)!")
         else:
-            return ""
+            return None
+
+    # Check file system path validity for a path parameter type, only once per path
+    def check_path(self, type, path):
+        path_key = (type, path)
+        if path_key not in self._path_checks:
+            if type == 'filepath':
+                self._path_checks[path_key] = os.path.isfile(path)
+            elif type == 'dirpath':
+                self._path_checks[path_key] = os.path.isdir(path)
+            elif type == 'prefixpath':
+                self._path_checks[path_key] = bool(glob.glob(path + "*"))
+        return self._path_checks[path_key]
+
+# Return the output of "module show" for a module
+def module_show(module):
+    # Bash shell must be invoked in order to find "module" cmd
+    return subprocess.check_output(["bash", "-c", "module show " + module], stderr=subprocess.STDOUT)
+
+# Return a fingerprint of a module from the MODULEPATH value and the modification times of its candidate module files
+# i.e. "<module>", "<module>.lua", their parent directory and its version files setting the default module version,
+# in each MODULEPATH directory. A module given without version may also be a directory containing its own version files.
+def module_fingerprint(module):
+    module_path = os.environ.get("MODULEPATH", "")
+    fingerprint = hashlib.md5(module_path)
+    for module_dir in [module_dir for module_dir in module_path.split(":") if module_dir]:
+        module_file = os.path.join(module_dir, module)
+        for candidate_file in [
+            module_file,
+            module_file + ".lua",
+            os.path.dirname(module_file),
+            os.path.join(os.path.dirname(module_file), ".version"),
+            os.path.join(os.path.dirname(module_file), ".modulerc"),
+            os.path.join(module_file, ".version"),
+            os.path.join(module_file, ".modulerc")
+        ]:
+            try:
+                fingerprint.update(candidate_file + ":" + repr(os.stat(candidate_file).st_mtime) + "\n")
+            except OSError:
+                pass
+    return fingerprint.hexdigest()
 
 # Global config object used throughout the whole pipeline
 config = Config()
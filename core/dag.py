@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import hashlib
+import logging
+import os
+import re
+
+# MUGQIC Modules
+from completion_store import *
+from config import *
+from early_removal import *
+from fingerprint import *
+from job import *
+
+log = logging.getLogger(__name__)
+
+# Config section of fused jobs, whose cluster settings apply to all fused jobs
+job_fusion_section = "job_fusion"
+
+# Convert a duration "[[D-]HH:]MM:SS" or a number of seconds into seconds
+def parse_duration(duration):
+    match = re.match("^(?:(?:(\d+)-)?(\d+):)?(\d+):(\d+)$", duration)
+    if match:
+        [days, hours, minutes, seconds] = [int(value) if value else 0 for value in match.groups()]
+        return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+    elif re.match("^\d+$", duration):
+        return int(duration)
+    else:
+        raise Exception("Error: duration \"" + duration + "\" is invalid (should be [[D-]HH:]MM:SS or a number of seconds)!")
+
+# Return job expected runtime in seconds from its config section 'expected_runtime' hint, or None if undefined
+def expected_runtime(job):
+    # Config section must match job name prefix before first "."
+    expected_runtime = config.param(job.name.split(".")[0], 'expected_runtime', required=False)
+    return parse_duration(expected_runtime) if expected_runtime else None
+
+# Runtime estimate in seconds of jobs without expected runtime hint nor walltime
+default_runtime_estimate = 3600
+
+# Return job runtime estimate in seconds: its expected runtime hint if any, else its walltime set by the resource model if any,
+# else its requested cluster walltime
+def runtime_estimate(job):
+    runtime = expected_runtime(job)
+    if runtime is None and job.walltime:
+        runtime = job.walltime
+    elif runtime is None:
+        match = re.search("(?:walltime=|--time=)([\d:-]+)", config.param(job.name.split(".")[0], 'cluster_walltime', required=False))
+        runtime = parse_duration(match.group(1)) if match else default_runtime_estimate
+    return runtime
+
+# Format a duration in seconds as "HH:MM:SS"
+def format_duration(duration):
+    return "%02d:%02d:%02d" % (duration / 3600, duration / 60 % 60, duration % 60)
+
+# Return a dict of dependent jobs by job
+def dependent_jobs(jobs):
+    dependent_jobs = dict([(job, []) for job in jobs])
+    for job in jobs:
+        for dependency_job in job.dependency_jobs:
+            dependent_jobs[dependency_job].append(job)
+    return dependent_jobs
+
+# Return a new job running member jobs sequentially, each member job recording its own completion on success.
+# Thus, up-to-date member jobs are still skipped individually when the pipeline is run again.
+def fused_job(jobs, step, output_dir):
+    job = concat_jobs(jobs, name=job_fusion_section + "." + jobs[0].name)
+    job.modules = []
+    # Member .done file directories may not exist if their step has no other job
+    job.command = "mkdir -p " + " ".join(collections.OrderedDict.fromkeys([os.path.dirname(member_job.done) for member_job in jobs])) + " && \\\n" + \
+        " && \\\n".join(["""\
+{remove_done_cmd}{early_removal_start_cmd} && \\
+(
+{job.command_with_modules}
+) && \\
+{create_done_cmd}{write_manifest_cmd}{early_removal_end_cmd}""".format(
+            job=member_job,
+            remove_done_cmd=completion_store.remove_done_cmd(member_job.done, output_dir),
+            create_done_cmd=completion_store.create_done_cmd(member_job.done, output_dir),
+            write_manifest_cmd=write_manifest_cmd(member_job),
+            early_removal_start_cmd=early_removal.job_start_cmd(member_job),
+            early_removal_end_cmd=early_removal.job_end_cmd(member_job)
+        ) for member_job in jobs])
+
+    job.done = os.path.join("job_output", step.name, job.name + "." + hashlib.md5(job.command_with_modules).hexdigest() + ".mugqic.done")
+    job.output_dir = output_dir
+    return job
+
+# Fuse short jobs, i.e. with an expected runtime hint, into jobs whose total expected runtime is at most max_runtime seconds:
+# - chains: a short job whose only dependency is a short job with no other dependent job is appended to this job chain,
+# - siblings: short job chains of the same step and config section, independent from other jobs of this step, are packed together.
+# Only jobs requesting the same cluster resources as fused jobs are fused.
+# Each fused job replaces its members in the step of its last member, and job dependencies are updated accordingly.
+def fuse_jobs(steps, max_runtime, output_dir):
+    jobs = [job for step in steps for job in step.jobs]
+    dependents = dependent_jobs(jobs)
+
+    runtimes = {}
+    fusion_cluster_cpu = config.param(job_fusion_section, 'cluster_cpu')
+    for job in jobs:
+        runtime = expected_runtime(job)
+        if runtime is not None and runtime <= max_runtime and config.param(job.name.split(".")[0], 'cluster_cpu') == fusion_cluster_cpu:
+            runtimes[job] = runtime
+
+    # Build job chains in submission order
+    chains = {}
+    for job in jobs:
+        if job in runtimes and len(job.dependency_jobs) == 1:
+            dependency_job = job.dependency_jobs[0]
+            if dependency_job in chains and len(dependents[dependency_job]) == 1:
+                chain = chains[dependency_job]
+                if sum([runtimes[chain_job] for chain_job in chain]) + runtimes[job] <= max_runtime:
+                    chain.append(job)
+                    chains[job] = chain
+                    continue
+        if job in runtimes:
+            chains[job] = [job]
+
+    # Pack independent chains of each step by config section of their last job, in submission order
+    groups = []
+    for step in steps:
+        step_jobs = set(step.jobs)
+        bins = {}
+        for job in step.jobs:
+            if job in chains and chains[job][-1] is job:
+                chain = chains[job]
+                chain_jobs = set(chain)
+                is_independent = not [other_job for chain_job in chain for other_job in chain_job.dependency_jobs + dependents[chain_job] if other_job in step_jobs and other_job not in chain_jobs]
+                runtime = sum([runtimes[chain_job] for chain_job in chain])
+                section = job.name.split(".")[0]
+                if is_independent and section in bins and bins[section][1] + runtime <= max_runtime:
+                    bins[section][0].extend(chain)
+                    bins[section][1] += runtime
+                else:
+                    group = [list(chain), runtime]
+                    groups.append((step, group[0]))
+                    if is_independent:
+                        bins[section] = group
+
+    # Create fused jobs from groups of several jobs
+    fused_jobs = {}
+    member_jobs = collections.OrderedDict()
+    for step, group in groups:
+        if len(group) > 1:
+            job = fused_job(group, step, output_dir)
+            member_jobs[job] = group
+            for member_job in group:
+                fused_jobs[member_job] = job
+
+    if fused_jobs:
+        # Fused job dependencies are the union of their member dependencies, then all dependencies on members are redirected to fused jobs
+        for job in jobs + member_jobs.keys():
+            if job not in fused_jobs:
+                dependency_jobs = [dependency_job for member_job in member_jobs[job] for dependency_job in member_job.dependency_jobs] if job in member_jobs else job.dependency_jobs
+                job.dependency_jobs = [dependency_job for dependency_job in collections.OrderedDict.fromkeys([fused_jobs.get(dependency_job, dependency_job) for dependency_job in dependency_jobs]) if dependency_job is not job]
+
+        # A fused job takes the position of its last member
+        for step in steps:
+            step_jobs = []
+            for job in step.jobs:
+                if job not in fused_jobs:
+                    step_jobs.append(job)
+                elif member_jobs[fused_jobs[job]][-1] is job:
+                    step_jobs.append(fused_jobs[job])
+            step.reset_jobs(step_jobs)
+
+        log.info("Job fusion: " + str(len(fused_jobs)) + " jobs fused into " + str(len(member_jobs)) + " job" + ("s" if len(member_jobs) > 1 else "") + "\n")
+
+# Remove redundant job dependencies i.e. the transitive reduction of the job dependency graph:
+# a dependency job is redundant if another dependency job depends on it directly or indirectly.
+# Jobs must be given in submission order, dependency jobs being always submitted before their dependent jobs.
+# Return the number of removed dependencies.
+def reduce_dependencies(jobs):
+    nb_dependencies = 0
+    nb_removed_dependencies = 0
+    # Transitive dependency jobs by job, released once all dependent jobs are processed
+    ancestors = {}
+    nb_pending_dependents = collections.Counter([dependency_job for job in jobs for dependency_job in job.dependency_jobs])
+    for job in jobs:
+        indirect_dependency_jobs = set()
+        for dependency_job in job.dependency_jobs:
+            indirect_dependency_jobs.update(ancestors[dependency_job])
+        reduced_dependency_jobs = [dependency_job for dependency_job in job.dependency_jobs if dependency_job not in indirect_dependency_jobs]
+
+        nb_dependencies += len(job.dependency_jobs)
+        if len(reduced_dependency_jobs) < len(job.dependency_jobs):
+            log.debug("Job " + job.name + ": " + str(len(job.dependency_jobs) - len(reduced_dependency_jobs)) + " redundant dependencies removed")
+            nb_removed_dependencies += len(job.dependency_jobs) - len(reduced_dependency_jobs)
+
+        if nb_pending_dependents[job]:
+            ancestors[job] = indirect_dependency_jobs.union(job.dependency_jobs)
+        for dependency_job in job.dependency_jobs:
+            nb_pending_dependents[dependency_job] -= 1
+            if not nb_pending_dependents[dependency_job]:
+                del ancestors[dependency_job]
+        job.dependency_jobs = reduced_dependency_jobs
+
+    log.info("Transitive reduction: " + str(nb_removed_dependencies) + " redundant job dependencies removed out of " + str(nb_dependencies) + "\n")
+    return nb_removed_dependencies
+
+# Return a dict of critical path lengths in seconds by job i.e. the longest runtime estimate sum of job chains starting with this job.
+# Jobs must be given in submission order, dependency jobs being always submitted before their dependent jobs.
+def critical_path_lengths(jobs):
+    dependents = dependent_jobs(jobs)
+    critical_path_lengths = {}
+    for job in reversed(jobs):
+        critical_path_lengths[job] = runtime_estimate(job) + max([critical_path_lengths[dependent_job] for dependent_job in dependents[job]] or [0])
+    return critical_path_lengths
+
+# Set job priorities proportionally to their critical path length, so that long job chains are started first,
+# and report the predicted makespan with unlimited cluster resources i.e. the longest critical path length
+def prioritize_critical_paths(jobs):
+    if jobs:
+        lengths = critical_path_lengths(jobs)
+        dependents = dependent_jobs(jobs)
+        makespan = max(lengths.values())
+        for job in jobs:
+            job.priority = float(lengths[job]) / makespan if makespan else 1.0
+            log.debug("Job " + job.name + " critical path length: " + format_duration(lengths[job]) + ", priority: " + "%.3f" % job.priority)
+
+        # Follow the longest chain from its first job
+        critical_path = [max(jobs, key=lambda job: lengths[job])]
+        while dependents[critical_path[-1]]:
+            critical_path.append(max(dependents[critical_path[-1]], key=lambda job: lengths[job]))
+
+        log.info("Predicted makespan: " + format_duration(makespan) + " (" + str(len(critical_path)) + " job" + ("s" if len(critical_path) > 1 else "") + " on critical path)")
+        log.info("Critical path:\n  " + "\n  ".join([job.name + " (" + format_duration(runtime_estimate(job)) + ")" for job in critical_path]) + "\n")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import hashlib
+import logging
+import os
+
+# MUGQIC Modules
+from stat_cache import *
+
+log = logging.getLogger(__name__)
+
+# Directory of removable file reference tokens, in the job output directory
+early_removal_dir_name = "early_removal"
+
+# Early removal of removable files while the pipeline runs, instead of after the whole run with '--clean'.
+# Each removable file is referenced by its holder jobs: the jobs reading it or a file under it (if it is a directory),
+# plus the jobs listing it as removable. Each holder job removes its reference token when it starts
+# and creates it on success; the holder job completing last finds all tokens and removes the file.
+# Removable files without any job reading them are left to '--clean'.
+# Once a file is removed, a marker listing its holder jobs is left next to its token directory, so that these jobs
+# are still up to date without the file when the pipeline is run again. A holder job starting again removes the marker.
+class EarlyRemoval:
+
+    def __init__(self):
+        # (removable file absolute path, token directory, holder job names) list by job
+        self._job_removable_files = {}
+        # Holder job names read from removal markers, by marker path
+        self._removed_holder_job_names = {}
+
+    # Set removable file references of all jobs, given in submission order, and return the number of removable files removed early
+    def plan(self, jobs, output_dir):
+        # Holder jobs by removable file absolute path, in submission order
+        consumer_jobs = collections.OrderedDict()
+        listing_jobs = collections.OrderedDict()
+        for job in jobs:
+            for removable_file in job.removable_files:
+                listing_jobs.setdefault(job.abspath(removable_file), collections.OrderedDict())[job] = True
+
+        for job in jobs:
+            for input_file in job.input_files:
+                # Input file may be the removable file or any file under a removable directory
+                path = job.abspath(input_file)
+                while path not in [os.sep, ""]:
+                    if path in listing_jobs:
+                        consumer_jobs.setdefault(path, collections.OrderedDict())[job] = True
+                    path = os.path.dirname(path)
+
+        self._job_removable_files = {}
+        for removable_file in consumer_jobs:
+            holder_jobs = list(collections.OrderedDict.fromkeys(listing_jobs[removable_file].keys() + consumer_jobs[removable_file].keys()))
+            token_dir = removal_token_dir(output_dir, removable_file)
+            for job in holder_jobs:
+                self._job_removable_files.setdefault(job, []).append((removable_file, token_dir, [holder_job.name for holder_job in holder_jobs]))
+            log.debug("Removable file " + removable_file + " removed after jobs:\n  " + "\n  ".join([holder_job.name for holder_job in holder_jobs]))
+
+        log.info("Early removal: " + str(len(consumer_jobs)) + " removable file" + ("s" if len(consumer_jobs) > 1 else "") + " out of " + str(len(listing_jobs)) + " removed once their last reading job completes\n")
+        return len(consumer_jobs)
+
+    # Shell command suffix removing job reference tokens and removal markers when it starts
+    def job_start_cmd(self, job):
+        return "".join([" && rm -f " + os.path.join(token_dir, job.name) + " " + removal_marker_path(token_dir) for removable_file, token_dir, holder_job_names in self._job_removable_files.get(job, [])])
+
+    # Shell command suffix creating job reference tokens on success, and removing files whose holder jobs have all completed,
+    # leaving a removal marker listing the holder jobs. Removal failures do not fail the job.
+    def job_end_cmd(self, job):
+        return "".join([" && (mkdir -p " + token_dir + " && touch " + os.path.join(token_dir, job.name) +
+            " && if [ " + " -a ".join(["-e " + os.path.join(token_dir, holder_job_name) for holder_job_name in holder_job_names]) + " ] ; then rm -rf " + removable_file + " " + token_dir +
+            " && printf '%s\\n' " + " ".join(holder_job_names) + " > " + removal_marker_path(token_dir) + " ; fi || true)"
+            for removable_file, token_dir, holder_job_names in self._job_removable_files.get(job, [])])
+
+    # Return the removal marker of a missing file removed early, i.e. of the file or of a removed directory containing it,
+    # or None if the file was not removed early
+    def removal_marker(self, path, output_dir):
+        while path not in [os.sep, ""]:
+            marker = removal_marker_path(removal_token_dir(output_dir, path))
+            if stat_cache.exists(marker):
+                return marker
+            path = os.path.dirname(path)
+        return None
+
+    # Return the holder job names of a missing file removed early, or None if the file was not removed early
+    def removed_holder_job_names(self, path, output_dir):
+        marker = self.removal_marker(path, output_dir)
+        if marker and marker not in self._removed_holder_job_names:
+            try:
+                with open(marker) as marker_file:
+                    self._removed_holder_job_names[marker] = set(marker_file.read().split())
+            except IOError:
+                self._removed_holder_job_names[marker] = set()
+        return self._removed_holder_job_names[marker] if marker else None
+
+    # Return True if a missing file was removed early after the given job completed, the job being one of its holder jobs
+    def is_removed_after(self, job, path):
+        holder_job_names = self.removed_holder_job_names(path, job.output_dir)
+        return holder_job_names is not None and job.name in holder_job_names
+
+# Token directory of a removable file absolute path
+def removal_token_dir(output_dir, removable_file):
+    return os.path.join(output_dir, "job_output", early_removal_dir_name, hashlib.md5(removable_file).hexdigest())
+
+# Removal marker of a removable file, next to its token directory
+def removal_marker_path(token_dir):
+    return token_dir + ".removed"
+
+# Global early removal object used throughout the whole pipeline
+early_removal = EarlyRemoval()
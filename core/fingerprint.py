@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import hashlib
+import json
+import logging
+import os
+import stat
+import sys
+from multiprocessing.pool import ThreadPool
+
+# MUGQIC Modules
+from config import *
+from stat_cache import *
+
+log = logging.getLogger(__name__)
+
+# Size of the file blocks sampled at the beginning, middle and end of a file
+sample_block_size = 65536
+
+# Return a fast content fingerprint of a file: its size and a checksum of 3 sampled blocks.
+# For a directory, return a checksum of the relative paths and sizes of all its files.
+def fingerprint(path):
+    path_stat = os.stat(path)
+    checksum = hashlib.md5()
+    if stat.S_ISDIR(path_stat.st_mode):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                checksum.update(os.path.relpath(file_path, path) + "\t" + str(os.path.getsize(file_path)) + "\n")
+        return "dir:" + checksum.hexdigest()
+    else:
+        with open(path, 'rb') as file:
+            if path_stat.st_size <= 3 * sample_block_size:
+                checksum.update(file.read())
+            else:
+                for offset in [0, (path_stat.st_size - sample_block_size) // 2, path_stat.st_size - sample_block_size]:
+                    file.seek(offset)
+                    checksum.update(file.read(sample_block_size))
+        return str(path_stat.st_size) + ":" + checksum.hexdigest()
+
+# Manifest of job input and output file fingerprints, stored next to the job .done file
+def manifest_path(abspath_done):
+    return abspath_done + ".manifest"
+
+# Manifest record key of an absolute file path: relative to the job output directory, so that a job is still up to date
+# after the whole output directory is copied or moved, or absolute if the file is outside the output directory
+def manifest_key(path, output_dir):
+    relpath = os.path.relpath(path, output_dir)
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        return path
+    else:
+        return relpath
+
+# Return manifest file records {"input_files": {path: record}, "output_files": {path: record}} keyed by absolute path,
+# or None if missing or invalid
+def read_manifest(abspath_done, output_dir):
+    try:
+        with open(manifest_path(abspath_done)) as manifest_file:
+            manifest = json.load(manifest_file)
+        return dict([(files, dict([(os.path.normpath(os.path.join(output_dir, key)), record) for key, record in manifest[files].items()])) for files in ["input_files", "output_files"]])
+    except (IOError, ValueError, KeyError, AttributeError):
+        return None
+
+# Write manifest file records given by absolute path, keyed by path relative to the job output directory if possible
+def write_manifest(abspath_done, output_dir, input_records, output_records):
+    try:
+        with open(manifest_path(abspath_done), 'w') as manifest_file:
+            json.dump({
+                "input_files": dict([(manifest_key(path, output_dir), record) for path, record in input_records.items()]),
+                "output_files": dict([(manifest_key(path, output_dir), record) for path, record in output_records.items()])
+            }, manifest_file, indent=2, sort_keys=True)
+        stat_cache.invalidate(manifest_path(abspath_done))
+    except IOError as e:
+        log.warning("Manifest " + manifest_path(abspath_done) + " could not be written: " + str(e))
+
+# Return the fingerprint record of an existing file.
+# Symbolic links are followed: the record describes the link target, so that a changed target is fingerprinted again.
+def fingerprint_record(path):
+    path_stat = os.stat(path)
+    return {"size": path_stat.st_size, "mtime": path_stat.st_mtime, "fingerprint": fingerprint(path)}
+
+# Shell command recording the job manifest once the job has succeeded if '[DEFAULT] up2date_check=checksum' is set,
+# so that the job is still up to date after its files are copied or restored with new modification times.
+# The manifest is recorded by '[DEFAULT] manifest_python' if set, or else by the Python interpreter running the pipeline,
+# since the 'python' found once job modules are loaded may be another version.
+# A failure does not fail the job but is reported: without manifest, the job is then checked by modification times.
+def write_manifest_cmd(job):
+    if config.param('DEFAULT', 'up2date_check', required=False) == "checksum":
+        manifest_python = config.param('DEFAULT', 'manifest_python', required=False) or sys.executable
+        return " && (" + manifest_python + " " + os.path.splitext(os.path.abspath(__file__))[0] + ".py " + job.abspath(job.done) + " " + job.output_dir + " " + \
+            " ".join([job.abspath(input_file) for input_file in job.input_files]) + " -- " + \
+            " ".join([job.abspath(output_file) for output_file in job.output_files]) + \
+            " || echo 'Warning: manifest of " + job.abspath(job.done) + " could not be recorded, job will be checked by modification times' >&2)"
+    else:
+        return ""
+
+# Cache of file fingerprint records {"size": ..., "mtime": ..., "fingerprint": ...} keyed by absolute path.
+# A fingerprint is computed incrementally: a known record, e.g. from a job manifest,
+# is reused as long as the file size and modification time did not change.
+class FingerprintCache:
+
+    def __init__(self):
+        self._records = {}
+        self._manifests = {}
+
+    # Return job manifest records keyed by absolute path, reading each manifest file only once
+    def manifest(self, abspath_done, output_dir):
+        if abspath_done not in self._manifests:
+            self._manifests[abspath_done] = read_manifest(abspath_done, output_dir)
+        return self._manifests[abspath_done]
+
+    # Symbolic links are followed, as in fingerprint records
+    def _is_current(self, path, record):
+        path_stat = stat_cache.stat(path)
+        return path_stat is not None and record.get("size") == path_stat.st_size and record.get("mtime") == path_stat.st_mtime
+
+    # Called from worker threads, hence using the file system directly instead of the stat cache
+    def _compute(self, path):
+        return fingerprint_record(path)
+
+    # Return the fingerprint record of an existing file, reusing known record if still current
+    def record(self, path, known_record=None):
+        if path not in self._records:
+            if known_record and self._is_current(path, known_record):
+                self._records[path] = known_record
+            else:
+                self._records[path] = self._compute(path)
+        return self._records[path]
+
+    # Compute fingerprints of existing files in parallel, except those whose known record is still current
+    def prefetch(self, paths, known_records={}, nb_threads=default_nb_threads):
+        missing_paths = []
+        for path in set(paths):
+            if path not in self._records and stat_cache.exists(path):
+                if path in known_records and self._is_current(path, known_records[path]):
+                    self._records[path] = known_records[path]
+                else:
+                    missing_paths.append(path)
+        if len(missing_paths) > 1 and nb_threads > 1:
+            pool = ThreadPool(min(nb_threads, len(missing_paths)))
+            try:
+                self._records.update(zip(missing_paths, pool.map(self._compute, missing_paths)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._records.update([(path, self._compute(path)) for path in missing_paths])
+        log.debug("Fingerprint cache: " + str(len(missing_paths)) + " fingerprints computed, " + str(len(self._records)) + " paths")
+
+# Global fingerprint cache object used throughout the whole pipeline
+fingerprint_cache = FingerprintCache()
+
+# Record the manifest of a completed job, called from job scripts:
+# fingerprint.py <job .done file> <job output directory> <job input files> -- <job output files>
+if __name__ == '__main__':
+    logging.basicConfig()
+    separator_index = sys.argv.index("--")
+    write_manifest(
+        sys.argv[1],
+        sys.argv[2],
+        dict([(path, fingerprint_record(path)) for path in sys.argv[3:separator_index]]),
+        dict([(path, fingerprint_record(path)) for path in sys.argv[separator_index + 1:]])
+    )
@@ -26,7 +26,11 @@ import logging
 import os
 
 # MUGQIC Modules
+from completion_store import *
 from config import *
+from early_removal import *
+from fingerprint import *
+from stat_cache import *
 
 log = logging.getLogger(__name__)
 
@@ -40,10 +44,16 @@ class Job:
         self._removable_files = filter(None, removable_files)
 
         # Retrieve modules from config, removing duplicates but keeping the order
-        self._modules = list(collections.OrderedDict.fromkeys([config.param(section, option) for section, option in module_entries]))
+        self._modules = list(OrderedSet([config.param(section, option) for section, option in module_entries]))
 
         self._name = name
         self._command = command
+        # Optional scheduling priority between 0 (lowest) and 1 (highest)
+        self._priority = None
+        # Optional walltime in seconds overriding config cluster settings
+        self._walltime = None
+        # Optional memory in MB raising config cluster settings
+        self._memory = None
 
     @property
     def id(self):
@@ -81,6 +91,18 @@ class Job:
     def dependency_jobs(self):
         return self._dependency_jobs
 
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def walltime(self):
+        return self._walltime
+
+    @property
+    def memory(self):
+        return self._memory
+
     @property
     def modules(self):
         return self._modules
@@ -115,22 +137,52 @@ class Job:
         abspath_input_files = [self.abspath(input_file) for input_file in self.input_files]
         abspath_output_files = [self.abspath(output_file) for output_file in self.output_files]
 
-        # If any .done, input or output file is missing, job is not up to date
-        for file in [abspath_done] + abspath_input_files + abspath_output_files:
+        # If job completion is not recorded, job is not up to date
+        if not completion_store.is_done(abspath_done):
+            log.debug("Job " + self.name + " NOT up to date")
+            log.debug("Job completion not recorded: " + abspath_done)
+            return False
+
+        # If any input or output file is missing, job is not up to date,
+        # unless it was removed early after this job completed
+        removed_files = []
+        for file in abspath_input_files + abspath_output_files:
             # Use 'exists' instead of 'isfile' since input/output files can be directories
-            if not os.path.exists(file):
-                log.debug("Job " + self.name + " NOT up to date")
-                log.debug("Input, output or .done file missing: " + file)
-                return False
+            if not stat_cache.exists(file):
+                if config.param('DEFAULT', 'early_removal', required=False, type='boolean') and early_removal.is_removed_after(self, file):
+                    removed_files.append(file)
+                else:
+                    log.debug("Job " + self.name + " NOT up to date")
+                    log.debug("Input or output file missing: " + file)
+                    return False
+
+        # Files removed early are not compared anymore
+        if removed_files:
+            log.debug("Job " + self.name + " files removed early:\n  " + "\n  ".join(removed_files))
+            abspath_input_files = [file for file in abspath_input_files if file not in removed_files]
+            abspath_output_files = [file for file in abspath_output_files if file not in removed_files]
+
+        up2date_check = config.param('DEFAULT', 'up2date_check', required=False) or "mtime"
+        if up2date_check == "mtime":
+            return self.is_up2date_by_mtime(abspath_input_files, abspath_output_files)
+        elif up2date_check == "checksum":
+            return self.is_up2date_by_checksum(abspath_done, abspath_input_files, abspath_output_files, removed_files)
+        else:
+            raise Exception("Error: up2date_check \"" + up2date_check + "\" is invalid (should be mtime or checksum)!")
+
+    def is_up2date_by_mtime(self, abspath_input_files, abspath_output_files):
+        # Without input or output files left to compare, e.g. removed early, job is up to date
+        if not abspath_input_files or not abspath_output_files:
+            return True
 
         # Retrieve latest input file by modification time i.e. maximum stat mtime
         # Use lstat to avoid following symbolic links
-        latest_input_file = max(abspath_input_files, key=lambda input_file: os.lstat(input_file).st_mtime)
-        latest_input_time = os.lstat(latest_input_file).st_mtime
+        latest_input_file = max(abspath_input_files, key=lambda input_file: stat_cache.lstat(input_file).st_mtime)
+        latest_input_time = stat_cache.lstat(latest_input_file).st_mtime
 
         # Same with earliest output file by modification time
-        earliest_output_file = min(abspath_output_files, key=lambda output_file:os.lstat(output_file).st_mtime)
-        earliest_output_time = os.lstat(earliest_output_file).st_mtime
+        earliest_output_file = min(abspath_output_files, key=lambda output_file: stat_cache.lstat(output_file).st_mtime)
+        earliest_output_time = stat_cache.lstat(earliest_output_file).st_mtime
 
         # If any input file is strictly more recent than all output files, job is not up to date
         if latest_input_time > earliest_output_time:
@@ -141,25 +193,233 @@ class Job:
         # If all previous tests passed, job is up to date
         return True
 
+    # Compare input and output file content fingerprints with the ones recorded in the job manifest, ignoring modification times.
+    # Without manifest, e.g. for a job completed before this check was enabled, fall back to modification times
+    # and record the manifest if the job is up to date.
+    # Files removed early may be missing from the manifest or not.
+    def is_up2date_by_checksum(self, abspath_done, abspath_input_files, abspath_output_files, removed_files=[]):
+        manifest = fingerprint_cache.manifest(abspath_done, self.output_dir)
+        if manifest:
+            recorded_records = dict(manifest["input_files"].items() + manifest["output_files"].items())
+            if set(recorded_records).difference(removed_files) != set(abspath_input_files + abspath_output_files):
+                log.debug("Job " + self.name + " NOT up to date")
+                log.debug("Input or output files differ from manifest: " + manifest_path(abspath_done) + "\n")
+                return False
+
+            current_records = {}
+            for file in abspath_input_files + abspath_output_files:
+                current_records[file] = fingerprint_cache.record(file, recorded_records[file])
+                if current_records[file]["fingerprint"] != recorded_records[file]["fingerprint"]:
+                    log.debug("Job " + self.name + " NOT up to date")
+                    log.debug("File content changed since job completion: " + file + "\n")
+                    return False
+
+            # Record current modification times of files whose content did not change e.g. copied files
+            if [file for file in current_records if current_records[file] is not recorded_records[file]]:
+                write_manifest(abspath_done, self.output_dir, dict([(file, current_records[file]) for file in abspath_input_files]), dict([(file, current_records[file]) for file in abspath_output_files]))
+
+            return True
+
+        elif self.is_up2date_by_mtime(abspath_input_files, abspath_output_files):
+            write_manifest(abspath_done, self.output_dir, dict([(file, fingerprint_cache.record(file)) for file in abspath_input_files]), dict([(file, fingerprint_cache.record(file)) for file in abspath_output_files]))
+            return True
+
+        else:
+            return False
+
+
+# Return a tuple of strings e.g. file paths, interning them so that strings shared by several jobs
+# e.g. output files of a job being input files of another one, are stored once
+def intern_strings(values):
+    return tuple([intern(value) if isinstance(value, str) else value for value in values])
+
+# Compact job representation for very large plans, created from a job once its step has created it:
+# attributes are stored in slots instead of a dict, file lists are interned path tuples and modules are interned.
+# Attributes can be assigned like job ones, but file lists cannot be modified in place anymore.
+class CompactJob(object):
+
+    __slots__ = ("_id", "_name", "_output_dir", "_input_files", "_output_files", "_report_files", "_removable_files", "_done", "_dependency_jobs", "_priority", "_walltime", "_memory", "_modules", "_command")
+
+    def __init__(self, job):
+        self.input_files = job.input_files
+        self.output_files = job.output_files
+        self.report_files = job.report_files
+        self.removable_files = job.removable_files
+        self.modules = job.modules
+        self.name = job.name
+        self.command = job.command
+        self.priority = job.priority
+        self.walltime = job.walltime
+        self.memory = job.memory
+        # Attributes set by pipeline or scheduler if any
+        for attribute in ["id", "output_dir", "done", "dependency_jobs"]:
+            if hasattr(job, attribute):
+                setattr(self, attribute, getattr(job, attribute))
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+
+    @property
+    def output_dir(self):
+        return self._output_dir
+
+    @output_dir.setter
+    def output_dir(self, value):
+        self._output_dir = intern(value) if isinstance(value, str) else value
+
+    @property
+    def input_files(self):
+        return self._input_files
+
+    @input_files.setter
+    def input_files(self, value):
+        self._input_files = intern_strings(value)
+
+    @property
+    def output_files(self):
+        return self._output_files
+
+    @output_files.setter
+    def output_files(self, value):
+        self._output_files = intern_strings(value)
+
+    @property
+    def report_files(self):
+        return self._report_files
+
+    @report_files.setter
+    def report_files(self, value):
+        self._report_files = intern_strings(value)
+
+    @property
+    def removable_files(self):
+        return self._removable_files
+
+    @removable_files.setter
+    def removable_files(self, value):
+        self._removable_files = intern_strings(value)
+
+    @property
+    def done(self):
+        return self._done
+
+    @done.setter
+    def done(self, value):
+        self._done = value
+
+    @property
+    def dependency_jobs(self):
+        return self._dependency_jobs
+
+    @dependency_jobs.setter
+    def dependency_jobs(self, value):
+        self._dependency_jobs = value
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, value):
+        self._priority = value
+
+    @property
+    def walltime(self):
+        return self._walltime
+
+    @walltime.setter
+    def walltime(self, value):
+        self._walltime = value
+
+    @property
+    def memory(self):
+        return self._memory
+
+    @memory.setter
+    def memory(self, value):
+        self._memory = value
+
+    @property
+    def modules(self):
+        return self._modules
+
+    @modules.setter
+    def modules(self, value):
+        self._modules = intern_strings(value)
+
+    @property
+    def command(self):
+        return self._command
+
+    @command.setter
+    def command(self, value):
+        self._command = value
+
+    # Job methods are shared as is
+    command_with_modules = Job.__dict__["command_with_modules"]
+    abspath = Job.__dict__["abspath"]
+    is_up2date = Job.__dict__["is_up2date"]
+    is_up2date_by_mtime = Job.__dict__["is_up2date_by_mtime"]
+    is_up2date_by_checksum = Job.__dict__["is_up2date_by_checksum"]
+
+
+# Set of values keeping their insertion order, used to merge job files and modules without duplicates in linear time
+class OrderedSet(collections.MutableSet):
+
+    def __init__(self, values=[]):
+        self._values = collections.OrderedDict.fromkeys(values)
+
+    def __contains__(self, value):
+        return value in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        self._values[value] = None
+
+    def discard(self, value):
+        self._values.pop(value, None)
+
+    def update(self, values):
+        for value in values:
+            self._values[value] = None
 
 # Create a new job by concatenating a list of jobs together
 def concat_jobs(jobs, name=""):
 
     # Merge all input/output/report/removable files and modules
-    input_files = []
-    output_files = []
-    report_files = []
-    removable_files = []
-    modules = []
+    input_files = OrderedSet()
+    output_files = OrderedSet()
+    report_files = OrderedSet()
+    removable_files = OrderedSet()
+    modules = OrderedSet()
     for job_item in jobs:
-        input_files.extend([input_file for input_file in job_item.input_files if input_file not in input_files and input_file not in output_files])
-        output_files.extend([output_file for output_file in job_item.output_files if output_file not in output_files])
-        report_files.extend([report_file for report_file in job_item.report_files if report_file not in report_files])
-        removable_files.extend([removable_file for removable_file in job_item.removable_files if removable_file not in removable_files])
-        modules.extend([module for module in job_item.modules if module not in modules])
+        # Input files produced by a previous job are not input files of the new job
+        input_files.update([input_file for input_file in job_item.input_files if input_file not in output_files])
+        output_files.update(job_item.output_files)
+        report_files.update(job_item.report_files)
+        removable_files.update(job_item.removable_files)
+        modules.update(job_item.modules)
 
-    job = Job(input_files, output_files, name=name, report_files=report_files, removable_files=removable_files)
-    job.modules = modules
+    job = Job(list(input_files), list(output_files), name=name, report_files=list(report_files), removable_files=list(removable_files))
+    job.modules = list(modules)
 
     # Merge commands
     job.command = " && \\\n".join([job_item.command for job_item in jobs])
@@ -171,22 +431,18 @@ def pipe_jobs(jobs, name=""):
 
     job = Job(jobs[0].input_files, jobs[-1].output_files, name=name)
 
-    # Merge all report/removable files and modules
-    report_files = []
-    removable_files = []
-    modules = []
+    # Merge all report/removable files and modules, removing duplicates if any, keeping the order
+    report_files = OrderedSet()
+    removable_files = OrderedSet()
+    modules = OrderedSet()
     for job_item in jobs:
-        report_files.extend(job_item.report_files)
-        removable_files.extend(job_item.removable_files)
-        modules.extend(job_item.modules)
-
-    # Remove duplicates if any, keeping the order
-    report_files = list(collections.OrderedDict.fromkeys([report_file for report_file in report_files]))
-    job.report_files = report_files
-    removable_files = list(collections.OrderedDict.fromkeys([removable_file for removable_file in removable_files]))
-    job.removable_files = removable_files
-    modules = list(collections.OrderedDict.fromkeys([module for module in modules]))
-    job.modules = modules
+        report_files.update(job_item.report_files)
+        removable_files.update(job_item.removable_files)
+        modules.update(job_item.modules)
+
+    job.report_files = list(report_files)
+    job.removable_files = list(removable_files)
+    job.modules = list(modules)
 
     # Merge commands
     job.command = " | \\\n".join([job_item.command for job_item in jobs])
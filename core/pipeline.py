@@ -35,9 +35,18 @@ import re
 import textwrap
 
 # MUGQIC Modules
+from completion_store import *
 from config import *
+from dag import *
+from early_removal import *
+from fingerprint import *
 from job import *
+from plan_cache import *
+from plan_profiler import *
+from resource_model import *
 from scheduler import *
+from staging import *
+from stat_cache import *
 from step import *
 
 log = logging.getLogger(__name__)
@@ -110,19 +119,31 @@ Usage
             else:
                 self.argparser.error("argument -s/--steps is required!")
 
-            # For job reporting, all jobs must be created first, no matter whether they are up to date or not
+            # Planning is profiled in all modes, the profiler being stopped even if planning fails
+            self.plan_profiler.start()
+            try:
+                # For job reporting or cleaning, all jobs must be created first, no matter whether they are up to date or not
+                if self.args.report or self.args.clean:
+                    self._force_jobs = True
+                    self.create_jobs()
+                else:
+                    self._force_jobs = self.args.force
+                    self.create_jobs()
+                    size_job_resources(self.jobs)
+                    stage_jobs(self.jobs)
+                    self.plan_early_removal()
+                    self.fuse_short_jobs()
+                    self.reduce_job_dependencies()
+                    self.prioritize_jobs()
+            finally:
+                self.plan_profiler.stop()
+            self.plan_profiler.write_summary(self.step_range)
+
             if self.args.report:
-                self._force_jobs = True
-                self.create_jobs()
                 self.report_jobs()
-            # For job cleaning, all jobs must be created first, no matter whether they are up to date or not
             elif self.args.clean:
-                self._force_jobs = True
-                self.create_jobs()
                 self.clean_jobs()
             else:
-                self._force_jobs = self.args.force
-                self.create_jobs()
                 self.submit_jobs()
 
     # Pipeline command line arguments parser
@@ -145,10 +166,12 @@ Steps:
             self._argparser.add_argument("-c", "--config", help="config INI-style list of files; config parameters are overwritten based on files order", nargs="+", type=file)
             self._argparser.add_argument("-s", "--steps", help="step range e.g. '1-5', '3,6,7', '2,4-8'")
             self._argparser.add_argument("-o", "--output-dir", help="output directory (default: current)", default=os.getcwd())
-            self._argparser.add_argument("-j", "--job-scheduler", help="job scheduler type (default: pbs)", choices=["pbs", "batch"], default="pbs")
+            self._argparser.add_argument("-j", "--job-scheduler", help="job scheduler type; 'local' executes jobs directly on this machine (default: pbs)", choices=["pbs", "slurm", "batch", "local"], default="pbs")
             self._argparser.add_argument("-f", "--force", help="force creation of jobs even if up to date (default: false)", action="store_true")
             self._argparser.add_argument("--report", help="create 'pandoc' command to merge all job markdown report files in the given step range into HTML, if they exist; if --report is set, --job-scheduler, --force, --clean options and job up-to-date status are ignored (default: false)", action="store_true")
             self._argparser.add_argument("--clean", help="create 'rm' commands for all job removable files in the given step range, if they exist; if --clean is set, --job-scheduler, --force options and job up-to-date status are ignored (default: false)", action="store_true")
+            self._argparser.add_argument("--plan-cache", help="reuse jobs created by previous invocations with the same config values, pipeline arguments and pipeline version, cached in <output_dir>/job_output/<Pipeline>.plan_cache; job dependencies and up-to-date status are still checked (default: false)", action="store_true")
+            self._argparser.add_argument("--profile-plan", help="write on stderr a summary table of the time spent creating jobs, checking dependencies and up-to-date status, and the number of file system calls and config lookups by step; if PROFILE_FILE is given, also write cProfile statistics of the whole planning in it (default: false)", nargs="?", const=True, metavar="PROFILE_FILE")
             self._argparser.add_argument("-l", "--log", help="log level (default: info)", choices=["debug", "info", "warning", "error", "critical"], default="info")
 
         return self._argparser
@@ -201,54 +224,98 @@ Steps:
     # Given a list of lists of input files, return the first valid list of input files which can be found either in previous jobs output files or on file system.
     # Thus, a job with several candidate lists of input files can find out the first valid one.
     def select_input_files(self, candidate_input_files):
+        selected_input_files = self.find_input_files(candidate_input_files)
+        # Record input file selection to check it when cached step jobs are reused
+        if getattr(self, "_input_selections", None) is not None:
+            self._input_selections.append((candidate_input_files, selected_input_files))
+        return selected_input_files
+
+    # Write a file read by step jobs, e.g. a region BED file, when jobs are created and only if its content changed,
+    # so that jobs reading it stay up to date as long as its content is the same.
+    # With '--report' or '--clean', no job is submitted: files are not written, since jobs already queued may read them,
+    # and missing ones are not reported as missing job input files.
+    # File path is relative to the pipeline output directory if not absolute.
+    def write_plan_file(self, file, content):
+        # Record plan file to write it again when cached step jobs are reused
+        if getattr(self, "_plan_files", None) is not None:
+            self._plan_files.append((file, content))
+        path = os.path.join(self.output_dir, file)
+        if self.args.report or self.args.clean:
+            if not hasattr(self, "_unwritten_plan_files"):
+                self._unwritten_plan_files = set()
+            self._unwritten_plan_files.add(os.path.normpath(path))
+            return
+        # Plan files are recorded as such, not as file system state read by the step
+        file_system_probes.pause()
+        try:
+            if os.path.isfile(path):
+                with open(path) as plan_file:
+                    if plan_file.read() == content:
+                        return
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+                stat_cache.invalidate(os.path.dirname(path))
+            with open(path, 'w') as plan_file:
+                plan_file.write(content)
+            stat_cache.invalidate(path)
+        finally:
+            file_system_probes.resume()
+
+    def find_input_files(self, candidate_input_files):
         log.debug("candidate_input_files: \n" + str(candidate_input_files))
 
-        selected_input_files = []
-
-        # Create a reversed copy to pop the candidates ordered by priority
-        remaining_candidate_input_files = list(candidate_input_files)
-        remaining_candidate_input_files.reverse()
-        previous_jobs_output_files = set([output_file for job in self.jobs for output_file in job.output_files])
-
-        while not selected_input_files and remaining_candidate_input_files:
-            input_files = filter(None, remaining_candidate_input_files.pop())
+        for input_files in candidate_input_files:
+            input_files = filter(None, input_files)
             # Skip empty candidate input files
             if input_files:
-                # dependency_jobs() checks if the current candidate input files is valid, otherwise raises an exception
-                try:
-                    job = Job(input_files=input_files)
-                    job.output_dir = self.output_dir
-                    self.dependency_jobs(job)
-                    selected_input_files = input_files
-                except Exception as e:
-                    log.debug("Caught Exception for candidate input file: " +  ", ".join(input_files))
-                    log.debug(e.message)
-
-        if selected_input_files:
-            log.debug("selected_input_files: " + ", ".join(input_files) + "\n")
-            return selected_input_files
-        else:
-            raise Exception("Error: missing candidate input files: " + str(candidate_input_files) +
-                " neither found in dependencies nor on file system!")
+                # Candidate input files are valid if all of them are produced by previous jobs or found on file system
+                missing_input_files = [input_file for input_file in input_files if not self.is_job_output_file(input_file) and not self.file_exists(input_file)]
+                if missing_input_files:
+                    log.debug("Missing candidate input files: " + ", ".join(missing_input_files))
+                else:
+                    log.debug("selected_input_files: " + ", ".join(input_files) + "\n")
+                    return input_files
+
+        raise Exception("Error: missing candidate input files: " + str(candidate_input_files) +
+            " neither found in dependencies nor on file system!")
+
+    # Return True if file is an output file of a job already created in the step range
+    def is_job_output_file(self, file):
+        for step in self.step_range:
+            if file in step.output_file_index:
+                return True
+        return False
+
+    # Return True if file exists on file system, file path being relative to the pipeline output directory if not absolute
+    def file_exists(self, file):
+        # Use 'exists' instead of 'isfile' since input file can be a directory
+        return stat_cache.exists(os.path.normpath(os.path.join(self.output_dir, os.path.expandvars(file))))
 
     def dependency_jobs(self, current_job):
         dependency_jobs = []
         dependency_input_files = set()
+        current_job_input_files = set(current_job.input_files)
         for step in self.step_range:
-            for step_job in step.jobs:
-                # If current job input files intersect with step job output files, step job is a dependency
-                shared_files = set(current_job.input_files).intersection(set(step_job.output_files))
-                if shared_files:
-                    dependency_jobs.append(step_job)
-                    dependency_input_files.update(shared_files)
+            # If current job input files are found in step output file index, producer jobs are dependencies
+            shared_files = [input_file for input_file in current_job_input_files if input_file in step.output_file_index]
+            if shared_files:
+                dependency_jobs.extend(step.producer_jobs(shared_files))
+                dependency_input_files.update(shared_files)
 
         # Check if job input files not found in dependencies are on file system
         missing_input_files = set()
         # Add current_job.output_files in case of "... && ..." command
         # where first command output becomes second command input
-        for remaining_input_file in set(current_job.input_files).difference(dependency_input_files).difference(set(current_job.output_files)):
+        for remaining_input_file in current_job_input_files.difference(dependency_input_files).difference(set(current_job.output_files)):
             # Use 'exists' instead of 'isfile' since input file can be a directory
-            if not os.path.exists(current_job.abspath(remaining_input_file)):
+            if not stat_cache.exists(current_job.abspath(remaining_input_file)) and current_job.abspath(remaining_input_file) not in getattr(self, "_unwritten_plan_files", set()):
+                # A file removed early is only expected to be missing for its holder jobs, which completed before its removal
+                removal_marker = early_removal.removal_marker(current_job.abspath(remaining_input_file), self.output_dir) if config.param('DEFAULT', 'early_removal', required=False, type='boolean') else None
+                if removal_marker:
+                    if early_removal.is_removed_after(current_job, current_job.abspath(remaining_input_file)):
+                        continue
+                    raise Exception("Error: input file " + remaining_input_file + " of job " + current_job.name + " was removed early once its reading jobs completed: remove " +
+                        removal_marker + " to create it again!")
                 missing_input_files.add(remaining_input_file)
         if missing_input_files:
             raise Exception("Error: missing input files for job " + current_job.name + ": " +
@@ -256,31 +323,189 @@ Steps:
 
         return dependency_jobs
 
+    @property
+    def plan_profiler(self):
+        if not hasattr(self, "_plan_profiler"):
+            self._plan_profiler = PlanProfiler(enabled=bool(self.args.profile_plan), cprofile_file=self.args.profile_plan if isinstance(self.args.profile_plan, str) else None)
+        return self._plan_profiler
+
     def create_jobs(self):
+        profiler = self.plan_profiler
+        plan_cache = PlanCache(os.path.join(self.output_dir, "job_output", self.__class__.__name__ + ".plan_cache"), self.plan_cache_key()) if self.args.plan_cache else None
+        step_plans = plan_cache.load() if plan_cache else {}
+        created_step_names = []
+        file_system_probes.clear()
+
         for step in self.step_range:
+            profiler.start_step(step)
+            start_param_lookups, start_param_cache_hits = config.param_lookups, config.param_cache_hits
             log.info("Create jobs for step " + step.name + "...")
-            jobs = step.create_jobs()
-            for job in jobs:
-                # Job name is mandatory to create job .done file name
-                if not job.name:
-                    raise Exception("Error: job \"" + job.command + "\" has no name!")
+            if step.name in step_plans and self.is_valid_input_selection(step_plans[step.name][1]) and is_valid_file_system_probes(step_plans[step.name][3]):
+                jobs = step_plans[step.name][0]
+                # Files written by the step when creating its jobs may have been modified or removed since
+                for file, content in step_plans[step.name][2]:
+                    self.write_plan_file(file, content)
+                log.info("Step " + step.name + ": jobs reused from plan cache")
+            else:
+                self._input_selections = []
+                self._plan_files = []
+                # Record the file system state read by the step only if jobs are cached
+                if plan_cache:
+                    file_system_probes.start()
+                try:
+                    jobs = profiler.call(step, "create_jobs", step.create_jobs)
+                finally:
+                    if plan_cache:
+                        file_system_probes.stop()
+                created_step_names.append(step.name)
+                for job in jobs:
+                    # Job name is mandatory to create job .done file name
+                    if not job.name:
+                        raise Exception("Error: job \"" + job.command + "\" has no name!")
+
+                    # Job .done file name contains the command checksum.
+                    # Thus, if the command is modified, the job is not up-to-date anymore.
+                    job.done = os.path.join("job_output", step.name, job.name + "." + hashlib.md5(job.command_with_modules).hexdigest() + ".mugqic.done")
+                    job.output_dir = self.output_dir
 
+                # Step jobs are not modified in place anymore once created
+                if config.param('DEFAULT', 'compact_jobs', required=False, type='boolean'):
+                    jobs = [CompactJob(job) for job in jobs]
+                # Probes are still recorded by the next created steps until the cache is saved
+                step_plans[step.name] = (jobs, self._input_selections, self._plan_files, file_system_probes.probes)
+                self._input_selections = None
+                self._plan_files = None
+
+            # Retrieve file metadata of all step jobs in bulk, before checking dependencies and up-to-date status
+            profiler.call(step, "prefetch_file_stats", self.prefetch_file_stats, jobs)
+
+            for job in jobs:
                 log.debug("Job name: " + job.name)
                 log.debug("Job input files:\n  " + "\n  ".join(job.input_files))
                 log.debug("Job output files:\n  " + "\n  ".join(job.output_files) + "\n")
 
-                # Job .done file name contains the command checksum.
-                # Thus, if the command is modified, the job is not up-to-date anymore.
-                job.done = os.path.join("job_output", step.name, job.name + "." + hashlib.md5(job.command_with_modules).hexdigest() + ".mugqic.done")
-                job.output_dir = self.output_dir
-                job.dependency_jobs = self.dependency_jobs(job)
-                if not self.force_jobs and job.is_up2date():
+                job.dependency_jobs = profiler.call(step, "dependency_jobs", self.dependency_jobs, job)
+                if not self.force_jobs and profiler.call(step, "is_up2date", job.is_up2date):
                     log.info("Job " + job.name + " up to date... skipping")
                 else:
                     step.add_job(job)
             log.info("Step " + step.name + ": " + str(len(step.jobs)) + " job" + ("s" if len(step.jobs) > 1 else "") + " created" + ("" if step.jobs else "... skipping") + "\n")
+            stat_cache.log_counters("Step " + step.name + ": ")
+            log.debug("Step " + step.name + ": Config parameter lookups: " + str(config.param_lookups - start_param_lookups) + ", " + str(config.param_cache_hits - start_param_cache_hits) + " served from cache")
+            profiler.end_step(step)
         log.info("TOTAL: " + str(len(self.jobs)) + " job" + ("s" if len(self.jobs) > 1 else "") + " created" + ("" if self.jobs else "... skipping") + "\n")
 
+        # Save created jobs before they are modified by later planning passes
+        if plan_cache and created_step_names:
+            plan_cache.save(step_plans)
+
+    # Plan cache key: checksum of the pipeline class and version, output directory, config trace values,
+    # pipeline arguments used to create jobs including the modification time, and content if opened, of file arguments e.g. readset or design files,
+    # and modification times of the pipeline source files
+    def plan_cache_key(self):
+        checksum = hashlib.md5()
+        checksum.update(self.__class__.__name__ + "\n" + self.version + "\n" + self.output_dir + "\n")
+
+        # Skip config trace comments containing its creation time
+        with open(config.filepath) as config_trace:
+            checksum.update("".join([line for line in config_trace if not line.startswith("#")]))
+
+        # Arguments which do not modify the jobs created by steps
+        ignored_args = ["help", "config", "steps", "output_dir", "job_scheduler", "force", "report", "clean", "plan_cache", "profile_plan", "log"]
+        for name, value in sorted(vars(self.args).items()):
+            if name not in ignored_args:
+                checksum.update(name + "=")
+                for arg_value in value if isinstance(value, list) else [value]:
+                    if isinstance(arg_value, file):
+                        with open(arg_value.name) as arg_file:
+                            checksum.update(arg_value.name + " " + str(os.path.getmtime(arg_value.name)) + "\n" + arg_file.read())
+                    # File path arguments e.g. Illumina run processing readset and sample sheet files
+                    elif isinstance(arg_value, basestring) and os.path.isfile(arg_value):
+                        checksum.update(arg_value + " " + str(os.path.getmtime(arg_value)) + "\n")
+                    else:
+                        checksum.update(str(arg_value) + "\n")
+
+        # Modules may be loaded from compiled files, which are not rewritten if their directory is not writable: check source files instead
+        pipelines_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        source_files = set([re.sub("\.py[co]$", ".py", os.path.abspath(module.__file__)) for module in sys.modules.values() if getattr(module, "__file__", None)])
+        for source_file in sorted(source_files):
+            if source_file.startswith(pipelines_dir + os.sep) and os.path.exists(source_file):
+                checksum.update(source_file + " " + str(os.path.getmtime(source_file)) + "\n")
+
+        return checksum.hexdigest()
+
+    # Return True if input file selections made while creating cached step jobs are still the same,
+    # given the jobs created by previous steps and the file system
+    def is_valid_input_selection(self, input_selections):
+        for candidate_input_files, selected_input_files in input_selections:
+            try:
+                if self.find_input_files(candidate_input_files) != selected_input_files:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    # Probe in parallel the file system metadata needed by job dependency and up-to-date checks.
+    # Input files produced by previous jobs are not probed: their consumer jobs have dependencies, hence are not up to date.
+    # Otherwise, unless jobs are forced, .done and output files are probed as well as input files.
+    # With checksum up-to-date check, file fingerprints of completed jobs are then computed in parallel as well.
+    def prefetch_file_stats(self, jobs):
+        nb_threads = config.param('DEFAULT', 'stat_cache_threads', required=False, type='posint') or default_nb_threads
+        files = set()
+        up2date_candidate_jobs = []
+        for job in jobs:
+            remaining_input_files = [input_file for input_file in job.input_files if not self.is_job_output_file(input_file)]
+            files.update([job.abspath(input_file) for input_file in remaining_input_files])
+            if not self.force_jobs and len(remaining_input_files) == len(job.input_files):
+                up2date_candidate_jobs.append(job)
+                # Completion log is read in a single pass instead
+                if completion_store.type == "files":
+                    files.add(job.abspath(job.done))
+                files.update([job.abspath(output_file) for output_file in job.output_files])
+        stat_cache.prefetch(files, nb_threads)
+
+        if config.param('DEFAULT', 'up2date_check', required=False) == "checksum":
+            fingerprint_files = set()
+            known_records = {}
+            for job in up2date_candidate_jobs:
+                abspath_done = job.abspath(job.done)
+                if completion_store.is_done(abspath_done):
+                    fingerprint_files.update([job.abspath(file) for file in job.input_files + job.output_files])
+                    manifest = fingerprint_cache.manifest(abspath_done, job.output_dir)
+                    if manifest:
+                        known_records.update(manifest["input_files"])
+                        known_records.update(manifest["output_files"])
+            fingerprint_cache.prefetch(fingerprint_files, known_records, nb_threads)
+
+    # Remove removable files as soon as the jobs reading them have completed if '[DEFAULT] early_removal' is set.
+    # Fused jobs keep the removal commands of their member jobs.
+    # Jobs of steps outside the step range may read removable files too: early removal is only safe if the step range
+    # includes all steps from its first one to the last pipeline one.
+    def plan_early_removal(self):
+        if config.param('DEFAULT', 'early_removal', required=False, type='boolean'):
+            first_step_index = min([self.step_list.index(step) for step in self.step_range])
+            missing_steps = [step for step in self.step_list[first_step_index:] if step not in self.step_range]
+            if missing_steps:
+                log.warning("Early removal disabled: " + str(len(missing_steps)) + " following step" + ("s" if len(missing_steps) > 1 else "") + " outside the step range, from step " + str(self.step_list.index(missing_steps[0]) + 1) + " " + missing_steps[0].name + ", may read removable files\n")
+            else:
+                early_removal.plan(self.jobs, self.output_dir)
+
+    # Fuse short jobs into packed jobs if '[job_fusion] max_runtime' is set
+    def fuse_short_jobs(self):
+        max_runtime = config.param(job_fusion_section, 'max_runtime', required=False)
+        if max_runtime:
+            fuse_jobs(self.step_range, parse_duration(max_runtime), self.output_dir)
+
+    # Remove redundant job dependencies, implied by other dependencies, if '[DEFAULT] transitive_reduction' is set
+    def reduce_job_dependencies(self):
+        if config.param('DEFAULT', 'transitive_reduction', required=False, type='boolean'):
+            reduce_dependencies(self.jobs)
+
+    # Set job priorities from their critical path in the job dependency graph if '[DEFAULT] critical_path_priority' is set
+    def prioritize_jobs(self):
+        if config.param('DEFAULT', 'critical_path_priority', required=False, type='boolean'):
+            prioritize_critical_paths(self.jobs)
+
     def submit_jobs(self):
         self.scheduler.submit(self)
 
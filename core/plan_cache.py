@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import __builtin__
+import cPickle
+import logging
+import os
+import stat
+import time
+
+# MUGQIC Modules
+from stat_cache import *
+
+log = logging.getLogger(__name__)
+
+# On-disk cache of the jobs created by each pipeline step, before dependency and up-to-date checks.
+# Cached step plans are {step_name: (jobs, input_selections, plan_files, file_system_probes)} where input_selections is the list of
+# (candidate_input_files, selected_input_files) of all Pipeline.select_input_files calls made while creating step jobs,
+# plan_files the list of (file, content) of all Pipeline.write_plan_file calls
+# and file_system_probes the file system state read directly by the step, as recorded by FileSystemProbes.
+# The cache file contains the cache key followed by the step plans, which are only unpickled if the key matches.
+class PlanCache:
+
+    def __init__(self, path, key):
+        self._path = path
+        self._key = key
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def key(self):
+        return self._key
+
+    # Return cached step plans, or an empty dict if the cache file is missing, invalid or has a different key
+    def load(self):
+        start = time.time()
+        try:
+            with open(self.path, 'rb') as cache_file:
+                if cPickle.load(cache_file) != self.key:
+                    log.info("Plan cache " + self.path + " is out of date")
+                    return {}
+                step_plans = cPickle.load(cache_file)
+        except IOError:
+            return {}
+        except Exception as e:
+            log.warning("Plan cache " + self.path + " could not be read: " + str(e))
+            return {}
+
+        log.info("Plan cache " + self.path + " loaded in " + "%.2f" % (time.time() - start) + " s: " + str(len(step_plans)) + " step" + ("s" if len(step_plans) > 1 else ""))
+        return step_plans
+
+    def save(self, step_plans):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            # Write a temporary file renamed at the end, to never leave a partial cache file
+            tmp_path = self.path + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_path, 'wb') as cache_file:
+                cPickle.dump(self.key, cache_file, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(step_plans, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning("Plan cache " + self.path + " could not be written: " + str(e))
+
+# Return the recorded state of a path given its stat or lstat result: file type only for a directory,
+# since its modification time changes whenever a file is created in it, otherwise file type, size and modification time
+def probed_stat(path_stat):
+    if stat.S_ISDIR(path_stat.st_mode):
+        return (stat.S_IFDIR,)
+    else:
+        return (stat.S_IFMT(path_stat.st_mode), path_stat.st_size, path_stat.st_mtime)
+
+# Recorder of the file system state read directly by a step while it creates its jobs, e.g. 'os.path.exists' or 'glob.glob' calls
+# outside Pipeline.select_input_files, or files opened for reading, so that cached step jobs are only reused if this state did not change.
+# Probes are {(kind, absolute path): state} where kind is "stat", "lstat" or "listdir" and state is None if the path did not exist.
+# 'os.path' functions all call 'os.stat' or 'os.lstat', and 'glob' calls 'os.listdir', hence only these functions and 'open' are recorded.
+# The first state read of each path is kept. Probes are shared by all steps creating their jobs in a pipeline run,
+# since a step may use data read and memoized by a previous step, e.g. reference tables.
+class FileSystemProbes:
+
+    def __init__(self):
+        self._probes = {}
+        self._recording = False
+        self._functions = {}
+        self._paused = 0
+
+    @property
+    def probes(self):
+        return self._probes
+
+    def clear(self):
+        self._probes = {}
+
+    def _record(self, kind, path, state):
+        if self._recording and not self._paused:
+            self._probes.setdefault((kind, os.path.abspath(path)), state)
+
+    def _recorded_stat(self, kind, function):
+        def recorded_function(path, *args, **kwargs):
+            try:
+                path_stat = function(path, *args, **kwargs)
+            except OSError:
+                self._record(kind, path, None)
+                raise
+            self._record(kind, path, probed_stat(path_stat))
+            return path_stat
+        return recorded_function
+
+    def _recorded_listdir(self, function):
+        def recorded_function(path):
+            try:
+                names = function(path)
+            except OSError:
+                self._record("listdir", path, None)
+                raise
+            self._record("listdir", path, tuple(sorted(names)))
+            return names
+        return recorded_function
+
+    # Files opened for writing are not read, hence not recorded
+    def _recorded_open(self, function):
+        def recorded_function(name, mode="r", *args, **kwargs):
+            if isinstance(name, basestring) and not [flag for flag in "wa+" if flag in mode]:
+                try:
+                    self._record("stat", name, probed_stat(self._functions["stat"](name)))
+                except OSError:
+                    self._record("stat", name, None)
+            return function(name, mode, *args, **kwargs)
+        return recorded_function
+
+    # Start recording probes, wrapping file system functions until stop is called
+    def start(self):
+        self._recording = True
+        self._paused = 0
+        self._functions = {"stat": os.stat, "lstat": os.lstat, "listdir": os.listdir, "open": __builtin__.open}
+        os.stat = self._recorded_stat("stat", self._functions["stat"])
+        os.lstat = self._recorded_stat("lstat", self._functions["lstat"])
+        os.listdir = self._recorded_listdir(self._functions["listdir"])
+        __builtin__.open = self._recorded_open(self._functions["open"])
+
+    # Stop recording probes, restoring file system functions
+    def stop(self):
+        os.stat = self._functions["stat"]
+        os.lstat = self._functions["lstat"]
+        os.listdir = self._functions["listdir"]
+        __builtin__.open = self._functions["open"]
+        self._functions = {}
+        self._recording = False
+
+    # Files written while creating jobs, e.g. plan files, are not recorded
+    def pause(self):
+        self._paused += 1
+
+    def resume(self):
+        self._paused -= 1
+
+# Return True if the file system state of all probes is the same as recorded
+def is_valid_file_system_probes(probes):
+    stat_cache.prefetch([path for kind, path in probes if kind != "listdir"])
+    for (kind, path), state in probes.items():
+        if kind == "listdir":
+            try:
+                current_state = tuple(sorted(os.listdir(path)))
+            except OSError:
+                current_state = None
+        else:
+            path_stat = stat_cache.stat(path) if kind == "stat" else stat_cache.lstat(path)
+            current_state = probed_stat(path_stat) if path_stat else None
+        if current_state != state:
+            log.debug("File system probe changed: " + kind + " " + path)
+            return False
+    return True
+
+# Global file system probe recorder used while steps create their jobs
+file_system_probes = FileSystemProbes()
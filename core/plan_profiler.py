@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import cProfile
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# MUGQIC Modules
+from config import *
+
+log = logging.getLogger(__name__)
+
+# Timed phases of each step while jobs are created, in summary table column order
+plan_profiler_phases = ["create_jobs", "prefetch_file_stats", "dependency_jobs", "is_up2date"]
+
+# File system calls counted while profiling: os.path.exists, isfile, isdir, getmtime, getsize etc. all call os.stat
+plan_profiler_fs_functions = ["stat", "lstat", "listdir", "access"]
+
+# Profile of pipeline planning by step: time spent in each phase, number of file system calls and config parameter lookups.
+# When disabled, phase functions are called directly without any measurement.
+class PlanProfiler:
+
+    def __init__(self, enabled=False, cprofile_file=None):
+        self._enabled = enabled
+        self._cprofile_file = cprofile_file
+        self._cprofile = None
+        self._step_names = []
+        self._phase_times = collections.defaultdict(float)
+        self._step_counters = {}
+        self._step_start = None
+        self._fs_calls = 0
+        self._fs_lock = threading.Lock()
+        self._fs_functions = {}
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    # File system calls may be made concurrently by the stat cache threads
+    def _count_fs_call(self, function):
+        def counted_function(*args, **kwargs):
+            with self._fs_lock:
+                self._fs_calls += 1
+            return function(*args, **kwargs)
+        return counted_function
+
+    def start(self):
+        if self.enabled:
+            for name in plan_profiler_fs_functions:
+                self._fs_functions[name] = getattr(os, name)
+                setattr(os, name, self._count_fs_call(self._fs_functions[name]))
+            if self._cprofile_file:
+                self._cprofile = cProfile.Profile()
+                self._cprofile.enable()
+
+    # File system functions are restored first, whatever happens next
+    def stop(self):
+        if self.enabled:
+            for name in self._fs_functions:
+                setattr(os, name, self._fs_functions[name])
+            self._fs_functions = {}
+            if self._cprofile:
+                self._cprofile.disable()
+                self._cprofile.dump_stats(self._cprofile_file)
+                log.info("Planning cProfile statistics written in " + self._cprofile_file)
+                self._cprofile = None
+
+    def _counters(self):
+        return (time.time(), self._fs_calls, config.param_lookups, config.param_cache_hits)
+
+    def start_step(self, step):
+        if self.enabled:
+            self._step_names.append(step.name)
+            self._step_start = self._counters()
+
+    # Record step total time, file system calls, config lookups and config lookups served from cache
+    def end_step(self, step):
+        if self.enabled:
+            self._step_counters[step.name] = [end - start for start, end in zip(self._step_start, self._counters())]
+
+    # Call function with the given arguments and add its elapsed time to the step phase
+    def call(self, step, phase, function, *args):
+        if self.enabled:
+            start = time.time()
+            result = function(*args)
+            self._phase_times[(step.name, phase)] += time.time() - start
+            return result
+        else:
+            return function(*args)
+
+    # Write the summary table of steps sorted by decreasing time on stderr, since stdout receives the job script
+    def write_summary(self, steps, output=sys.stderr):
+        if self.enabled:
+            nb_jobs = dict([(step.name, len(step.jobs)) for step in steps])
+            header = ["#step"] + [phase + "_s" for phase in plan_profiler_phases] + ["total_s", "jobs", "fs_calls", "config_lookups", "config_cache_hits"]
+            rows = []
+            for step_name in sorted(self._step_names, key=lambda step_name: self._step_counters[step_name][0], reverse=True):
+                [total_time, fs_calls, config_lookups, config_cache_hits] = self._step_counters[step_name]
+                rows.append([step_name] + ["%.3f" % self._phase_times[(step_name, phase)] for phase in plan_profiler_phases] + ["%.3f" % total_time, str(nb_jobs.get(step_name, 0)), str(fs_calls), str(config_lookups), str(config_cache_hits)])
+            rows.append(["TOTAL"] + ["%.3f" % sum([self._phase_times[(step_name, phase)] for step_name in self._step_names]) for phase in plan_profiler_phases] + ["%.3f" % sum([self._step_counters[step_name][0] for step_name in self._step_names])] + [str(sum([int(row[index]) for row in rows])) for index in range(len(header) - 4, len(header))])
+
+            widths = [max([len(row[index]) for row in [header] + rows]) for index in range(len(header))]
+            output.write("Planning profile:\n")
+            for row in [header] + rows:
+                output.write("  ".join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]) + "\n")
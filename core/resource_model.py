@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import logging
+import math
+import re
+import stat
+
+# MUGQIC Modules
+from config import *
+from stat_cache import *
+
+log = logging.getLogger(__name__)
+
+# Job resources which can be sized from job input size, with their config parameter fitted coefficients
+# "resource_model_<resource>=<intercept>,<slope per GB of input files>":
+# walltime in seconds and Java heap size in MB.
+# The number of cores is not sized since job commands set their own number of threads from config.
+resource_model_resources = ["walltime", "java_heap"]
+
+# Default memory in MB used by a Java virtual machine beyond its heap, added to the sized heap to request job memory
+default_java_overhead = 1024
+
+# Return a section resource model coefficients (intercept, slope per GB) or None if undefined
+def resource_model_coefficients(section, resource):
+    coefficients = config.param(section, 'resource_model_' + resource, required=False, type='list')
+    if not coefficients:
+        return None
+    elif len(coefficients) == 2:
+        return [float(coefficient) for coefficient in coefficients]
+    else:
+        raise Exception("Error: parameter \"[" + section + "] resource_model_" + resource + "\" value \"" + ",".join(coefficients) + "\" is invalid (should be <intercept>,<slope per GB>)!")
+
+# Return the estimated total size in bytes of each job input files, in a dict by job.
+# Jobs must be given in submission order. Input files found on file system count for their size,
+# while input files not produced yet are estimated by the input size of their producer job, counted once per producer job.
+def input_sizes(jobs):
+    producer_jobs = {}
+    input_sizes = {}
+    for job in jobs:
+        input_size = 0
+        job_producers = set()
+        for input_file in job.input_files:
+            if input_file in producer_jobs:
+                job_producers.add(producer_jobs[input_file])
+            else:
+                input_stat = stat_cache.stat(job.abspath(input_file))
+                if input_stat and stat.S_ISREG(input_stat.st_mode):
+                    input_size += input_stat.st_size
+        input_sizes[job] = input_size + sum([input_sizes[producer_job] for producer_job in job_producers])
+        for output_file in job.output_files:
+            producer_jobs[output_file] = job
+    return input_sizes
+
+# Return the job command with the Java heap size of the config section tool set to heap MB, or None if not found.
+# Only the tool invocation using the section 'ram' value as -Xmx is modified, not the other tools of concatenated or piped commands.
+def sized_java_heap_command(job, section, heap):
+    ram = config.param(section, 'ram', required=False)
+    xmx_pattern = "-Xmx" + re.escape(ram) + "(?![\\w.])" if ram else None
+    if not ram or len(re.findall(xmx_pattern, job.command)) != 1:
+        log.warning("Job " + job.name + ": Java heap size not sized since the command has not exactly one -Xmx option with [" + section + "] ram value")
+        return None
+    return re.sub(xmx_pattern, "-Xmx" + str(heap) + "M", job.command)
+
+# Set job walltime, Java heap size and memory from the estimated size of job input files,
+# for config sections defining resource model coefficients. Otherwise, static config values are used.
+# Job memory is the Java heap size plus '[<section>] resource_model_java_overhead' MB (default: 1024),
+# which raises the cluster memory request of the job if lower.
+# Job .done file names are not modified: resized jobs which are up to date are still skipped.
+def size_job_resources(jobs):
+    nb_sized_jobs = 0
+    job_input_sizes = input_sizes(jobs)
+    for job in jobs:
+        input_size = job_input_sizes[job]
+        # Config section must match job name prefix before first "."
+        section = job.name.split(".")[0]
+        input_size_gb = float(input_size) / 1024 ** 3
+        if input_size:
+            resource_values = {}
+            for resource in resource_model_resources:
+                coefficients = resource_model_coefficients(section, resource)
+                if coefficients:
+                    resource_values[resource] = int(math.ceil(coefficients[0] + coefficients[1] * input_size_gb))
+
+            if resource_values.get("walltime", 0) > 0:
+                job.walltime = resource_values["walltime"]
+            if resource_values.get("java_heap", 0) > 0:
+                command = sized_java_heap_command(job, section, resource_values["java_heap"])
+                if command:
+                    job.command = command
+                    job.memory = resource_values["java_heap"] + (config.param(section, 'resource_model_java_overhead', required=False, type='int') or default_java_overhead)
+                else:
+                    del resource_values["java_heap"]
+
+            if resource_values:
+                nb_sized_jobs += 1
+                log.debug("Job " + job.name + " input size: " + "%.2f" % input_size_gb + " GB, resources: " + ", ".join([resource + "=" + str(resource_values[resource]) for resource in resource_model_resources if resource in resource_values]))
+
+    if nb_sized_jobs:
+        log.info("Resource model: " + str(nb_sized_jobs) + " job" + ("s" if nb_sized_jobs > 1 else "") + " sized from input size\n")
@@ -20,22 +20,96 @@
 ################################################################################
 
 # Python Standard Modules
+import Queue
+import bisect
+import collections
+import datetime
 import json
+import logging
+import math
+import multiprocessing
 import os
+import re
+import signal
+import subprocess
+import threading
 
 # MUGQIC Modules
+from completion_store import *
 from config import *
+from dag import *
+from early_removal import *
+from fingerprint import *
+
+log = logging.getLogger(__name__)
 
 # Output comment separator line
 separator_line = "#" + "-" * 79
 
+# Job resource usage report, run after the job command given $MUGQIC_STATE exit status, $MUGQIC_START epoch time and $MUGQIC_INPUT_SIZE:
+# Python replaces the job shell to retrieve the resource usage of all job processes i.e. the shell children,
+# prints job wallclock time, CPU time, peak RSS in KB and total size of job input files, then exits with the job exit status
+job_resource_usage_script = """\
+command -v python > /dev/null && exec python -c '
+import resource, sys, time
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+print("MUGQICresources:wallclock=%d cputime=%.2f maxrss=%d inputsize=%d" % (time.time() - int(sys.argv[2]), usage.ru_utime + usage.ru_stime, usage.ru_maxrss, int(sys.argv[3])))
+sys.exit(int(sys.argv[1]))' $MUGQIC_STATE $MUGQIC_START $MUGQIC_INPUT_SIZE"""
+
+# Return config cluster walltime option of jobs section, with the longest job walltime set by the resource model if any
+def cluster_walltime(job_name_prefix, jobs):
+    cluster_walltime = config.param(job_name_prefix, 'cluster_walltime')
+    walltimes = [job.walltime for job in jobs if job.walltime]
+    if walltimes:
+        walltime = "walltime=" + format_duration(max(walltimes))
+        if re.search("walltime=[\d:-]+", cluster_walltime):
+            cluster_walltime = re.sub("walltime=[\d:-]+", walltime, cluster_walltime)
+        else:
+            cluster_walltime += " -l " + walltime
+    return cluster_walltime
+
+# Return config cluster cpu option of jobs section, with its memory request raised to the largest job memory set by the resource model if any.
+# Memory per core (pmem or --mem-per-cpu) is raised to the job memory divided by the number of cores, total memory (mem or --mem) to the job memory,
+# otherwise a total memory request is added. Config memory requests are never lowered.
+def cluster_cpu(job_name_prefix, jobs):
+    cluster_cpu = config.param(job_name_prefix, 'cluster_cpu')
+    memories = [job.memory for job in jobs if job.memory]
+    if memories:
+        memory = max(memories)
+        cpu_match = re.search("(?:ppn=|--cpus-per-task=)(\d+)", cluster_cpu)
+        nb_cpus = int(cpu_match.group(1)) if cpu_match else 1
+
+        # Replace a memory size in MB if it is larger, keeping PBS or SLURM unit style
+        def raised_memory(match, memory):
+            if memory * 1024 ** 2 > parse_memory_size(match.group(2)):
+                return match.group(1) + str(memory) + ("M" if match.group(1).startswith("--") else "m")
+            else:
+                return match.group(0)
+
+        if re.search("(?:pmem=|--mem-per-cpu=)\d", cluster_cpu):
+            cluster_cpu = re.sub("(pmem=|--mem-per-cpu=)(\d+[a-zA-Z]*)", lambda match: raised_memory(match, int(math.ceil(float(memory) / nb_cpus))), cluster_cpu)
+        elif re.search("\\bmem=\d", cluster_cpu):
+            cluster_cpu = re.sub("(--mem=|\\bmem=)(\d+[a-zA-Z]*)", lambda match: raised_memory(match, memory), cluster_cpu)
+        else:
+            cluster_cpu += " -l mem=" + str(memory) + "m"
+    return cluster_cpu
+
+# Return the command setting $MUGQIC_INPUT_SIZE to the total size of job input files when the job starts,
+# since early removal may remove them before the job resource usage report
+def job_input_size_cmd(job):
+    return "MUGQIC_INPUT_SIZE=0 ; for MUGQIC_INPUT_FILE in " + " ".join(job.input_files) + " ; do if [ -f $MUGQIC_INPUT_FILE ] ; then MUGQIC_INPUT_SIZE=$((MUGQIC_INPUT_SIZE + $(wc -c < $MUGQIC_INPUT_FILE))) ; fi ; done"
+
 def create_scheduler(type):
     if type == "pbs":
         return PBSScheduler()
+    elif type == "slurm":
+        return SlurmScheduler()
     elif type == "batch":
         return BatchScheduler()
     elif type == "daemon":
         return DaemonScheduler()
+    elif type == "local":
+        return LocalScheduler()
     else:
         raise Exception("Error: scheduler type \"" + type + "\" is invalid!")
 
@@ -81,6 +155,28 @@ cd $OUTPUT_DIR
                 )
             )
 
+    # Job script run by the scheduler: remove job completion, run job command, print its exit status, record job completion on success
+    # and print job resource usage
+    def job_script(self, job):
+        return """\
+MUGQIC_START=$(date +%s)
+{input_size_cmd}
+{remove_done_cmd}{early_removal_start_cmd} && {job.command_with_modules}
+MUGQIC_STATE=$PIPESTATUS
+echo MUGQICexitStatus:$MUGQIC_STATE
+if [ $MUGQIC_STATE -eq 0 ] ; then {create_done_cmd}{write_manifest_cmd}{early_removal_end_cmd} ; fi
+{resource_usage_script}
+exit $MUGQIC_STATE""".format(
+            job=job,
+            remove_done_cmd=completion_store.remove_done_cmd(job.done, job.output_dir),
+            create_done_cmd=completion_store.create_done_cmd(job.done, job.output_dir),
+            write_manifest_cmd=write_manifest_cmd(job),
+            early_removal_start_cmd=early_removal.job_start_cmd(job),
+            early_removal_end_cmd=early_removal.job_end_cmd(job),
+            input_size_cmd=job_input_size_cmd(job),
+            resource_usage_script=job_resource_usage_script
+        )
+
     def print_step(self, step):
         print("""
 {separator_line}
@@ -92,23 +188,109 @@ mkdir -p $JOB_OUTPUT_DIR/$STEP
         )
 
 class PBSScheduler(Scheduler):
+    # Job array option and environment variable containing the array task index
+    array_arg = "-t"
+    array_task_id_variable = "PBS_ARRAYID"
+    # Lines prepended to the job script piped to the submission command
+    job_script_header = ""
+
     def submit(self, pipeline):
         self.print_header(pipeline)
         for step in pipeline.step_range:
             if step.jobs:
                 self.print_step(step)
-                for job in step.jobs:
-                    if job.dependency_jobs:
-                        # Chunk JOB_DEPENDENCIES on multiple lines to avoid lines too long
-                        max_dependencies_per_line = 50
-                        dependency_chunks = [job.dependency_jobs[i:i + max_dependencies_per_line] for i in range(0, len(job.dependency_jobs), max_dependencies_per_line)]
-                        job_dependencies = "JOB_DEPENDENCIES=" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunks[0]])
-                        for dependency_chunk in dependency_chunks[1:]:
-                            job_dependencies += "\nJOB_DEPENDENCIES=$JOB_DEPENDENCIES:" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunk])
+                for job_group in self.job_groups(step):
+                    if len(job_group) > 1:
+                        # Arrays split in chunks share the task table of their first chunk
+                        first_task_id = 1
+                        for job_array in self.job_arrays(job_group):
+                            self.print_job_array(job_array, first_task_id, shared_task_table=first_task_id > 1, array_task_offset=first_task_id - 1)
+                            first_task_id += len(job_array)
                     else:
-                        job_dependencies = "JOB_DEPENDENCIES="
+                        self.print_job(job_group[0])
 
-                    print("""
+        self.check_cluster_max_jobs(pipeline)
+
+    # Check cluster maximum job submission
+    def check_cluster_max_jobs(self, pipeline):
+        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
+        if cluster_max_jobs and len(pipeline.jobs) > cluster_max_jobs:
+            log.warning("Number of jobs: " + str(len(pipeline.jobs)) + " > Cluster maximum number of jobs: " + str(cluster_max_jobs) + "!")
+
+    # Return True if jobs of this config section can be grouped in job arrays
+    def is_job_array_section(self, job_name_prefix):
+        return config.param(job_name_prefix, 'cluster_job_array', required=False, type='boolean')
+
+    # Return step jobs grouped in submission order: jobs sharing the same config section are grouped in one job array
+    # if 'cluster_job_array' is set for this section, and if they do not depend on other jobs of the same step.
+    # Thus, all array task dependencies are submitted before the array and each array is submitted before its dependent jobs.
+    # Other jobs are submitted individually.
+    def job_groups(self, step):
+        job_groups = []
+        array_job_groups = {}
+        step_jobs = set(step.jobs)
+        for job in step.jobs:
+            # Cluster settings section must match job name prefix before first "."
+            job_name_prefix = job.name.split(".")[0]
+            if self.is_job_array_section(job_name_prefix) and not step_jobs.intersection(job.dependency_jobs):
+                if job_name_prefix in array_job_groups:
+                    array_job_groups[job_name_prefix].append(job)
+                else:
+                    array_job_groups[job_name_prefix] = [job]
+                    job_groups.append(array_job_groups[job_name_prefix])
+            else:
+                job_groups.append([job])
+
+        # Arrays of a single job are submitted individually
+        return job_groups
+
+    # Return a job group split in job arrays of supported size
+    def job_arrays(self, jobs):
+        return [jobs]
+
+    # Return JOB_DEPENDENCIES variable definition given dependency jobs
+    def job_dependencies(self, dependency_jobs):
+        if dependency_jobs:
+            # Chunk JOB_DEPENDENCIES on multiple lines to avoid lines too long
+            max_dependencies_per_line = 50
+            dependency_chunks = [dependency_jobs[i:i + max_dependencies_per_line] for i in range(0, len(dependency_jobs), max_dependencies_per_line)]
+            job_dependencies = "JOB_DEPENDENCIES=" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunks[0]])
+            for dependency_chunk in dependency_chunks[1:]:
+                job_dependencies += "\nJOB_DEPENDENCIES=$JOB_DEPENDENCIES:" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunk])
+        else:
+            job_dependencies = "JOB_DEPENDENCIES="
+        return job_dependencies
+
+    # Return cluster submission command with its arguments for job name prefix config section and submitted jobs
+    def cluster_submit_cmd(self, job_name_prefix, has_dependencies, jobs, is_array=False):
+        # Cluster settings section must match job name prefix before first "."
+        # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
+        cmd = \
+            config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
+            config.param(job_name_prefix, 'cluster_other_arg') + " " + \
+            config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
+            config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT " + \
+            config.param(job_name_prefix, 'cluster_job_name_arg') + " $JOB_NAME " + \
+            cluster_walltime(job_name_prefix, jobs) + " " + \
+            config.param(job_name_prefix, 'cluster_queue') + " " + \
+            cluster_cpu(job_name_prefix, jobs)
+        if has_dependencies:
+            cmd += " " + config.param(job_name_prefix, 'cluster_dependency_arg') + "$JOB_DEPENDENCIES"
+        return cmd
+
+    def cluster_submit_cmd_suffix(self, job_name_prefix):
+        return config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
+
+    # Return priority option given job priority between 0 (lowest) and 1 (highest), if any
+    def priority_arg(self, priority):
+        # PBS priority ranges from -1024 to 1023, 0 being the default: only raise priorities
+        return " -p " + str(int(round(priority * 1023))) if priority is not None else ""
+
+    def cluster_cmd_produces_job_id(self, job_name_prefix):
+        return config.param(job_name_prefix, 'cluster_cmd_produces_job_id')
+
+    def print_job(self, job):
+        print("""
 {separator_line}
 # JOB: {job.id}: {job.name}
 {separator_line}
@@ -121,51 +303,285 @@ COMMAND=$(cat << '{limit_string}'
 {job.command_with_modules}
 {limit_string}
 )""".format(
-                            job=job,
-                            job_dependencies=job_dependencies,
-                            separator_line=separator_line,
-                            limit_string=os.path.basename(job.done)
-                        )
-                    )
+                job=job,
+                job_dependencies=self.job_dependencies(job.dependency_jobs),
+                separator_line=separator_line,
+                limit_string=os.path.basename(job.done)
+            )
+        )
 
-                    cmd = """\
-echo "rm -f $JOB_DONE && $COMMAND
+        cmd = """\
+echo "{job_script_header}MUGQIC_START=\$(date +%s)
+{input_size_cmd}
+{remove_done_cmd}{early_removal_start_cmd} && $COMMAND
 MUGQIC_STATE=\$PIPESTATUS
 echo MUGQICexitStatus:\$MUGQIC_STATE
-if [ \$MUGQIC_STATE -eq 0 ] ; then touch $JOB_DONE ; fi
+if [ \$MUGQIC_STATE -eq 0 ] ; then {create_done_cmd}{write_manifest_cmd}{early_removal_end_cmd} ; fi
+{resource_usage_script}
 exit \$MUGQIC_STATE" | \\
-""".format(job=job)
-
-                    # Cluster settings section must match job name prefix before first "."
-                    # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
-                    job_name_prefix = job.name.split(".")[0]
-                    cmd += \
-                        config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
-                        config.param(job_name_prefix, 'cluster_other_arg') + " " + \
-                        config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
-                        config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT " + \
-                        config.param(job_name_prefix, 'cluster_job_name_arg') + " $JOB_NAME " + \
-                        config.param(job_name_prefix, 'cluster_walltime') + " " + \
-                        config.param(job_name_prefix, 'cluster_queue') + " " + \
-                        config.param(job_name_prefix, 'cluster_cpu')
-                    if job.dependency_jobs:
-                        cmd += " " + config.param(job_name_prefix, 'cluster_dependency_arg') + "$JOB_DEPENDENCIES"
-                    cmd += " " + config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
-
-                    if config.param(job_name_prefix, 'cluster_cmd_produces_job_id'):
-                        cmd = job.id + "=$(" + cmd + ")"
+""".format(
+            job=job,
+            job_script_header=self.job_script_header,
+            # JOB_DONE is expanded at submission
+            remove_done_cmd=completion_store.remove_done_cmd("$JOB_DONE", job.output_dir),
+            create_done_cmd=completion_store.create_done_cmd("$JOB_DONE", job.output_dir),
+            write_manifest_cmd=write_manifest_cmd(job).replace('$', '\\$'),
+            early_removal_start_cmd=early_removal.job_start_cmd(job),
+            early_removal_end_cmd=early_removal.job_end_cmd(job),
+            input_size_cmd=job_input_size_cmd(job).replace('$', '\\$'),
+            resource_usage_script=job_resource_usage_script.replace('"', '\\"').replace('$', '\\$')
+        )
+
+        job_name_prefix = job.name.split(".")[0]
+        cmd += self.cluster_submit_cmd(job_name_prefix, job.dependency_jobs, [job]) + self.priority_arg(job.priority) + " " + self.cluster_submit_cmd_suffix(job_name_prefix)
+
+        if self.cluster_cmd_produces_job_id(job_name_prefix):
+            cmd = job.id + "=$(" + cmd + ")"
+        else:
+            cmd += "\n" + job.id + "=" + job.name
+
+        # Write job parameters in job list file
+        cmd += "\necho \"$" + job.id + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST\n"
+
+        print cmd
+
+    # Submit jobs as one job array: each job script is written in a task directory and listed in a task table,
+    # from which each array task selects its job script given its array task index.
+    # Array dependencies are the union of all job dependencies.
+    # If 'shared_task_table' is True, JOB_TASK_DIR and JOB_TASK_TABLE are already defined for the whole step
+    # and task indexes start at 'first_task_id'.
+    # Array task indexes are task indexes minus 'array_task_offset', to keep them below the scheduler maximum array size.
+    def print_job_array(self, jobs, first_task_id=1, shared_task_table=False, array_task_offset=0):
+        job_name_prefix = jobs[0].name.split(".")[0]
+        dependency_jobs = list(collections.OrderedDict.fromkeys([dependency_job for job in jobs for dependency_job in job.dependency_jobs]))
+        task_ids = range(first_task_id, first_task_id + len(jobs))
+        array_task_ids = [task_id - array_task_offset for task_id in task_ids]
+
+        print("""
+{separator_line}
+# JOB ARRAY: {job_name_prefix}: {nb_jobs} job{plural}
+{separator_line}
+JOB_NAME={job_name_prefix}
+{job_dependencies}
+JOB_OUTPUT_RELATIVE_PATH=$STEP/${{JOB_NAME}}_$TIMESTAMP{array_offset_suffix}.o
+JOB_OUTPUT=$JOB_OUTPUT_DIR/$JOB_OUTPUT_RELATIVE_PATH{task_table}""".format(
+                job_name_prefix=job_name_prefix,
+                # Array task output files are suffixed by their array task index: arrays with an offset need their own output file prefix
+                array_offset_suffix="." + str(array_task_offset) if array_task_offset else "",
+                nb_jobs=len(jobs),
+                plural="s" if len(jobs) > 1 else "",
+                job_dependencies=self.job_dependencies(dependency_jobs),
+                separator_line=separator_line,
+                task_table="" if shared_task_table else """
+JOB_TASK_DIR=$JOB_OUTPUT_DIR/$STEP/${JOB_NAME}_$TIMESTAMP.tasks
+JOB_TASK_TABLE=$JOB_TASK_DIR/task_table.tsv
+mkdir -p $JOB_TASK_DIR
+rm -f $JOB_TASK_TABLE"""
+            )
+        )
+
+        for task_id, job in zip(task_ids, jobs):
+            print("""\
+cat > $JOB_TASK_DIR/{task_id}.sh << '{limit_string}'
+{job_script}
+{limit_string}
+printf "%s\\t%s\\t%s\\t%s\\n" {task_id} {job.name} {job.done} $JOB_TASK_DIR/{task_id}.sh >> $JOB_TASK_TABLE""".format(
+                    task_id=task_id,
+                    job=job,
+                    job_script=self.job_script(job),
+                    limit_string=os.path.basename(job.done)
+                )
+            )
+
+        cmd = """\
+echo "{job_script_header}bash \$(awk -F'\\t' -v task=\$((\${array_task_id_variable} + {array_task_offset})) '\$1 == task {{print \$4}}' $JOB_TASK_TABLE)" | \\
+""".format(job_script_header=self.job_script_header, array_task_id_variable=self.array_task_id_variable, array_task_offset=array_task_offset)
+        # Array priority is the highest priority of its jobs
+        priorities = [job.priority for job in jobs if job.priority is not None]
+        cmd += self.cluster_submit_cmd(job_name_prefix, dependency_jobs, jobs, is_array=True) + self.priority_arg(max(priorities) if priorities else None) + " " + self.array_range_arg(array_task_ids[0], array_task_ids[-1]) + " " + self.cluster_submit_cmd_suffix(job_name_prefix)
+
+        if self.cluster_cmd_produces_job_id(job_name_prefix):
+            cmd = "JOB_ARRAY_ID=$(" + cmd + ")"
+            for array_task_id, job in zip(array_task_ids, jobs):
+                cmd += "\n" + job.id + "=" + self.array_task_job_id("$JOB_ARRAY_ID", array_task_id)
+        else:
+            for job in jobs:
+                cmd += "\n" + job.id + "=" + job.name
+
+        # Write job parameters in job list file
+        for array_task_id, job in zip(array_task_ids, jobs):
+            cmd += "\necho \"$" + job.id + "\t" + job.name + "\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH-" + str(array_task_id) + "\" >> $JOB_LIST"
+
+        print cmd + "\n"
+
+    # Return array option for task index range e.g. "-t 1-10"
+    def array_range_arg(self, first_task_id, last_task_id):
+        return self.array_arg + " " + str(first_task_id) + "-" + str(last_task_id)
+
+    # Return array task job ID given array job ID variable e.g. "123[].server" -> "123[1].server"
+    def array_task_job_id(self, array_job_id, task_id):
+        return "${" + array_job_id.lstrip("$") + "/\\[\\]/[" + str(task_id) + "]}"
+
+# PBS memory size units and their SLURM equivalents
+slurm_memory_units = {"b": "", "kb": "K", "k": "K", "mb": "M", "m": "M", "gb": "G", "g": "G", "tb": "T", "t": "T"}
+slurm_mail_types = {"a": "FAIL", "b": "BEGIN", "e": "END", "n": "NONE"}
+# Nice value of lowest priority jobs
+slurm_max_nice = 10000
+# Default maximum number of jobs per array, below the default SLURM MaxArraySize
+slurm_max_array_size = 1000
+
+def slurm_memory_size(pbs_memory_size):
+    match = re.match(r"^(\d+)([a-zA-Z]*)$", pbs_memory_size)
+    if match and match.group(2).lower() in slurm_memory_units:
+        # SLURM default unit is megabytes: convert bytes to kilobytes
+        if match.group(2).lower() == "b":
+            return str(max(1, int(match.group(1)) / 1024)) + "K"
+        return match.group(1) + slurm_memory_units[match.group(2).lower()]
+    else:
+        raise Exception("Error: PBS memory size \"" + pbs_memory_size + "\" cannot be converted to SLURM!")
+
+# Translated options cache to translate and warn about each PBS option string only once
+_slurm_options = {}
+
+# Translate PBS submission options as found in 'cluster_*' config values into sbatch options,
+# e.g. "-l nodes=1:ppn=3 -l pmem=2700m" -> "--nodes=1 --cpus-per-task=3 --mem-per-cpu=2700M".
+# Options starting with "--" are considered SLURM native and kept unchanged,
+# options handled by the scheduler itself (work dir, output, job name, dependencies) or not supported by SLURM are dropped.
+def slurm_options(pbs_options):
+    if pbs_options in _slurm_options:
+        return _slurm_options[pbs_options]
+
+    options = []
+    tokens = pbs_options.split()
+    i = 0
+    while i < len(tokens):
+        option = tokens[i]
+        value = tokens[i + 1] if i + 1 < len(tokens) else ""
+        i += 2
+        if option == "-l":
+            for resource in value.split(","):
+                if resource.startswith("nodes="):
+                    for node_property in resource.split(":"):
+                        [name, sep, count] = node_property.partition("=")
+                        if name == "nodes":
+                            options.append("--nodes=" + count)
+                        elif name == "ppn":
+                            options.append("--cpus-per-task=" + count)
+                        elif name == "gpus":
+                            options.append("--gres=gpu:" + count)
+                        else:
+                            log.warning("PBS node property \"" + node_property + "\" is not supported by SLURM scheduler: ignored")
+                else:
+                    [name, sep, resource_value] = resource.partition("=")
+                    if name == "walltime":
+                        options.append("--time=" + resource_value)
+                    elif name == "pmem":
+                        options.append("--mem-per-cpu=" + slurm_memory_size(resource_value))
+                    elif name == "mem":
+                        options.append("--mem=" + slurm_memory_size(resource_value))
+                    elif name == "qos":
+                        options.append("--qos=" + resource_value)
                     else:
-                        cmd += "\n" + job.id + "=" + job.name
+                        log.warning("PBS resource \"" + resource + "\" is not supported by SLURM scheduler: ignored")
+        elif option == "-q":
+            options.append("--partition=" + value)
+        elif option == "-A":
+            options.append("--account=" + value)
+        elif option == "-M":
+            options.append("--mail-user=" + value)
+        elif option == "-m":
+            mail_types = [slurm_mail_types[mail_option] for mail_option in value if mail_option in slurm_mail_types]
+            if mail_types:
+                options.append("--mail-type=" + ",".join(mail_types))
+        elif option in ["-W", "-d", "-o", "-e", "-j", "-N"]:
+            # umask and group_list have no sbatch equivalent, other options are set by the scheduler
+            log.debug("PBS option \"" + option + " " + value + "\" is not used by SLURM scheduler: ignored")
+        else:
+            # SLURM native option: keep it unchanged
+            options.append(option)
+            i -= 1
 
-                    # Write job parameters in job list file
-                    cmd += "\necho \"$" + job.id + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST\n"
+    _slurm_options[pbs_options] = " ".join(options)
+    return _slurm_options[pbs_options]
 
-                    print cmd
+# SLURM scheduler: each job script is piped to 'sbatch --parsable' which prints the job ID,
+# PBS 'cluster_*' config values are translated into sbatch options.
+# If '[DEFAULT] slurm_bulk_submission' is set, all jobs of a step are written in one submission manifest
+# and submitted as one job array per config section, which minimizes the number of sbatch calls on large cohorts.
+class SlurmScheduler(PBSScheduler):
+    array_arg = "--array"
+    array_task_id_variable = "SLURM_ARRAY_TASK_ID"
+    # sbatch requires a script interpreter line
+    job_script_header = "#!/bin/bash\n"
 
-        # Check cluster maximum job submission
-        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
-        if cluster_max_jobs and len(pipeline.jobs) > cluster_max_jobs:
-            log.warning("Number of jobs: " + str(len(pipeline.jobs)) + " > Cluster maximum number of jobs: " + str(cluster_max_jobs) + "!")
+    def submit(self, pipeline):
+        if config.param('DEFAULT', 'slurm_bulk_submission', required=False, type='boolean'):
+            self.print_header(pipeline)
+            for step in pipeline.step_range:
+                if step.jobs:
+                    self.print_step(step)
+                    self.print_step_manifest(step)
+                    first_task_id = 1
+                    for job_group in self.job_groups(step):
+                        for job_array in self.job_arrays(job_group):
+                            self.print_job_array(job_array, first_task_id, shared_task_table=True, array_task_offset=first_task_id - 1)
+                            first_task_id += len(job_array)
+            self.check_cluster_max_jobs(pipeline)
+        else:
+            PBSScheduler.submit(self, pipeline)
+
+    # Step submission manifest listing all step job scripts: task index, job name, job .done file and job script path
+    def print_step_manifest(self, step):
+        print("""\
+JOB_TASK_DIR=$JOB_OUTPUT_DIR/$STEP/${STEP}_$TIMESTAMP.tasks
+JOB_TASK_TABLE=$JOB_OUTPUT_DIR/$STEP/${STEP}_$TIMESTAMP.manifest
+mkdir -p $JOB_TASK_DIR
+rm -f $JOB_TASK_TABLE""")
+
+    # In bulk submission mode, all jobs not depending on jobs of the same step are grouped in job arrays
+    def is_job_array_section(self, job_name_prefix):
+        return config.param('DEFAULT', 'slurm_bulk_submission', required=False, type='boolean') or PBSScheduler.is_job_array_section(self, job_name_prefix)
+
+    def cluster_submit_cmd(self, job_name_prefix, has_dependencies, jobs, is_array=False):
+        # Cluster settings section must match job name prefix before first "."
+        # Array task output files are suffixed by their task index like in PBS
+        cmd = \
+            (config.param(job_name_prefix, 'slurm_submit_cmd', required=False) or "sbatch") + " --parsable " + \
+            " ".join([option for option in [
+                slurm_options(config.param(job_name_prefix, 'cluster_other_arg')),
+                slurm_options(cluster_walltime(job_name_prefix, jobs)),
+                slurm_options(config.param(job_name_prefix, 'cluster_queue')),
+                slurm_options(cluster_cpu(job_name_prefix, jobs))
+            ] if option]) + \
+            " -D $OUTPUT_DIR" + \
+            " -o $JOB_OUTPUT" + ("-%a" if is_array else "") + \
+            " -J $JOB_NAME"
+        if has_dependencies:
+            cmd += " --dependency=afterok:$JOB_DEPENDENCIES"
+        return cmd
+
+    # sbatch --parsable prints "<job ID>[;<cluster name>]"
+    def cluster_submit_cmd_suffix(self, job_name_prefix):
+        return "| cut -d ';' -f 1"
+
+    def cluster_cmd_produces_job_id(self, job_name_prefix):
+        return True
+
+    def priority_arg(self, priority):
+        # Regular users can only lower their job priority with a positive nice value
+        return " --nice=" + str(int(round((1 - priority) * slurm_max_nice))) if priority is not None else ""
+
+    # SLURM rejects array task indexes greater than or equal to its MaxArraySize (default: 1001)
+    def job_arrays(self, jobs):
+        max_array_size = config.param('DEFAULT', 'slurm_max_array_size', required=False, type='posint') or slurm_max_array_size
+        return [jobs[i:i + max_array_size] for i in range(0, len(jobs), max_array_size)]
+
+    def array_range_arg(self, first_task_id, last_task_id):
+        return self.array_arg + "=" + str(first_task_id) + "-" + str(last_task_id)
+
+    # Return array task job ID given array job ID variable e.g. "123" -> "123_1"
+    def array_task_job_id(self, array_job_id, task_id):
+        return "${" + array_job_id.lstrip("$") + "}_" + str(task_id)
 
 class BatchScheduler(Scheduler):
     def submit(self, pipeline):
@@ -182,17 +598,36 @@ class BatchScheduler(Scheduler):
 {separator_line}
 JOB_NAME={job.name}
 JOB_DONE={job.done}
+JOB_OUTPUT_RELATIVE_PATH=$STEP/${{JOB_NAME}}_$TIMESTAMP.o
+JOB_OUTPUT=$JOB_OUTPUT_DIR/$JOB_OUTPUT_RELATIVE_PATH
+echo "$JOB_NAME\t$JOB_NAME\t{job_dependencies}\t$JOB_OUTPUT_RELATIVE_PATH" >> $JOB_LIST
 printf "\\n$SEPARATOR_LINE\\n"
 echo "Begin MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`" && \\
-rm -f $JOB_DONE && \\
+{remove_done_cmd}{early_removal_start_cmd} && \\
+(
+# Run job in a subshell to report its own resource usage, its output being also written in the job output file
+MUGQIC_START=$(date +%s)
+{input_size_cmd}
 {job.command_with_modules}
 MUGQIC_STATE=$PIPESTATUS
-echo "End MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`"
 echo MUGQICexitStatus:$MUGQIC_STATE
-if [ $MUGQIC_STATE -eq 0 ] ; then touch $JOB_DONE ; else exit $MUGQIC_STATE ; fi
+{resource_usage_script}
+exit $MUGQIC_STATE
+) 2>&1 | tee $JOB_OUTPUT
+MUGQIC_STATE=$PIPESTATUS
+echo "End MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`"
+if [ $MUGQIC_STATE -eq 0 ] ; then {create_done_cmd}{write_manifest_cmd}{early_removal_end_cmd} ; else exit $MUGQIC_STATE ; fi
 """.format(
                             job=job,
-                            separator_line=separator_line
+                            separator_line=separator_line,
+                            job_dependencies=":".join([dependency_job.name for dependency_job in job.dependency_jobs]),
+                            remove_done_cmd=completion_store.remove_done_cmd("$JOB_DONE", job.output_dir),
+                            create_done_cmd=completion_store.create_done_cmd("$JOB_DONE", job.output_dir),
+                            write_manifest_cmd=write_manifest_cmd(job),
+                            early_removal_start_cmd=early_removal.job_start_cmd(job),
+                            early_removal_end_cmd=early_removal.job_end_cmd(job),
+                            input_size_cmd=job_input_size_cmd(job),
+                            resource_usage_script=job_resource_usage_script
                         )
                     )
 
@@ -221,11 +656,157 @@ class DaemonScheduler(Scheduler):
                             'cluster_work_dir_arg': config.param(job.name.split(".")[0], 'cluster_work_dir_arg') + " " + pipeline.output_dir,
                             'cluster_output_dir_arg': config.param(job.name.split(".")[0], 'cluster_output_dir_arg') + " " + os.path.join(pipeline.output_dir, "job_output", step.name, job.name + ".o"),
                             'cluster_job_name_arg': config.param(job.name.split(".")[0], 'cluster_job_name_arg') + " " + job.name,
-                            'cluster_walltime': config.param(job.name.split(".")[0], 'cluster_walltime'),
+                            'cluster_walltime': cluster_walltime(job.name.split(".")[0], [job]),
                             'cluster_queue': config.param(job.name.split(".")[0], 'cluster_queue'),
-                            'cluster_cpu': config.param(job.name.split(".")[0], 'cluster_cpu')
+                            'cluster_cpu': cluster_cpu(job.name.split(".")[0], [job])
                         },
                         "job_done": job.done
                     } for job in step.jobs]
                 } for step in pipeline.step_range]
             }}, indent=4)
+
+# Return a memory size in bytes given a string with an optional unit suffix e.g. "10G", "512M", "2048k"
+def parse_memory_size(memory_size):
+    memory_match = re.search("^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)[bB]?\s*$", memory_size)
+    if memory_match:
+        return int(float(memory_match.group(1)) * 1024 ** " KMGT".index(memory_match.group(2).upper() or " "))
+    else:
+        raise Exception("Error: memory size \"" + memory_size + "\" is invalid (should be a number with optional k, M, G or T unit)!")
+
+# Execute jobs on the local machine with a pool of concurrent jobs, following job dependencies.
+# Jobs are packed so that the sum of their cores and memory (cluster_cpu "ppn" and ram values of their config section,
+# or memory set by the resource model if larger) does not exceed the local_max_cpu and local_max_ram values (default: all cores and physical memory).
+class LocalScheduler(Scheduler):
+    def submit(self, pipeline):
+        jobs = pipeline.jobs
+        if not jobs:
+            log.info("No job to execute")
+            return
+
+        max_cpu = config.param('DEFAULT', 'local_max_cpu', required=False, type='posint') or multiprocessing.cpu_count()
+        max_ram = config.param('DEFAULT', 'local_max_ram', required=False)
+        max_ram = parse_memory_size(max_ram) if max_ram else os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H.%M.%S")
+        job_output_dir = os.path.join(pipeline.output_dir, "job_output")
+        job_list = os.path.join(job_output_dir, pipeline.__class__.__name__ + "_job_list_" + timestamp)
+
+        job_positions = {}
+        job_steps = {}
+        for step in pipeline.step_range:
+            if step.jobs and not os.path.isdir(os.path.join(job_output_dir, step.name)):
+                os.makedirs(os.path.join(job_output_dir, step.name))
+            for job in step.jobs:
+                job_positions[job] = len(job_positions)
+                job_steps[job] = step
+
+        # Only dependencies created in this pipeline run are waited for
+        remaining_dependencies = dict([(job, len([dependency_job for dependency_job in job.dependency_jobs if dependency_job in job_positions])) for job in jobs])
+        dependent_jobs = dict([(job, []) for job in jobs])
+        for job in jobs:
+            for dependency_job in job.dependency_jobs:
+                if dependency_job in dependent_jobs:
+                    dependent_jobs[dependency_job].append(job)
+
+        # Ready jobs are kept sorted by creation order
+        ready_jobs = [job_positions[job] for job in jobs if remaining_dependencies[job] == 0]
+        completed_jobs = Queue.Queue()
+        running_jobs = {}
+        used_cpu = 0
+        used_ram = 0
+        failed_jobs = []
+        cancelled_jobs = []
+        nb_succeeded_jobs = 0
+
+        log.info("Execute " + str(len(jobs)) + " job" + ("s" if len(jobs) > 1 else "") + " locally with maximum " + str(max_cpu) + " cores and " + str(max_ram / 1024 ** 2) + " MB of memory...")
+        try:
+            while ready_jobs or running_jobs:
+                # Start ready jobs fitting in available resources, in creation order
+                for job_position in list(ready_jobs):
+                    job = jobs[job_position]
+                    job_cpu, job_ram = self.job_resources(job, max_cpu, max_ram)
+                    if used_cpu + job_cpu <= max_cpu and used_ram + job_ram <= max_ram:
+                        ready_jobs.remove(job_position)
+                        running_jobs[job] = self.start_job(job, job_steps[job], pipeline.output_dir, job_output_dir, timestamp, job_list, completed_jobs)
+                        used_cpu += job_cpu
+                        used_ram += job_ram
+
+                # Wait with a timeout: a blocking Queue.get() cannot be interrupted by KeyboardInterrupt in Python 2
+                while True:
+                    try:
+                        job, job_state = completed_jobs.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running_jobs.pop(job)
+                job_cpu, job_ram = self.job_resources(job, max_cpu, max_ram)
+                used_cpu -= job_cpu
+                used_ram -= job_ram
+
+                if job_state == 0:
+                    log.info("Job " + job.name + " succeeded")
+                    nb_succeeded_jobs += 1
+                    for dependent_job in dependent_jobs[job]:
+                        remaining_dependencies[dependent_job] -= 1
+                        if remaining_dependencies[dependent_job] == 0:
+                            bisect.insort(ready_jobs, job_positions[dependent_job])
+                else:
+                    log.error("Job " + job.name + " failed with exit status " + str(job_state) + " (see log in " + os.path.join(job_output_dir, job_steps[job].name) + ")")
+                    failed_jobs.append(job)
+                    # Cancel all jobs depending directly or indirectly on the failed job
+                    cancelled_job_stack = list(dependent_jobs[job])
+                    while cancelled_job_stack:
+                        cancelled_job = cancelled_job_stack.pop()
+                        if remaining_dependencies[cancelled_job] >= 0:
+                            log.warning("Job " + cancelled_job.name + " cancelled since it depends on failed job " + job.name)
+                            # A negative count marks the job as cancelled so that it is never started
+                            remaining_dependencies[cancelled_job] = -1
+                            cancelled_jobs.append(cancelled_job)
+                            cancelled_job_stack.extend(dependent_jobs[cancelled_job])
+        finally:
+            # On interruption, stop running jobs and all their processes
+            for process in running_jobs.values():
+                if process.poll() is None:
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+
+        log.info("Local execution finished: " + str(nb_succeeded_jobs) + " succeeded, " + str(len(failed_jobs)) + " failed, " + str(len(cancelled_jobs)) + " cancelled job(s)")
+        if failed_jobs:
+            raise Exception("Error: failed jobs: " + ", ".join([job.name for job in failed_jobs]) + "!")
+
+    # Return the number of cores and the memory in bytes used by a job, bounded by the local maximum values
+    def job_resources(self, job, max_cpu, max_ram):
+        # Cluster settings section must match job name prefix before first "."
+        job_name_prefix = job.name.split(".")[0]
+        cpu_match = re.search("ppn=(\d+)", config.param(job_name_prefix, 'cluster_cpu', required=False))
+        job_cpu = int(cpu_match.group(1)) if cpu_match else 1
+        job_ram = config.param(job_name_prefix, 'ram', required=False)
+        job_ram = parse_memory_size(job_ram) if job_ram else 0
+        # Memory set by the resource model raises the config one
+        if job.memory:
+            job_ram = max(job_ram, job.memory * 1024 ** 2)
+        return min(job_cpu, max_cpu), min(job_ram, max_ram)
+
+    # Start job process, writing job output and exit status in its log file and creating job .done file on success,
+    # like the cluster job scripts. Job completion is notified in completed_jobs queue.
+    def start_job(self, job, step, output_dir, job_output_dir, timestamp, job_list, completed_jobs):
+        job_output_relative_path = os.path.join(step.name, job.name + "_" + timestamp + ".o")
+        with open(job_list, 'a') as job_list_file:
+            job_list_file.write("\t".join([job.id, job.name, ":".join([dependency_job.id for dependency_job in job.dependency_jobs]), job_output_relative_path]) + "\n")
+
+        job_environment = dict(os.environ)
+        job_environment.update({'OUTPUT_DIR': output_dir, 'JOB_OUTPUT_DIR': job_output_dir, 'JOB_NAME': job.name, 'JOB_DONE': job.done})
+        log.info("Start job " + job.name)
+        with open(os.path.join(job_output_dir, job_output_relative_path), 'w') as job_output:
+            # Each job runs in its own process group, so that all its processes can be terminated together
+            process = subprocess.Popen(["bash", "-c", self.job_script(job)], cwd=output_dir, env=job_environment, stdout=job_output, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+        def wait_job():
+            completed_jobs.put((job, process.wait()))
+        wait_thread = threading.Thread(target=wait_job)
+        wait_thread.daemon = True
+        wait_thread.start()
+
+        return process
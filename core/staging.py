@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import logging
+import os
+import re
+
+# MUGQIC Modules
+from config import *
+
+log = logging.getLogger(__name__)
+
+# Shell variable containing the node-local staging directory of a job
+staging_dir_variable = "MUGQIC_STAGING_DIR"
+
+# Return the index files which may accompany a file: BAM (.bam.bai and .bai), VCF/BED tabix (.tbi) and GATK VCF (.idx) indexes
+def companion_files(file):
+    return list(collections.OrderedDict.fromkeys([
+        file + ".bai",
+        re.sub("\.bam$", ".bai", file),
+        file + ".tbi",
+        file + ".idx"
+    ]))
+
+# Return True if a job file can be staged i.e. it is a relative path in the pipeline output directory, without shell variable
+def is_stageable_file(file):
+    return not os.path.isabs(file) and "$" not in file and not file.startswith("..")
+
+# Return command with all occurrences of file path as a whole word replaced by its staged path
+def rewrite_file_path(command, file):
+    return re.sub("(?<![\w./-])" + re.escape(file) + "(?![\w./-])", "$" + staging_dir_variable + "/" + file, command)
+
+# Return the job command wrapped to run in a node-local staging directory:
+# input files and their index files are copied in the staging directory, the command is run on staged paths,
+# then on success, output files and their index files are moved back under a temporary name and renamed,
+# so that output files appear atomically in the output directory.
+# All this runs in a subshell which removes the staging directory on success and failure alike before exiting with the job status,
+# since job scripts may replace their shell with 'exec' before an EXIT trap of the job shell would run.
+# The subshell EXIT trap only removes the staging directory of a killed job.
+def staged_command(job):
+    input_files = [input_file for input_file in job.input_files if is_stageable_file(input_file)]
+    output_files = [output_file for output_file in job.output_files if is_stageable_file(output_file)]
+    staged_files = list(collections.OrderedDict.fromkeys(input_files + output_files))
+    # Longest paths are rewritten first, in case a path is a prefix of another one
+    command = job.command
+    for file in sorted(staged_files, key=len, reverse=True):
+        command = rewrite_file_path(command, file)
+
+    staging_dir = "$" + staging_dir_variable
+    staged_dirs = collections.OrderedDict.fromkeys([os.path.join(staging_dir, os.path.dirname(file)) for file in staged_files])
+    output_dirs = collections.OrderedDict.fromkeys([os.path.dirname(output_file) for output_file in output_files if os.path.dirname(output_file)])
+
+    return """\
+(
+{staging_dir_variable}=$(mktemp -d ${{TMPDIR:-/tmp}}/mugqic_staging.XXXXXX) || exit $?
+trap "rm -rf ${staging_dir_variable}" EXIT
+mkdir -p {staged_dirs} && \\
+{copy_inputs}(
+{command}
+exit $PIPESTATUS
+) && \\
+{make_output_dirs}{move_outputs}true
+MUGQIC_STAGING_STATE=$?
+rm -rf {staging_dir}
+exit $MUGQIC_STAGING_STATE
+)""".format(
+        staging_dir_variable=staging_dir_variable,
+        staging_dir=staging_dir,
+        staged_dirs=" ".join(staged_dirs),
+        copy_inputs="".join(["cp -r " + input_file + " " + os.path.join(staging_dir, input_file) + " && \\\n" for input_file in input_files]) + \
+            "".join(["if [ -e " + companion_file + " ] ; then cp " + companion_file + " " + os.path.join(staging_dir, companion_file) + " ; fi && \\\n" for input_file in input_files for companion_file in companion_files(input_file) if companion_file not in input_files]),
+        command=command,
+        make_output_dirs="mkdir -p " + " ".join(output_dirs) + " && \\\n" if output_dirs else "",
+        move_outputs="".join(["mv " + os.path.join(staging_dir, output_file) + " " + output_file + ".staging.tmp && if [ -d " + output_file + " ] ; then rm -rf " + output_file + " ; fi && mv -f " + output_file + ".staging.tmp " + output_file + " && \\\n" for output_file in output_files]) + \
+            "".join(["if [ -e " + os.path.join(staging_dir, companion_file) + " ] ; then mv " + os.path.join(staging_dir, companion_file) + " " + companion_file + ".staging.tmp && mv -f " + companion_file + ".staging.tmp " + companion_file + " ; fi && \\\n" for output_file in output_files for companion_file in companion_files(output_file) if companion_file not in output_files])
+    )
+
+# Run jobs of config sections with 'node_local_staging' set in a node-local staging directory under $TMPDIR,
+# to avoid random I/O on the shared file system. Only job input and output files relative to the pipeline output directory are staged.
+# Job .done file names are not modified: staged jobs which are up to date are still skipped.
+def stage_jobs(jobs):
+    nb_staged_jobs = 0
+    for job in jobs:
+        # Config section must match job name prefix before first "."
+        if config.param(job.name.split(".")[0], 'node_local_staging', required=False, type='boolean'):
+            job.command = staged_command(job)
+            nb_staged_jobs += 1
+            log.debug("Job " + job.name + " staged in node-local directory")
+
+    if nb_staged_jobs:
+        log.info("Node-local staging: " + str(nb_staged_jobs) + " job" + ("s" if nb_staged_jobs > 1 else "") + " staged\n")
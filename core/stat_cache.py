@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import logging
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+# Default number of threads used to probe file metadata in bulk
+default_nb_threads = 16
+
+# Cache of file metadata keyed by absolute path.
+# Jobs mostly read the file system while they are created, hence each path needs to be probed only once
+# and many paths can be probed concurrently to hide the metadata latency of parallel file systems.
+# Files written while jobs are created, e.g. plan files or job manifests, must be invalidated once written.
+class StatCache:
+
+    def __init__(self):
+        self._stats = {}
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def clear(self):
+        self._stats = {}
+        self._hits = 0
+        self._misses = 0
+
+    # Return a (stat, lstat) tuple for path, each being None if it cannot be retrieved
+    def _probe(self, path):
+        try:
+            path_lstat = os.lstat(path)
+        except OSError:
+            return (None, None)
+        # Follow symbolic links like 'os.path.exists' does
+        if stat.S_ISLNK(path_lstat.st_mode):
+            try:
+                return (os.stat(path), path_lstat)
+            except OSError:
+                return (None, path_lstat)
+        else:
+            return (path_lstat, path_lstat)
+
+    def _get(self, path):
+        if path in self._stats:
+            self._hits += 1
+        else:
+            self._misses += 1
+            self._stats[path] = self._probe(path)
+        return self._stats[path]
+
+    # Forget cached metadata of an absolute path written or removed since it was probed, so that it is probed again
+    def invalidate(self, path):
+        self._stats.pop(path, None)
+
+    # Probe all given absolute paths not cached yet, using a pool of threads
+    def prefetch(self, paths, nb_threads=default_nb_threads):
+        missing_paths = [path for path in set(paths) if path not in self._stats]
+        if len(missing_paths) > 1 and nb_threads > 1:
+            pool = ThreadPool(min(nb_threads, len(missing_paths)))
+            try:
+                path_stats = pool.map(self._probe, missing_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            path_stats = [self._probe(path) for path in missing_paths]
+        self._stats.update(zip(missing_paths, path_stats))
+        self._misses += len(missing_paths)
+
+    # Same as 'os.path.exists'
+    def exists(self, path):
+        return self._get(path)[0] is not None
+
+    # Same as 'os.stat' but return None if path does not exist
+    def stat(self, path):
+        return self._get(path)[0]
+
+    # Same as 'os.lstat' but return None if path does not exist
+    def lstat(self, path):
+        return self._get(path)[1]
+
+    def log_counters(self, prefix=""):
+        log.debug(prefix + "Stat cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + str(len(self._stats)) + " paths")
+
+# Global stat cache object used throughout the whole pipeline
+stat_cache = StatCache()
@@ -35,6 +35,9 @@ class Step:
         self._name = step_name
         self._create_jobs = create_jobs
         self._jobs = []
+        # Index of job positions by output file, updated on each added job,
+        # to retrieve file producer jobs without scanning the whole job list
+        self._output_file_index = {}
 
     @property
     def name(self):
@@ -48,6 +51,26 @@ class Step:
     def jobs(self):
         return self._jobs
 
+    @property
+    def output_file_index(self):
+        return self._output_file_index
+
     def add_job(self, job):
         self.jobs.append(job)
         job.id = self.name + "_" + str(len(self.jobs)) + "_JOB_ID"
+        for output_file in job.output_files:
+            self._output_file_index.setdefault(output_file, []).append(len(self.jobs) - 1)
+
+    # Replace all step jobs e.g. after job fusion, updating job IDs and output file index
+    def reset_jobs(self, jobs):
+        self._jobs = []
+        self._output_file_index = {}
+        for job in jobs:
+            self.add_job(job)
+
+    # Return the jobs of this step producing any of the given files, in job creation order
+    def producer_jobs(self, files):
+        job_positions = set()
+        for file in files:
+            job_positions.update(self._output_file_index.get(file, []))
+        return [self.jobs[job_position] for job_position in sorted(job_positions)]
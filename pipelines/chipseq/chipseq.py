@@ -34,6 +34,7 @@ from core.config import *
 from core.job import *
 from core.pipeline import *
 from bfx.design import *
+from bfx.genome_reference import *
 
 from bfx import gq_seq_utils
 from bfx import picard
@@ -85,10 +86,8 @@ class ChipSeq(dnaseq.DnaSeq):
         return contrasts
 
     def mappable_genome_size(self):
-        genome_index = csv.reader(open(config.param('DEFAULT', 'genome_fasta', type='filepath') + ".fai", 'rb'), delimiter='\t')
-        # 2nd column of genome index contains chromosome length
         # HOMER and MACS2 mappable genome size (without repetitive features) is about 80 % of total size
-        return sum([int(chromosome[1]) for chromosome in genome_index]) * 0.8
+        return genome_reference().genome_size * 0.8
 
     def samtools_view_filter(self):
         """
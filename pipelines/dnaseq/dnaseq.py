@@ -20,6 +20,7 @@
 ################################################################################
 
 # Python Standard Modules
+import collections
 import logging
 import math
 import os
@@ -33,7 +34,9 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
 from core.config import *
 from core.job import *
 from core.pipeline import *
+from bfx.genome_reference import *
 from bfx.readset import *
+from bfx.scatter_weights import *
 from bfx.sequence_dictionary import *
 
 from bfx import bvatools
@@ -82,9 +85,63 @@ class DnaSeq(common.Illumina):
 
     @property
     def sequence_dictionary(self):
-        if not hasattr(self, "_sequence_dictionary"):
-            self._sequence_dictionary = parse_sequence_dictionary_file(config.param('DEFAULT', 'genome_dictionary', type='filepath'))
-        return self._sequence_dictionary
+        return genome_reference().sequence_dictionary
+
+    # Recalibrated BAM files of all samples, processed by haplotype caller
+    @property
+    def recalibrated_bams(self):
+        return [os.path.join("alignment", sample.name, sample.name + ".sorted.dup.recal.bam") for sample in self.samples]
+
+    # Return the scatter weights of a step config section 'scatter_weights' value: 'length' (default) balances shards by sequence length,
+    # 'targets' by target bases of the readset BED files and 'bam_index' by mapped reads of the step input BAM file indexes,
+    # which must exist: the pipeline must be run up to the step creating them first.
+    # Step jobs read their regions from BED files written by genome_scatter_beds, so only jobs whose regions changed are run again.
+    def scatter_weights(self, section, bams):
+        scatter_weights = config.param(section, 'scatter_weights', required=False) or "length"
+        if scatter_weights == "length":
+            return None
+        elif scatter_weights == "targets":
+            bed_files = [bed_file for bed_file in collections.OrderedDict.fromkeys([bvatools.resolve_readset_coverage_bed(readset) for readset in self.readsets]) if bed_file]
+            if bed_files:
+                return bed_weights(bed_files)
+            else:
+                log.warning("No readset BED files found for scatter_weights=targets in [" + section + "]: shards are balanced by length instead")
+                return None
+        elif scatter_weights == "bam_index":
+            # Never fall back silently: shards balanced otherwise would change once BAM indexes exist, rewriting the region BED files of queued jobs
+            for bam in bams:
+                if not bam_index_file(os.path.join(self.output_dir, bam)):
+                    raise Exception("Error: BAM index of " + bam + " is required by scatter_weights=bam_index in [" + section + "] but was not found: run the pipeline up to the step creating it first!")
+            return bam_index_weights([bam_index_file(os.path.join(self.output_dir, bam)) for bam in bams], self.sequence_dictionary)
+        else:
+            raise Exception("Error: scatter_weights \"" + scatter_weights + "\" in [" + section + "] is invalid (should be length, targets or bam_index)!")
+
+    # Return the genome scatter in nb_shards shards of balanced length, shared by all steps processing the genome by regions.
+    # If a config section is given, shards are balanced by its scatter weights instead, computed from the given BAM files if needed.
+    # The last shard is processed as the complement of all other shards, named 'others'.
+    def genome_scatter(self, nb_shards, split_sequences=True, section=None, bams=[]):
+        if not hasattr(self, "_genome_scatters"):
+            self._genome_scatters = {}
+        key = (nb_shards, split_sequences, section, tuple(bams))
+        if key not in self._genome_scatters:
+            self._genome_scatters[key] = scatter_intervals(self.sequence_dictionary, nb_shards, split_sequences, self.scatter_weights(section, bams) if section else None)
+        return self._genome_scatters[key]
+
+    # Write the region BED files of a genome scatter in a directory, only if their regions changed: one BED file for each shard but the last one,
+    # and one 'others' BED file of all their regions, excluded by the job processing the last shard.
+    # Return the shard BED files and the 'others' BED file, None if there are no other regions.
+    def genome_scatter_beds(self, directory, shards):
+        beds = [os.path.join(directory, "regions." + str(idx) + ".bed") for idx in range(len(shards) - 1)]
+        for intervals, bed in zip(shards[:-1], beds):
+            self.write_plan_file(bed, "".join([bed_line + "\n" for bed_line in intervals_to_bed(self.sequence_dictionary, intervals)]))
+
+        others_intervals = [interval for intervals in shards[:-1] for interval in intervals]
+        if others_intervals:
+            others_bed = os.path.join(directory, "regions.others.exclude.bed")
+            self.write_plan_file(others_bed, "".join([bed_line + "\n" for bed_line in intervals_to_bed(self.sequence_dictionary, others_intervals)]))
+        else:
+            others_bed = None
+        return beds, others_bed
 
     def bwa_mem_picard_sort_sam(self):
         """
@@ -229,7 +286,8 @@ pandoc --to=markdown \\
         are preferred over indels by the aligner since it can appear to be less costly by the algorithm.
         Such regions will introduce false positive variant calls which may be filtered out by realigning
         those regions properly. Realignment is done using [GATK](https://www.broadinstitute.org/gatk/).
-        The reference genome is divided by a number regions given by the `nb_jobs` parameter.
+        The reference genome is divided by a number regions given by the `nb_jobs` parameter,
+        whole sequences being distributed so that regions have balanced total lengths.
         """
 
         jobs = []
@@ -257,26 +315,26 @@ pandoc --to=markdown \\
                 ], name="gatk_indel_realigner." + sample.name))
 
             else:
-                # The first sequences are the longest to process.
-                # Each of them must be processed in a separate job.
-                unique_sequences_per_job = [sequence['name'] for sequence in self.sequence_dictionary[0:min(nb_jobs - 1, len(self.sequence_dictionary))]]
+                # Sequences are not split since reads overlapping a sub-interval boundary would be realigned twice
+                shards = self.genome_scatter(nb_jobs, split_sequences=False)
+                unique_sequences_per_job = [sequence for sequences in shards[:-1] for sequence in sequences]
 
-                # Create one separate job for each of the first sequences
-                for sequence in unique_sequences_per_job:
-                    realign_prefix = os.path.join(realign_directory, sequence)
+                # Create one separate job for each of the first shards
+                for idx, sequences in enumerate(shards[:-1]):
+                    realign_prefix = os.path.join(realign_directory, str(idx))
                     realign_intervals = realign_prefix + ".intervals"
-                    intervals=[sequence]
-                    if unique_sequences_per_job.index(sequence) == 0:
+                    intervals = list(sequences)
+                    if idx == 0:
                         intervals.append("unmapped")
                     output_bam = realign_prefix + ".bam"
                     jobs.append(concat_jobs([
                         # Create output directory since it is not done by default by GATK tools
                         Job(command="mkdir -p " + realign_directory, removable_files=[realign_directory]),
-                        gatk.realigner_target_creator(input, realign_intervals, intervals=[sequence]),
+                        gatk.realigner_target_creator(input, realign_intervals, intervals=sequences),
                         gatk.indel_realigner(input, output_bam, target_intervals=realign_intervals, intervals=intervals)
-                    ], name="gatk_indel_realigner." + sample.name + "." + sequence))
+                    ], name="gatk_indel_realigner." + sample.name + "." + str(idx)))
 
-                # Create one last job to process the last remaining sequences and 'others' sequences
+                # Create one last job to process the last shard sequences and 'others' sequences
                 realign_prefix = os.path.join(realign_directory, "others")
                 realign_intervals = realign_prefix + ".intervals"
                 output_bam = realign_prefix + ".bam"
@@ -305,7 +363,7 @@ pandoc --to=markdown \\
 
             # if nb_jobs == 1, symlink has been created in indel_realigner and merging is not necessary
             if nb_jobs > 1:
-                realigned_bams = [os.path.join(realign_directory, sequence['name'] + ".bam") for sequence in self.sequence_dictionary[0:min(nb_jobs - 1, len(self.sequence_dictionary))]]
+                realigned_bams = [os.path.join(realign_directory, str(idx) + ".bam") for idx in xrange(len(self.genome_scatter(nb_jobs, split_sequences=False)) - 1)]
                 realigned_bams.append(os.path.join(realign_directory, "others.bam"))
 
                 job = picard.merge_sam_files(realigned_bams, merged_realigned_bam)
@@ -577,6 +635,9 @@ cp \\
     def gatk_haplotype_caller(self):
         """
         GATK haplotype caller for snps and small indels.
+        The reference genome is divided in `nb_jobs` contiguous regions of equal length, long sequences being split if needed.
+        With `scatter_weights`, regions are balanced by readset BED target bases or by mapped reads of BAM indexes instead.
+        Regions are read from BED files, so that only jobs whose regions changed are run again.
         """
 
         jobs = []
@@ -585,6 +646,11 @@ cp \\
         if nb_haplotype_jobs > 50:
             log.warning("Number of haplotype jobs is > 50. This is usually much. Anything beyond 20 can be problematic.")
 
+        if nb_haplotype_jobs > 1:
+            # Job commands only refer to region BED files, so that jobs of unchanged regions stay up to date
+            beds, others_bed = self.genome_scatter_beds(os.path.join("alignment", "rawHaplotypeCaller.regions"), self.genome_scatter(nb_haplotype_jobs, section='gatk_haplotype_caller', bams=self.recalibrated_bams))
+            others_exclude_intervals = [others_bed] if others_bed else []
+
         for sample in self.samples:
             alignment_directory = os.path.join("alignment", sample.name)
             haplotype_directory = os.path.join(alignment_directory, "rawHaplotypeCaller")
@@ -598,22 +664,24 @@ cp \\
                 ], name="gatk_haplotype_caller." + sample.name))
 
             else:
-                unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-                # Create one separate job for each of the first sequences
-                for idx,sequences in enumerate(unique_sequences_per_job):
-                    jobs.append(concat_jobs([
+                # Create one separate job for each of the first shards
+                for idx,bed in enumerate(beds):
+                    job = concat_jobs([
                         # Create output directory since it is not done by default by GATK tools
                         Job(command="mkdir -p " + haplotype_directory,removable_files=[haplotype_directory]),
-                        gatk.haplotype_caller(input, os.path.join(haplotype_directory, sample.name + "." + str(idx) + ".hc.g.vcf.bgz"), intervals=sequences)
-                    ], name="gatk_haplotype_caller." + sample.name + "." + str(idx)))
+                        gatk.haplotype_caller(input, os.path.join(haplotype_directory, sample.name + "." + str(idx) + ".hc.g.vcf.bgz"), intervals=[bed])
+                    ], name="gatk_haplotype_caller." + sample.name + "." + str(idx))
+                    job.input_files = list(job.input_files) + [bed]
+                    jobs.append(job)
 
                 # Create one last job to process the last remaining sequences and 'others' sequences
-                jobs.append(concat_jobs([
+                job = concat_jobs([
                     # Create output directory since it is not done by default by GATK tools
                     Job(command="mkdir -p " + haplotype_directory,removable_files=[haplotype_directory]),
-                    gatk.haplotype_caller(input, os.path.join(haplotype_directory, sample.name + ".others.hc.g.vcf.bgz"), exclude_intervals=unique_sequences_per_job_others)
-                ], name="gatk_haplotype_caller." + sample.name + ".others"))
+                    gatk.haplotype_caller(input, os.path.join(haplotype_directory, sample.name + ".others.hc.g.vcf.bgz"), exclude_intervals=others_exclude_intervals)
+                ], name="gatk_haplotype_caller." + sample.name + ".others")
+                job.input_files = list(job.input_files) + others_exclude_intervals
+                jobs.append(job)
 
         return jobs
 
@@ -631,9 +699,7 @@ cp \\
             if nb_haplotype_jobs == 1:
                 gvcfs_to_merge = [haplotype_file_prefix + ".hc.g.vcf.bgz"]
             else:
-                unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-                gvcfs_to_merge = [haplotype_file_prefix + "." + str(idx) + ".hc.g.vcf.bgz" for idx in xrange(len(unique_sequences_per_job))]
+                gvcfs_to_merge = [haplotype_file_prefix + "." + str(idx) + ".hc.g.vcf.bgz" for idx in xrange(len(self.genome_scatter(nb_haplotype_jobs, section='gatk_haplotype_caller', bams=self.recalibrated_bams)) - 1)]
                 gvcfs_to_merge.append(haplotype_file_prefix + ".others.hc.g.vcf.bgz")
 
             jobs.append(concat_jobs([
@@ -650,6 +716,11 @@ cp \\
         jobs = []
         nb_haplotype_jobs = config.param('gatk_combine_gvcf', 'nb_haplotype', type='posint')
         nb_maxbatches_jobs = config.param('gatk_combine_gvcf', 'nb_batch', type='posint')
+
+        if nb_haplotype_jobs > 1:
+            # Job commands only refer to region BED files, so that jobs of unchanged regions stay up to date
+            beds, others_bed = self.genome_scatter_beds(os.path.join("variants", "combineGVCF.regions"), self.genome_scatter(nb_haplotype_jobs, section='gatk_combine_gvcf', bams=self.recalibrated_bams))
+            others_exclude_intervals = [others_bed] if others_bed else []
         
         # merge all sample in one shot
         if nb_maxbatches_jobs == 1 :
@@ -659,18 +730,19 @@ cp \\
                     gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in self.samples ], os.path.join("variants", "allSamples.hc.g.vcf.bgz"))],
                     name="gatk_combine_gvcf.AllSamples"))
             else :
-                unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-                # Create one separate job for each of the first sequences
-                for idx,sequences in enumerate(unique_sequences_per_job):
-                    obs.append(concat_jobs([
+                # Create one separate job for each of the first shards
+                for idx,bed in enumerate(beds):
+                    job = concat_jobs([
                         Job(command="mkdir -p variants",removable_files=[os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz",os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz.tbi"]),
-                        gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in self.samples ], os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz", intervals=sequences)
-                    ], name="gatk_combine_gvcf.AllSample" + "." + str(idx)))
+                        gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in self.samples ], os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz", intervals=[bed])
+                    ], name="gatk_combine_gvcf.AllSample" + "." + str(idx))
+                    job.input_files = list(job.input_files) + [bed]
+                    jobs.append(job)
 
                 # Create one last job to process the last remaining sequences and 'others' sequences
-                job=gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in self.samples ], os.path.join("alignment", "allSamples.others.hc.g.vcf.bgz"), exclude_intervals=unique_sequences_per_job_others)
+                job=gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in self.samples ], os.path.join("variants", "allSamples.others.hc.g.vcf.bgz"), exclude_intervals=others_exclude_intervals)
                 job.name="gatk_combine_gvcf.AllSample" + ".others"
+                job.input_files = list(job.input_files) + others_exclude_intervals
                 job.removable_files=[os.path.join("variants", "allSamples.others.hc.g.vcf.bgz"),os.path.join("variants", "allSamples.others.hc.g.vcf.bgz.tbi") ]
                 jobs.append(job)
         else:
@@ -686,18 +758,19 @@ cp \\
                         gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in batch ], os.path.join("variants", "allSamples.batch" + str(cpt) + ".hc.g.vcf.bgz"))
                     ], name="gatk_combine_gvcf.AllSamples.batch" + str(cpt)))
                 else :
-                    unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-                    # Create one separate job for each of the first sequences
-                    for idx,sequences in enumerate(unique_sequences_per_job):
-                        jobs.append(concat_jobs([
+                    # Create one separate job for each of the first shards
+                    for idx,bed in enumerate(beds):
+                        job = concat_jobs([
                             Job(command="mkdir -p variants",removable_files=[os.path.join("variants", "allSamples") + ".batch" + str(cpt) + "." + str(idx) + ".hc.g.vcf.bgz",os.path.join("variants", "allSamples") + ".batch" + str(cpt) + "." + str(idx) + ".hc.g.vcf.bgz.tbi"]),
-                            gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in batch ], os.path.join("variants", "allSamples") + ".batch" + str(cpt) + "." + str(idx) + ".hc.g.vcf.bgz", intervals=sequences)
-                        ], name="gatk_combine_gvcf.AllSample" + ".batch" + str(cpt) + "." + str(idx)))
+                            gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in batch ], os.path.join("variants", "allSamples") + ".batch" + str(cpt) + "." + str(idx) + ".hc.g.vcf.bgz", intervals=[bed])
+                        ], name="gatk_combine_gvcf.AllSample" + ".batch" + str(cpt) + "." + str(idx))
+                        job.input_files = list(job.input_files) + [bed]
+                        jobs.append(job)
                         
                     # Create one last job to process the last remaining sequences and 'others' sequences
-                    job=gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in batch ], os.path.join("variants", "allSamples" + ".batch" + str(cpt) + ".others.hc.g.vcf.bgz"), exclude_intervals=unique_sequences_per_job_others)
+                    job=gatk.combine_gvcf([ os.path.join("alignment", sample.name, sample.name)+".hc.g.vcf.bgz" for sample in batch ], os.path.join("variants", "allSamples" + ".batch" + str(cpt) + ".others.hc.g.vcf.bgz"), exclude_intervals=others_exclude_intervals)
                     job.name="gatk_combine_gvcf.AllSample" + ".batch" + str(cpt) + ".others"
+                    job.input_files = list(job.input_files) + others_exclude_intervals
                     job.removable_files=[os.path.join("variants", "allSamples" + ".batch" + str(cpt) + ".others.hc.g.vcf.bgz"),os.path.join("variants", "allSamples" + ".batch" + str(cpt) + ".others.hc.g.vcf.bgz.tbi")]
                     jobs.append(job)
                 batches.append("batch" + str(cpt))
@@ -709,18 +782,18 @@ cp \\
                 job.name="gatk_combine_gvcf.AllSamples.batches"
                 jobs.append(job)
             else :
-                unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-                # Create one separate job for each of the first sequences
-                for idx,sequences in enumerate(unique_sequences_per_job):
-                    job=gatk.combine_gvcf([ os.path.join("variants", "allSamples." + batch_idx + "." + str(idx) + ".hc.g.vcf.bgz") for batch_idx in batches ], os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz", intervals=sequences)
+                # Create one separate job for each of the first shards
+                for idx,bed in enumerate(beds):
+                    job=gatk.combine_gvcf([ os.path.join("variants", "allSamples." + batch_idx + "." + str(idx) + ".hc.g.vcf.bgz") for batch_idx in batches ], os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz", intervals=[bed])
                     job.name="gatk_combine_gvcf.AllSample" + "." + str(idx)
+                    job.input_files = list(job.input_files) + [bed]
                     job.removable_files=[os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz",os.path.join("variants", "allSamples") + "." + str(idx) + ".hc.g.vcf.bgz.tbi"]
                     jobs.append(job)
 
                 # Create one last job to process the last remaining sequences and 'others' sequences
-                job=gatk.combine_gvcf([ os.path.join("variants", "allSamples." + batch_idx + ".others.hc.g.vcf.bgz") for batch_idx in batches ], os.path.join("variants", "allSamples" + ".others.hc.g.vcf.bgz"), exclude_intervals=unique_sequences_per_job_others)
+                job=gatk.combine_gvcf([ os.path.join("variants", "allSamples." + batch_idx + ".others.hc.g.vcf.bgz") for batch_idx in batches ], os.path.join("variants", "allSamples" + ".others.hc.g.vcf.bgz"), exclude_intervals=others_exclude_intervals)
                 job.name="gatk_combine_gvcf.AllSample" + ".others"
+                job.input_files = list(job.input_files) + others_exclude_intervals
                 job.removable_files=[os.path.join("variants", "allSamples" + ".others.hc.g.vcf.bgz"),os.path.join("variants", "allSamples" + ".others.hc.g.vcf.bgz.tbi")]
                 jobs.append(job)
         
@@ -739,9 +812,7 @@ cp \\
         output_haplotype = os.path.join("variants", "allSamples.hc.g.vcf.bgz")
         output_haplotype_genotyped = os.path.join("variants", "allSamples.hc.vcf.bgz")
         if nb_haplotype_jobs > 1:
-            unique_sequences_per_job,unique_sequences_per_job_others = split_by_size(self.sequence_dictionary, nb_haplotype_jobs - 1)
-
-            gvcfs_to_merge = [haplotype_file_prefix + "." + str(idx) + ".hc.g.vcf.bgz" for idx in xrange(len(unique_sequences_per_job))]
+            gvcfs_to_merge = [haplotype_file_prefix + "." + str(idx) + ".hc.g.vcf.bgz" for idx in xrange(len(self.genome_scatter(nb_haplotype_jobs, section='gatk_combine_gvcf', bams=self.recalibrated_bams)) - 1)]
             gvcfs_to_merge.append(haplotype_file_prefix + ".others.hc.g.vcf.bgz")
 
             job = gatk.cat_variants(gvcfs_to_merge, output_haplotype)
@@ -864,6 +935,14 @@ pandoc \\
     def generate_approximate_windows(self, nb_jobs):
         if nb_jobs <= len(self.sequence_dictionary):
             return [sequence['name'] + ":1-" + str(sequence['length']) for sequence in self.sequence_dictionary]
+        elif config.param('snp_and_indel_bcf', 'gap_aware_windows', required=False, type='boolean'):
+            # Windows are computed once for both snp_and_indel_bcf and merge_filter_bcf steps
+            if not hasattr(self, "_gap_aware_windows"):
+                self._gap_aware_windows = {}
+            if nb_jobs not in self._gap_aware_windows:
+                gaps = genome_reference(genome_fasta=config.param('snp_and_indel_bcf', 'genome_fasta', type='filepath')).gaps(config.param('snp_and_indel_bcf', 'min_gap_length', required=False, type='posint') or 1000)
+                self._gap_aware_windows[nb_jobs] = gap_aware_windows(self.sequence_dictionary, gaps, nb_jobs)
+            return self._gap_aware_windows[nb_jobs]
         else:
             total_length = sum([sequence['length'] for sequence in self.sequence_dictionary])
             approximate_window_size = int(math.floor(total_length / (nb_jobs - len(self.sequence_dictionary))))
@@ -916,6 +995,8 @@ pandoc \\
         """
         Mpileup and Variant calling. Variants (SNPs and INDELs) are called using
         [SAMtools](http://samtools.sourceforge.net/) mpileup. bcftools view is used to produce binary bcf files.
+        With `gap_aware_windows`, region boundaries are placed in reference genome gaps so that regions carry
+        similar numbers of callable bases.
         """
 
         jobs = []
@@ -166,6 +166,7 @@ class DnaSeqHighCoverage(dnaseq.DnaSeq):
     def call_variants(self):
         """
         VarScan caller for insertions and deletions.
+        The genome is divided in `nb_jobs` contiguous regions balanced by `scatter_weights` (sequence length by default).
         """
 
         jobs = []
@@ -177,24 +178,20 @@ class DnaSeqHighCoverage(dnaseq.DnaSeq):
         variants_directory = os.path.join("variants")
         varscan_directory = os.path.join(variants_directory, "rawVarScan")
 
-        beds = []
-        for idx in range(nb_jobs):
-            beds.append(os.path.join(varscan_directory, 'chrs.' + str(idx) + '.bed'))
+        bams = [os.path.join("alignment", sample.name, sample.name + ".matefixed.sorted.bam") for sample in self.samples]
 
-        genome_dictionary = config.param('DEFAULT', 'genome_dictionary', type='filepath')
-        
         if nb_jobs > 1:
-            bedJob = tools.dict2beds(genome_dictionary, beds)
-            jobs.append(concat_jobs([mkdir_job,bedJob], name="varscan.genome.beds"))
+            # Region BED files of the genome scatter, balanced by the varscan scatter weights, are written when jobs are created
+            # and only if their regions changed, so that job commands do not depend on the scatter and jobs of unchanged regions stay up to date
+            shards = self.genome_scatter(nb_jobs, section='varscan', bams=bams)
+            beds = [os.path.join(varscan_directory, 'chrs.' + str(idx) + '.bed') for idx in range(len(shards))]
+            for intervals, bed in zip(shards, beds):
+                self.write_plan_file(bed, "".join([bed_line + "\n" for bed_line in intervals_to_bed(self.sequence_dictionary, intervals)]))
 
-        bams=[]
         sampleNamesFile = 'varscan_samples.tsv'
         sampleNames = open(sampleNamesFile, 'w')
 
         for sample in self.samples:
-            alignment_directory = os.path.join("alignment", sample.name)
-            input = os.path.join(alignment_directory, sample.name + ".matefixed.sorted.bam")
-            bams.append(input)
             sampleNames.write("%s\n" % sample.name)
             bedfile = bvatools.resolve_readset_coverage_bed(sample.readsets[0])
             #sampleNames.append(sample.name)
@@ -213,13 +210,14 @@ class DnaSeqHighCoverage(dnaseq.DnaSeq):
 
         else:
             output_vcfs=[]
-            for idx in range(nb_jobs):
+            for idx in range(len(beds)):
                 output_vcf = os.path.join(varscan_directory, "allSamples."+str(idx)+".vcf.gz")
                 varScanJob = pipe_jobs([
                     samtools.mpileup(bams, None, config.param('varscan', 'mpileup_other_options'), regionFile=beds[idx]),
                     varscan.mpileupcns(None, None, sampleNamesFile, config.param('varscan', 'other_options')),
                     htslib.bgzip_tabix_vcf(None, output_vcf)
                 ], name = "varscan." + str(idx))
+                varScanJob.input_files = list(varScanJob.input_files) + [beds[idx]]
                 output_vcfs.append(output_vcf)
                 jobs.append(varScanJob)
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Import job .done files of pipeline output directories into their completion log, used with '[DEFAULT] completion_store=log'.
+# Jobs already recorded in the completion log are skipped, since their log records are more recent than their .done file.
+
+import argparse
+import fcntl
+import glob
+import logging
+import os
+import sys
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
+
+# MUGQIC Modules
+from core.completion_store import *
+
+log = logging.getLogger(__name__)
+
+# Return the set of relative .done paths of all jobs recorded in a completion log, completed or not
+def recorded_jobs(completion_log):
+    recorded_jobs = set()
+    if os.path.exists(completion_log):
+        with open(completion_log) as completion_log_file:
+            for line in completion_log_file:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2:
+                    recorded_jobs.add(os.path.normpath(fields[1]))
+    return recorded_jobs
+
+def import_done_files(output_dir, remove):
+    output_dir = os.path.abspath(output_dir)
+    completion_log = os.path.join(output_dir, "job_output", completion_log_name)
+    # .done files are sorted by modification time, so that the completion log keeps the job completion order
+    done_files = sorted(glob.glob(os.path.join(output_dir, "job_output", "*", "*.mugqic.done")), key=os.path.getmtime)
+
+    # Lock the completion log while importing, like job scripts do when recording their completion
+    with open(completion_log, 'a') as completion_log_file:
+        fcntl.flock(completion_log_file, fcntl.LOCK_EX)
+        already_recorded_jobs = recorded_jobs(completion_log)
+        imported_done_files = []
+        for done_file in done_files:
+            done = os.path.relpath(done_file, output_dir)
+            if done in already_recorded_jobs:
+                log.debug("Job " + done + " already recorded in completion log... skipping")
+            else:
+                completion_log_file.write("done\t" + done + "\n")
+                imported_done_files.append(done_file)
+        completion_log_file.flush()
+        fcntl.flock(completion_log_file, fcntl.LOCK_UN)
+
+    log.info("Output directory " + output_dir + ": " + str(len(imported_done_files)) + " .done files imported out of " + str(len(done_files)) + " into " + completion_log)
+
+    if remove:
+        # Remove all .done files, including the ones already recorded, to avoid importing them later
+        for done_file in done_files:
+            os.remove(done_file)
+        log.info("Output directory " + output_dir + ": " + str(len(done_files)) + " .done files removed")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import job .done files of pipeline output directories into their completion log")
+    parser.add_argument("output_dirs", help="pipeline output directories", nargs="+")
+    parser.add_argument("-r", "--remove", help="remove .done files once imported (default: false)", action="store_true")
+    parser.add_argument("-l", "--log", help="log level (default: info)", choices=["debug", "info", "warning", "error", "critical"], default="info")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log.upper()))
+
+    for output_dir in args.output_dirs:
+        import_done_files(output_dir, args.remove)
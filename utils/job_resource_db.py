@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Collect job resource usage recorded in job output files listed in pipeline job list files into a SQLite database.
+# Job output files contain "MUGQICexitStatus:<status>" and "MUGQICresources:wallclock=<s> cputime=<s> maxrss=<KB> inputsize=<bytes>" lines.
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+default_database = os.path.join("$HOME", ".mugqic", "job_resources.sqlite")
+
+def create_tables(connection):
+    connection.execute("""\
+CREATE TABLE IF NOT EXISTS job (
+  job_list TEXT NOT NULL,
+  job_id TEXT NOT NULL,
+  job_name TEXT NOT NULL,
+  job_name_prefix TEXT NOT NULL,
+  job_dependencies TEXT,
+  job_output TEXT,
+  exit_status INTEGER,
+  wallclock INTEGER,
+  cputime REAL,
+  maxrss INTEGER,
+  input_size INTEGER,
+  end_time INTEGER,
+  PRIMARY KEY (job_list, job_id, job_name)
+)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS job_name_prefix_input_size ON job (job_name_prefix, input_size)")
+
+# Return job resource usage values parsed from job output file: exit status, wallclock, CPU time, peak RSS, input size and end time
+def parse_job_output(job_output):
+    values = {}
+    try:
+        with open(job_output) as job_output_file:
+            for line in job_output_file:
+                exit_status = re.search("MUGQICexitStatus:(\d+)", line)
+                resources = re.search("MUGQICresources:wallclock=(\d+) cputime=([\d.]+) maxrss=(\d+) inputsize=(\d+)", line)
+                if exit_status:
+                    values['exit_status'] = int(exit_status.group(1))
+                elif resources:
+                    values['wallclock'] = int(resources.group(1))
+                    values['cputime'] = float(resources.group(2))
+                    values['maxrss'] = int(resources.group(3))
+                    values['input_size'] = int(resources.group(4))
+        values['end_time'] = int(os.path.getmtime(job_output))
+    except IOError:
+        log.warning("Job output file " + job_output + " not found... skipping")
+    return values
+
+# Load all jobs of a pipeline job list file into the database, replacing records of this job list collected before
+def collect_job_list(connection, job_list):
+    job_list = os.path.abspath(job_list)
+    nb_jobs = 0
+    nb_resources = 0
+    with open(job_list) as job_list_file:
+        for line in job_list_file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 4:
+                [job_id, job_name, job_dependencies, job_output] = fields
+                # Job output path is relative to job list directory
+                job_output = os.path.join(os.path.dirname(job_list), job_output)
+                values = parse_job_output(job_output)
+                connection.execute(
+                    "INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_list, job_id, job_name, job_name.split(".")[0], job_dependencies, job_output, values.get('exit_status'), values.get('wallclock'), values.get('cputime'), values.get('maxrss'), values.get('input_size'), values.get('end_time'))
+                )
+                nb_jobs += 1
+                if 'wallclock' in values:
+                    nb_resources += 1
+    log.info("Job list " + job_list + ": " + str(nb_jobs) + " jobs collected, " + str(nb_resources) + " with resource usage")
+
+# Print resource usage summary of successful jobs by job name prefix i.e. config section
+def print_summary(connection):
+    print("\t".join(["#job_name_prefix", "nb_jobs", "mean_wallclock", "max_wallclock", "mean_cputime", "max_maxrss_kb", "mean_input_size"]))
+    for row in connection.execute("""\
+SELECT job_name_prefix, COUNT(*), AVG(wallclock), MAX(wallclock), AVG(cputime), MAX(maxrss), AVG(input_size)
+FROM job WHERE exit_status = 0 AND wallclock IS NOT NULL
+GROUP BY job_name_prefix ORDER BY job_name_prefix"""):
+        print("\t".join([row[0], str(row[1])] + ["%.0f" % value for value in row[2:]]))
+
+# Return (intercept, slope) of the least squares line fitting y values given x values
+def linear_fit(x_values, y_values):
+    n = len(x_values)
+    x_mean = float(sum(x_values)) / n
+    y_mean = float(sum(y_values)) / n
+    x_variance = sum([(x - x_mean) ** 2 for x in x_values])
+    slope = sum([(x - x_mean) * (y - y_mean) for x, y in zip(x_values, y_values)]) / x_variance if x_variance else 0
+    return (y_mean - slope * x_mean, slope)
+
+# Print resource model coefficients fitted on successful jobs by job name prefix, as config file sections:
+# walltime in seconds and Java heap size in MB (from peak RSS) given input size in GB, multiplied by a safety margin
+def print_resource_model(connection, margin, min_jobs):
+    job_records = {}
+    for row in connection.execute("SELECT job_name_prefix, input_size, wallclock, maxrss FROM job WHERE exit_status = 0 AND wallclock IS NOT NULL AND input_size > 0"):
+        job_records.setdefault(row[0], []).append(row[1:])
+
+    for job_name_prefix in sorted(job_records):
+        records = job_records[job_name_prefix]
+        if len(records) < min_jobs:
+            log.info("Job name prefix " + job_name_prefix + ": " + str(len(records)) + " jobs < " + str(min_jobs) + "... skipping")
+        else:
+            input_sizes_gb = [float(input_size) / 1024 ** 3 for input_size, wallclock, maxrss in records]
+            print("[" + job_name_prefix + "]")
+            print("# Fitted on " + str(len(records)) + " jobs")
+            # Fitted line is moved up so that no job exceeds it, then multiplied by the margin
+            for resource, values in [("walltime", [wallclock for input_size, wallclock, maxrss in records]), ("java_heap", [maxrss / 1024.0 for input_size, wallclock, maxrss in records])]:
+                intercept, slope = linear_fit(input_sizes_gb, values)
+                intercept += max([value - (intercept + slope * x) for x, value in zip(input_sizes_gb, values)])
+                print("resource_model_" + resource + "=" + "%.0f" % (max(intercept, 0) * margin) + "," + "%.1f" % (max(slope, 0) * margin))
+            print("")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect job resource usage of pipeline job list files into a SQLite database")
+    parser.add_argument("job_lists", help="pipeline job list files e.g. <output_dir>/job_output/<Pipeline>_job_list_<timestamp>", nargs="*")
+    parser.add_argument("-d", "--database", help="SQLite database file (default: " + default_database + ")", default=default_database)
+    parser.add_argument("-s", "--summary", help="print resource usage summary by job name prefix (default: false)", action="store_true")
+    parser.add_argument("-f", "--fit", help="print resource model coefficients fitted by job name prefix as config file sections (default: false)", action="store_true")
+    parser.add_argument("-m", "--margin", help="resource model safety margin factor (default: 1.5)", type=float, default=1.5)
+    parser.add_argument("-n", "--min-jobs", help="minimum number of successful jobs to fit a resource model (default: 10)", type=int, default=10)
+    parser.add_argument("-l", "--log", help="log level (default: info)", choices=["debug", "info", "warning", "error", "critical"], default="info")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log.upper()))
+
+    database = os.path.expandvars(args.database)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(database))):
+        os.makedirs(os.path.dirname(os.path.abspath(database)))
+
+    connection = sqlite3.connect(database)
+    try:
+        create_tables(connection)
+        for job_list in args.job_lists:
+            collect_job_list(connection, job_list)
+        connection.commit()
+
+        if args.summary:
+            print_summary(connection)
+        if args.fit:
+            print_resource_model(connection, args.margin, args.min_jobs)
+    finally:
+        connection.close()
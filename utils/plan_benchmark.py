@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
+
+# MUGQIC Modules
+from core.config import *
+from core.job import *
+from core.pipeline import *
+
+log = logging.getLogger(__name__)
+
+# Synthetic pipeline planning a cohort of readsets through per-readset steps and a final cohort step,
+# without any real input file: first step jobs have no input files and produce the raw reads
+class SyntheticPipeline(Pipeline):
+
+    def __init__(self, nb_readsets):
+        self.version = "benchmark"
+        self._readsets = ["readset" + str(i + 1) for i in range(nb_readsets)]
+        super(SyntheticPipeline, self).__init__()
+
+    @property
+    def readsets(self):
+        return self._readsets
+
+    def raw_reads(self):
+        return [Job(
+            [],
+            [os.path.join("raw_reads", readset + ".pair1.fastq.gz"), os.path.join("raw_reads", readset + ".pair2.fastq.gz")],
+            name="raw_reads." + readset,
+            command="touch raw_reads/" + readset + ".pair1.fastq.gz raw_reads/" + readset + ".pair2.fastq.gz"
+        ) for readset in self.readsets]
+
+    def trimming(self):
+        jobs = []
+        for readset in self.readsets:
+            # As in Illumina.trimmomatic, readset FASTQ files are missing and fall back to the raw reads job output files
+            [fastq1, fastq2] = self.select_input_files([
+                [os.path.join("fastq", readset + ".pair1.fastq.gz"), os.path.join("fastq", readset + ".pair2.fastq.gz")],
+                [os.path.join("raw_reads", readset + ".pair1.fastq.gz"), os.path.join("raw_reads", readset + ".pair2.fastq.gz")]
+            ])
+            jobs.append(Job(
+                [fastq1, fastq2],
+                [os.path.join("trim", readset + ".trim.pair1.fastq.gz"), os.path.join("trim", readset + ".trim.pair2.fastq.gz")],
+                name="trimming." + readset,
+                command="trim " + fastq1 + " " + fastq2
+            ))
+        return jobs
+
+    def alignment(self):
+        return [Job(
+            [os.path.join("trim", readset + ".trim.pair1.fastq.gz"), os.path.join("trim", readset + ".trim.pair2.fastq.gz")],
+            [os.path.join("alignment", readset + ".sorted.bam")],
+            name="alignment." + readset,
+            command="align " + readset
+        ) for readset in self.readsets]
+
+    def metrics(self):
+        return [Job(
+            [os.path.join("alignment", readset + ".sorted.bam")],
+            [os.path.join("metrics", readset + ".metrics.tsv")],
+            name="metrics." + readset,
+            command="metrics " + readset
+        ) for readset in self.readsets]
+
+    def cohort_metrics(self):
+        return [Job(
+            [os.path.join("metrics", readset + ".metrics.tsv") for readset in self.readsets],
+            [os.path.join("metrics", "cohort.metrics.tsv")],
+            name="cohort_metrics",
+            command="cat metrics/*.metrics.tsv > metrics/cohort.metrics.tsv"
+        )]
+
+    @property
+    def steps(self):
+        return [
+            self.raw_reads,
+            self.trimming,
+            self.alignment,
+            self.metrics,
+            self.cohort_metrics
+        ]
+
+# Plan the synthetic pipeline in a temporary directory, once per given list of extra pipeline arguments,
+# and return the list of (pipeline, elapsed time in seconds) of each planning
+def run_plans(nb_readsets, config_content, extra_args_list):
+    benchmark_dir = tempfile.mkdtemp(prefix="mugqic_plan_benchmark.")
+    current_dir = os.getcwd()
+    stdout = sys.stdout
+    # Discard the generated job script
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        os.chdir(benchmark_dir)
+        config_file = os.path.join(benchmark_dir, "benchmark.ini")
+        with open(config_file, 'w') as config_ini:
+            config_ini.write("[DEFAULT]\n" + config_content)
+
+        plans = []
+        for extra_args in extra_args_list:
+            sys.argv = [sys.argv[0], "-c", config_file, "-s", "1-5", "-o", benchmark_dir, "-j", "batch", "-l", "warning"] + extra_args
+            start = time.time()
+            pipeline = SyntheticPipeline(nb_readsets)
+            plans.append((pipeline, time.time() - start))
+        return plans
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(current_dir)
+        shutil.rmtree(benchmark_dir)
+
+# Plan the synthetic pipeline twice for a given number of readsets with the plan cache enabled,
+# and return the elapsed times in seconds of the first planning and of the second one reusing cached jobs
+def benchmark_plan(nb_readsets):
+    return [elapsed_time for pipeline, elapsed_time in run_plans(nb_readsets, "", [["--plan-cache"], ["--plan-cache"]])]
+
+# Return the current resident set size of this process in bytes, or its peak resident set size if not available
+def resident_set_size():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Peak resident set size is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Plan the synthetic pipeline for a given number of readsets with or without compact jobs,
+# and return the memory in bytes retained by the pipeline and its jobs.
+# Run in a separate process so that memory freed by previous benchmarks is not reused.
+def benchmark_memory(nb_readsets, compact_jobs):
+    gc.collect()
+    initial_rss = resident_set_size()
+    plans = run_plans(nb_readsets, "compact_jobs=" + str(compact_jobs).lower() + "\n", [[]])
+    gc.collect()
+    return resident_set_size() - initial_rss
+
+def benchmark_memory_process(nb_readsets, compact_jobs):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(benchmark_memory, (nb_readsets, compact_jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+# Concatenate then pipe jobs like merge_trimmomatic_stats does with one job per readset,
+# and return the elapsed times in seconds of concat_jobs and pipe_jobs
+def benchmark_concat(nb_jobs):
+    jobs = [Job(
+        [os.path.join("trim", "readset" + str(i + 1) + ".trim.log")],
+        [os.path.join("metrics", "readset" + str(i + 1) + ".trim.stats.csv")],
+        name="merge_trimmomatic_stats.readset" + str(i + 1),
+        command="grep ^Input trim/readset" + str(i + 1) + ".trim.log",
+        report_files=[os.path.join("report", "trimReadsetTable.tsv")],
+        removable_files=[os.path.join("trim", "readset" + str(i + 1) + ".tmp")]
+    ) for i in range(nb_jobs)]
+    for job in jobs:
+        job.modules = ["mugqic/python/2.7.8", "mugqic/R_Bioconductor/3.1.2_3.0"]
+
+    start = time.time()
+    concat_jobs(jobs, name="merge_trimmomatic_stats")
+    concat_time = time.time() - start
+
+    start = time.time()
+    pipe_jobs(jobs, name="merge_trimmomatic_stats")
+    return [concat_time, time.time() - start]
+
+parser = argparse.ArgumentParser(description="Benchmark pipeline planning on a synthetic cohort of readsets")
+parser.add_argument("-n", "--readsets", help="comma-separated list of cohort sizes to plan (default: 1000,2000,5000,10000)", default="1000,2000,5000,10000")
+parser.add_argument("-c", "--concat-jobs", help="benchmark concat_jobs and pipe_jobs on this number of jobs instead of planning, e.g. 10000", type=int)
+parser.add_argument("-m", "--memory", help="benchmark memory retained by planned jobs with and without compact jobs instead of planning time (default: false)", action="store_true")
+
+args = parser.parse_args()
+
+if args.concat_jobs:
+    [concat_time, pipe_time] = benchmark_concat(args.concat_jobs)
+    print("Jobs: " + str(args.concat_jobs) + "\tconcat_jobs time: " + "%.3f" % concat_time + " s\tpipe_jobs time: " + "%.3f" % pipe_time + " s")
+else:
+    for nb_readsets in [int(nb_readsets) for nb_readsets in args.readsets.split(",")]:
+        # Each readset creates one job in the 4 per-readset steps, plus one cohort job
+        nb_jobs = nb_readsets * 4 + 1
+        if args.memory:
+            job_memory = benchmark_memory_process(nb_readsets, False)
+            compact_job_memory = benchmark_memory_process(nb_readsets, True)
+            print("Readsets: " + str(nb_readsets) + "\tJobs: " + str(nb_jobs) + "\tMemory: " + "%.1f" % (job_memory / 1024.0 ** 2) + " MB\t(" + "%.0f" % (float(job_memory) / nb_jobs) + " B/job)\tCompact jobs memory: " + "%.1f" % (compact_job_memory / 1024.0 ** 2) + " MB\t(" + "%.0f" % (float(compact_job_memory) / nb_jobs) + " B/job)")
+        else:
+            [elapsed_time, cached_elapsed_time] = benchmark_plan(nb_readsets)
+            print("Readsets: " + str(nb_readsets) + "\tJobs: " + str(nb_jobs) + "\tPlanning time: " + "%.2f" % elapsed_time + " s\t(" + "%.1f" % (elapsed_time / nb_jobs * 1000000) + " us/job)\tCached planning time: " + "%.2f" % cached_elapsed_time + " s")